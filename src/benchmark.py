@@ -0,0 +1,486 @@
+"""
+Benchmarks for the INEO harvesting and templating pipeline.
+
+Run inside the ineo-sync container, next to the basex container (see docker-compose.yaml):
+
+    python benchmark.py index --sizes 1000 10000 100000
+    python benchmark.py template tools --sizes 1000 10000 --basex
+    python benchmark.py hash --sizes 1000 10000
+    python benchmark.py store --sizes 10000 100000
+    python benchmark.py history --files 2000 --days 365
+
+The synthetic corpora are written to ./data/benchmark, which the basex container sees as /data/benchmark.
+Without --basex the templating benchmark runs against a stand-in of the BaseX REST API in this process (see
+BaseXStandIn), so it also runs outside the containers:
+
+    python benchmark.py template tools --sizes 1000 --latency 5
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import statistics
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import utils
+from utils import get_logger, get_basex_client, init_basex_client
+from template_compiler import fallback_query
+from query_registry import query_registry
+
+logger = get_logger("benchmark.log", __name__)
+
+BENCHMARK_FOLDER = "./data/benchmark"
+# the same folder as seen by the basex container
+BASEX_BENCHMARK_FOLDER = "/data/benchmark"
+
+
+def synthetic_codemeta(i: int) -> dict:
+    """
+    A small codemeta record, with the fields used by the tools template.
+    """
+    return {
+        "@context": "https://w3id.org/codemeta/3.0",
+        "@type": "SoftwareSourceCode",
+        "identifier": f"tool-{i:06d}",
+        "name": f"tool {i}",
+        "description": f"Synthetic tool number {i} for benchmarking. " * 5,
+        "codeRepository": f"https://github.com/example/tool-{i}",
+        "dateCreated": "2024-01-01",
+        "programmingLanguage": ["Python", "XQuery"],
+        "author": [{"@type": "Person", "givenName": "Jane", "familyName": f"Doe{i}"}],
+        "developmentStatus": "https://www.repostatus.org/#active",
+        "applicationCategory": [{"@id": "https://w3id.org/nwo-research-fields#Linguistics"}],
+    }
+
+
+def synthetic_dataset(i: int) -> dict:
+    """
+    A small dataset record, as parsed from the Solr response (see harvester.store_solr_response), with the fields
+    used by the datasets template.
+    """
+    return {
+        "id": f"dataset-{i:06d}",
+        "name": [f"dataset {i}"],
+        "description": [f"{{code:eng}}Synthetic dataset number {i} for benchmarking. " * 3],
+        "subject": ["Linguistics", "Language resources"],
+        "languageCode": ["code:nld"],
+        "collection": ["Benchmark collection"],
+        "_selfLink": f"https://example.org/record/dataset-{i:06d}",
+    }
+
+
+def synthetic_ruc(current_id: str) -> dict:
+    """
+    A RUC as written by harvester.serialize_ruc_to_json, with the keys used by the templates.
+    """
+    title = f"Title of {current_id}"
+    return {
+        "identifier": current_id,
+        "title": title,
+        title.lower(): f"Description of {current_id} in the RUC.",
+        "overview": f"### Overview\n Synthetic overview of {current_id}.\n### Data\n Some data.",
+        "learn": f"Learn more about {current_id}.",
+        "mentions": f"Mentions of {current_id}.",
+        "carousel": ["/media/logo.svg", "https://example.org/screenshot.png"],
+    }
+
+
+def write_corpus(folder: str, size: int, make_record=synthetic_codemeta) -> list[str]:
+    """
+    Write a synthetic corpus of size records as individual json files, returns the ids.
+    """
+    os.makedirs(folder, exist_ok=True)
+    ids = []
+    for i in range(size):
+        record = make_record(i)
+        current_id = record.get("identifier", record.get("id"))
+        with open(os.path.join(folder, f"{current_id}.json"), "w") as f:
+            json.dump(record, f)
+        ids.append(current_id)
+    return ids
+
+
+def summarize(latencies: list[float]) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "calls": len(latencies),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 2),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2),
+    }
+
+
+def bench_index_lookup(sizes: list[int], lookups: int = 200, query_file: str = "queries/name.xq") -> list[dict]:
+    """
+    Measure the latency of a single-id query against tools databases of increasing size.
+    With the text index the latency should stay flat as the database grows.
+    """
+    # imported here, main pulls in the whole pipeline
+    from main import prepare_basex_tables
+
+    file_query = query_registry.get(query_file)
+
+    client = get_basex_client()
+    results = []
+    for size in sizes:
+        db = f"benchmark_tools_{size}"
+        ids = write_corpus(os.path.join(BENCHMARK_FOLDER, db), size)
+        prepare_basex_tables(db, f"{BASEX_BENCHMARK_FOLDER}/{db}", client)
+
+        for name, query in (("fallback", fallback_query("name", "tools")), (query_file, file_query)):
+            latencies = []
+            for current_id in random.sample(ids, min(lookups, size)):
+                start = time.perf_counter()
+                response = client.query(query, db, {"DB": db, "ID": current_id})
+                latencies.append(time.perf_counter() - start)
+                assert response.status_code == 200, response.text
+            result = {"size": size, "query": name, **summarize(latencies)}
+            logger.info(result)
+            results.append(result)
+    return results
+
+
+def write_rucs(folder: str, ids: list[str]) -> None:
+    os.makedirs(folder, exist_ok=True)
+    for current_id in ids:
+        with open(os.path.join(folder, f"{current_id}.json"), "w") as f:
+            json.dump(synthetic_ruc(current_id), f)
+
+
+class BaseXStandIn:
+    """
+    A stand-in of the BaseX REST API (POST /rest/{db}) in this process, the pipeline is pointed at it on enter.
+    Every query is answered after the latency: a single-id query with an empty result, a batch query (see
+    utils.build_batch_query) with an empty result per id. It measures the templating itself and the number of
+    requests, not the evaluation of the queries.
+
+    latency (float): the latency of every request in seconds
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.original = None
+
+    def handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, as the pooled sessions of the clients expect
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                variables = {variable.get("name"): variable.get("value")
+                             for variable in ElementTree.fromstring(body).findall("variable")}
+                with stand_in.lock:
+                    stand_in.requests += 1
+                time.sleep(stand_in.latency)
+                if "IDS" in variables:
+                    text = json.dumps({current_id: "" for current_id in json.loads(variables["IDS"])})
+                else:
+                    text = ""
+                response = text.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self) -> "BaseXStandIn":
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        # the clients created from now on (also by forked workers) use the stand-in
+        self.original = (utils.BASEX_HOST, utils.BASEX_PORT)
+        utils.BASEX_HOST, utils.BASEX_PORT = self.server.server_address
+        init_basex_client()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        utils.BASEX_HOST, utils.BASEX_PORT = self.original
+        init_basex_client()
+
+
+# the ways main.call_template can template the ids
+TEMPLATE_MODES = {
+    # a query per id and md directive, as before the md queries were evaluated in batch
+    "serial": {"workers": 1, "batch_size": 1},
+    "batched": {"workers": 1},
+    "thread": {"mode": "thread"},
+    "process": {"mode": "process"},
+    "async": {"mode": "async"},
+}
+
+
+def bench_templating(template_type: str, sizes: list[int], modes: list[str], latency: float = 0.005,
+                     use_basex: bool = False, ruc_every: int = 10) -> list[dict]:
+    """
+    Measure the records per second of main.call_template in every mode on synthetic corpora of increasing size.
+    The template cache is not used, so every run templates all ids. The packages are written to a spool.
+
+    template_type (str): 'tools' or 'datasets'
+    sizes (list[int]): the numbers of records
+    modes (list[str]): the modes to compare, see TEMPLATE_MODES
+    latency (float): the latency of the stand-in in seconds
+    use_basex (bool): run against BaseX instead of the stand-in, the corpora are loaded in benchmark databases
+    ruc_every (int): every ruc_every-th record has a RUC
+    """
+    # imported here, main pulls in the whole pipeline
+    import main
+    import md_index
+    import template
+    import template_compiler
+    from package_sink import JsonlSpoolSink
+
+    main.USE_TEMPLATE_CACHE = False
+    main.PROFILE_TEMPLATING = False
+    make_record = synthetic_codemeta if template_type == "tools" else synthetic_dataset
+    spool_folder = os.path.join(BENCHMARK_FOLDER, "spool")
+
+    results = []
+    with nullcontext() if use_basex else BaseXStandIn(latency) as stand_in:
+        for size in sizes:
+            db = f"benchmark_{template_type}_{size}"
+            ids = write_corpus(os.path.join(BENCHMARK_FOLDER, db), size, make_record)
+            write_rucs(os.path.join(BENCHMARK_FOLDER, f"{db}_ruc"), ids[::ruc_every])
+            # the pipeline reads the synthetic corpus instead of the harvested metadata
+            template_compiler.DBNAMES[template_type] = db
+            md_index.METADATA_FOLDERS[template_type] = os.path.join(BENCHMARK_FOLDER, db)
+            md_index.md_indexes.pop(template_type, None)
+            template.RUC_FOLDER = os.path.join(BENCHMARK_FOLDER, f"{db}_ruc")
+            if use_basex:
+                main.prepare_basex_tables(db, f"{BASEX_BENCHMARK_FOLDER}/{db}")
+            # loaded before the modes are timed, like call_template does before starting a pool
+            md_index.get_md_index(template_type)
+
+            for mode in modes:
+                shutil.rmtree(spool_folder, ignore_errors=True)
+                requests_before = stand_in.requests if stand_in else 0
+                start = time.perf_counter()
+                with JsonlSpoolSink(spool_folder) as sink:
+                    errors = main.call_template(ids, template_type, sink=sink, **TEMPLATE_MODES[mode])
+                seconds = time.perf_counter() - start
+                result = {"type": template_type, "size": size, "mode": mode, "seconds": round(seconds, 2),
+                          "records_per_sec": round(size / seconds, 1), "errors": len(errors),
+                          "requests": stand_in.requests - requests_before if stand_in else ""}
+                logger.info(result)
+                results.append(result)
+    return results
+
+
+def legacy_codemeta_md5(file_name: str) -> str:
+    """
+    The hashing of a codemeta file before harvester.get_canonical hashed in memory: the purged json was written to a
+    <file>.canon file, which was read back to be hashed.
+    """
+    canon_file = f"{file_name}.canon"
+    with open(file_name, "r") as json_file:
+        data = json.load(json_file)
+        if "review" in data:
+            data["review"]["@id"] = "__canon_purge__"
+            data["review"]["datePublished"] = "__canon_purge__"
+    with open(canon_file, "w") as json_file:
+        json.dump(data, json_file, indent=2)
+    hasher = hashlib.md5()
+    with open(canon_file, "rb") as file:
+        for chunk in iter(lambda: file.read(4096), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def bench_hashing(sizes: list[int]) -> list[dict]:
+    """
+    Measure the files per second of the change detection hashing of codemeta files:
+    - canon_file: the purged json written to a .canon file and read back, see legacy_codemeta_md5
+    - in_memory: harvester.get_md5, the file is read and its canonical form hashed in memory
+    - on_write: harvester.canonical_md5 of the json which is being written, as download_json_files does
+    """
+    # imported here, harvester reads the .env
+    import harvester
+
+    results = []
+    for size in sizes:
+        folder = os.path.join(BENCHMARK_FOLDER, f"hash_{size}")
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+        records = {}
+        for i in range(size):
+            record = synthetic_codemeta(i)
+            record["review"] = {"@type": "Review", "@id": f"https://example.org/review/{i}/{random.random()}",
+                                "datePublished": "2024-01-01T00:00:00", "reviewRating": 4}
+            file_name = os.path.join(folder, f"{record['identifier']}.codemeta.json")
+            with open(file_name, "w") as f:
+                json.dump(record, f, indent=2)
+            records[file_name] = record
+        purge_rules = harvester.get_purge_rules(".codemeta.json")
+
+        modes = (("canon_file", legacy_codemeta_md5),
+                 ("in_memory", harvester.get_md5),
+                 ("on_write", lambda file_name: harvester.canonical_md5(records[file_name], purge_rules)))
+        for mode, md5 in modes:
+            start = time.perf_counter()
+            for file_name in records:
+                md5(file_name)
+            seconds = time.perf_counter() - start
+            result = {"size": size, "mode": mode, "seconds": round(seconds, 3),
+                      "files_per_sec": round(size / seconds, 1)}
+            logger.info(result)
+            results.append(result)
+    return results
+
+
+def bench_change_store(sizes: list[int], batches: int = 3) -> list[dict]:
+    """
+    Measure the time to record a batch of files in the change-tracking store and to read the previous batch back,
+    as harvester.get_changed_ids does, in a fresh database per size.
+    """
+    from change_store import ChangeStore
+
+    results = []
+    os.makedirs(BENCHMARK_FOLDER, exist_ok=True)
+    for size in sizes:
+        db_file_name = os.path.join(BENCHMARK_FOLDER, f"ineo_{size}.db")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_file_name + suffix):
+                os.remove(db_file_name + suffix)
+        store = ChangeStore(db_file_name)
+        file_names = [f"data/tools_metadata/tool-{i:06d}.codemeta.json" for i in range(size)]
+        for batch in range(batches):
+            timestamp = f"202401{batch + 1:02d}000000"
+            start = time.perf_counter()
+            previous_timestamp = store.latest_timestamp("tools_metadata")
+            previous = store.get_batch("tools_metadata", previous_timestamp) if previous_timestamp else {}
+            read_seconds = time.perf_counter() - start
+            rows = [(file_name, hashlib.md5(f"{file_name}{batch}".encode()).hexdigest(), None)
+                    for file_name in file_names]
+            start = time.perf_counter()
+            store.record_batch("tools_metadata", rows, timestamp)
+            record_seconds = time.perf_counter() - start
+            result = {"size": size, "batch": batch + 1, "previous": len(previous),
+                      "read_seconds": round(read_seconds, 3), "record_seconds": round(record_seconds, 3)}
+            logger.info(result)
+            results.append(result)
+        store.close()
+    return results
+
+
+def bench_history(files: int = 2000, days: int = 365, keep_batches: Optional[int] = None) -> list[dict]:
+    """
+    Measure harvester.get_changed_ids on a database with a batch per day, of which 1% of the files changed, as it
+    grew (full) and after change_store.ChangeStore.compact and a VACUUM (compacted).
+    The hashes of the files are given, as the downloads do, so the files themselves are not read.
+    """
+    # imported here, harvester reads the .env
+    import harvester
+    from change_store import ChangeStore, HISTORY_BATCHES, close_change_stores
+
+    keep_batches = keep_batches or HISTORY_BATCHES
+    folder = os.path.join(BENCHMARK_FOLDER, "history")
+    shutil.rmtree(folder, ignore_errors=True)
+    ids = write_corpus(os.path.join(folder, "tools_metadata"), files)
+    file_names = [os.path.normpath(os.path.join(folder, "tools_metadata", f"{current_id}.json")) for current_id in ids]
+
+    db_file_name = os.path.join(folder, "ineo.db")
+    store = ChangeStore(db_file_name)
+    first_day = datetime(2024, 1, 1)
+    for day in range(days):
+        timestamp = (first_day + timedelta(days=day)).strftime("%Y%m%d%H%M%S")
+        rows = [(file_name, f"{day if i % 100 == day % 100 else 0}", None) for i, file_name in enumerate(file_names)]
+        store.record_batch("tools_metadata", rows, timestamp)
+    hashes = store.get_batch("tools_metadata", store.latest_timestamp("tools_metadata"))
+    store.close()
+
+    compacted_db_file_name = os.path.join(folder, "ineo_compacted.db")
+    shutil.copy(db_file_name, compacted_db_file_name)
+    store = ChangeStore(compacted_db_file_name)
+    store.compact("tools_metadata", keep_batches)
+    store.vacuum_if_due()
+    store.close()
+
+    harvester.output_path_data = folder
+    timestamp = (first_day + timedelta(days=days)).strftime("%Y%m%d%H%M%S")
+    results = []
+    for name, db in (("full", db_file_name), ("compacted", compacted_db_file_name)):
+        store = ChangeStore(db)
+        rows = store.conn.execute("SELECT COUNT(*) FROM tools_metadata").fetchone()[0]
+        store.close()
+        size_mb = os.path.getsize(db) / 1024 / 1024
+        changed_ids = []
+        start = time.perf_counter()
+        harvester.get_changed_ids(db, "tools_metadata", timestamp, "tools_metadata", changed_ids, hashes=hashes)
+        seconds = time.perf_counter() - start
+        close_change_stores()
+        result = {"db": name, "files": files, "days": days, "rows": rows, "size_mb": round(size_mb, 1),
+                  "changed": len(changed_ids), "seconds": round(seconds, 3)}
+        logger.info(result)
+        results.append(result)
+    return results
+
+
+def print_table(results: list[dict]) -> None:
+    if not results:
+        return
+    columns = list(results[0].keys())
+    print("\t".join(columns))
+    for result in results:
+        print("\t".join(str(result[c]) for c in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    index_parser = subparsers.add_parser("index", help="per-query latency of the id lookup as the database grows")
+    index_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    index_parser.add_argument("--lookups", type=int, default=200)
+
+    template_parser = subparsers.add_parser("template", help="records/sec of the templating in every mode")
+    template_parser.add_argument("template_type", choices=["tools", "datasets"])
+    template_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    template_parser.add_argument("--modes", nargs="+", choices=list(TEMPLATE_MODES), default=list(TEMPLATE_MODES))
+    template_parser.add_argument("--latency", type=float, default=5.0, help="latency of the stand-in in ms")
+    template_parser.add_argument("--basex", action="store_true", help="run against BaseX instead of the stand-in")
+
+    hash_parser = subparsers.add_parser("hash", help="files/sec of the change detection hashing")
+    hash_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+
+    store_parser = subparsers.add_parser("store", help="seconds to record and read a batch in the change store")
+    store_parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+
+    history_parser = subparsers.add_parser("history", help="seconds of get_changed_ids with a year of batches")
+    history_parser.add_argument("--files", type=int, default=2000)
+    history_parser.add_argument("--days", type=int, default=365)
+
+    args = parser.parse_args()
+    if args.benchmark == "index":
+        print_table(bench_index_lookup(args.sizes, args.lookups))
+    elif args.benchmark == "template":
+        print_table(bench_templating(args.template_type, args.sizes, args.modes, args.latency / 1000, args.basex))
+    elif args.benchmark == "hash":
+        print_table(bench_hashing(args.sizes))
+    elif args.benchmark == "store":
+        print_table(bench_change_store(args.sizes))
+    elif args.benchmark == "history":
+        print_table(bench_history(args.files, args.days))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+import logging
+import os
+import sqlite3
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from utils import get_logger
+
+logger = get_logger("harvester.log", __name__, level=logging.ERROR)
+
+"""
+The change-tracking store of the harvester, the SQLite database ineo.db.
+
+The change tables (e.g. tools_metadata, rich_user_contents and datasets) have a row (file_name, md5, timestamp) per
+harvested file per batch; all files of a batch have the same timestamp. The previous batch of a table is the one with
+the highest timestamp, the files of a new batch are compared with it (see harvester.get_changed_ids).
+The presence table keeps, per file of every change table, the last batch it was part of and the number of batches
+it was absent from since then (missed_runs); it is updated with every batch, so the files which disappeared are
+found without going through the history (see absent). So only the last batches of the change tables are needed, the
+older batches are removed by compact.
+
+A run uses a single connection per database (see get_change_store). The journal is a write-ahead log, and a batch is
+recorded in a single transaction, so recording it costs a single sync of the file.
+
+The state of a harvest that tells which files need not be harvested again (e.g. the validators of the downloaded files
+or the high-water mark of the Solr harvest) is saved with_batch: in the transaction recording the next batch of the
+change table. If the run fails before the batch is recorded, the files are harvested again by the next run, and their
+changes are still found.
+"""
+
+# the database of the harvester
+DB_FILE = "./data/ineo.db"
+# the table with the ETag and Last-Modified of the downloaded codemeta files, see harvester.download_json_files
+VALIDATORS_TABLE = "http_validators"
+# the table with the highest modification time of the harvested Solr records per query, see harvester._harvest_datasets
+HARVEST_STATE_TABLE = "harvest_state"
+# the table with the last batch every file of the change tables was part of, see record_batch
+PRESENCE_TABLE = "presence"
+# the table with the ids to be reported until they are handled, by the next batch of a change table or explicitly,
+# see add_pending_ids
+PENDING_TABLE = "pending_ids"
+# the table with the last run of the maintenance tasks, see vacuum_if_due
+MAINTENANCE_TABLE = "maintenance"
+# number of batches kept per change table by compact, at least 1: the previous batch is compared with the next one
+HISTORY_BATCHES = 10
+# number of days between two VACUUMs of the database, see vacuum_if_due
+VACUUM_DAYS = 30
+
+
+class ChangeStore:
+    """
+    A connection to the database, with the queries of the harvester.
+    """
+
+    def __init__(self, db_file_name: str = DB_FILE):
+        self.db_file_name = db_file_name
+        self.conn = sqlite3.connect(db_file_name)
+        # readers do not block the writer, and a commit only syncs the log
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # the change tables which are known to exist, see ensure_table
+        self.tables = set()
+        # the change tables whose presence is not tracked, see untrack_presence
+        self.untracked = set()
+        # the writes deferred to the transaction recording the next batch of a change table, see write
+        self.deferred: Dict[str, List[Callable[[], None]]] = {}
+
+    def ensure_table(self, table_name: str) -> None:
+        """
+        Create the change table and its indexes if they do not exist yet.
+        The presence of the files of a change table with batches from before the presence table is derived from them.
+        """
+        if table_name in self.tables:
+            return
+        with self.conn:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table_name} "
+                              f"(file_name text, md5 text, timestamp text DEFAULT CURRENT_TIMESTAMP)")
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_timestamp ON {table_name} (timestamp)")
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_file_name_timestamp "
+                              f"ON {table_name} (file_name, timestamp)")
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {PRESENCE_TABLE} "
+                              f"(table_name text, file_name text, item_id text, last_seen text, missed_runs integer, "
+                              f"PRIMARY KEY (table_name, file_name))")
+            self.ensure_pending_table()
+            if table_name not in self.untracked and self.conn.execute(f"SELECT 1 FROM {PRESENCE_TABLE} WHERE table_name = ? LIMIT 1",
+                                 (table_name,)).fetchone() is None:
+                # missed_runs is the number of batches after the last batch of the file
+                self.conn.execute(f"""
+                    WITH runs AS (SELECT timestamp, ROW_NUMBER() OVER (ORDER BY timestamp DESC) - 1 AS runs_since
+                                  FROM (SELECT DISTINCT timestamp FROM {table_name}))
+                    INSERT INTO {PRESENCE_TABLE} (table_name, file_name, item_id, last_seen, missed_runs)
+                    SELECT ?, file_name, NULL, MAX(timestamp), MIN(runs_since)
+                    FROM {table_name} JOIN runs USING (timestamp)
+                    GROUP BY file_name""", (table_name,))
+        self.tables.add(table_name)
+
+    def latest_timestamp(self, table_name: str) -> Optional[str]:
+        """
+        The timestamp of the previous batch, None if there is no batch yet
+        """
+        self.ensure_table(table_name)
+        return self.conn.execute(f"SELECT MAX(timestamp) FROM {table_name}").fetchone()[0]
+
+    def get_batch(self, table_name: str, timestamp: str) -> Dict[str, str]:
+        """
+        The files of the batch with the timestamp, {file_name: md5}
+        """
+        self.ensure_table(table_name)
+        rows = self.conn.execute(f"SELECT file_name, md5 FROM {table_name} WHERE timestamp = ?", (timestamp,))
+        return {file_name: md5 for file_name, md5 in rows}
+
+    def record_batch(self, table_name: str, rows: Iterable[Tuple[str, str, Optional[str]]], timestamp: str) -> None:
+        """
+        Record the files of a batch and their presence in a single transaction. The files of the table which are not
+        in the batch have missed one more run.
+
+        rows (iterable): (file_name, md5, id) of every file of the batch, the id is None if it is not known (e.g. the
+            file was not read), the id recorded before is then kept
+        """
+        self.ensure_table(table_name)
+        rows = list(rows)
+        with self.conn:
+            self.conn.executemany(f"INSERT INTO {table_name} (file_name, md5, timestamp) VALUES (?, ?, ?)",
+                                  ((file_name, md5, timestamp) for file_name, md5, _ in rows))
+            if table_name not in self.untracked:
+                self.conn.executemany(f"INSERT INTO {PRESENCE_TABLE} "
+                                      f"(table_name, file_name, item_id, last_seen, missed_runs) "
+                                      f"VALUES (?, ?, ?, ?, 0) "
+                                      f"ON CONFLICT (table_name, file_name) DO UPDATE SET "
+                                      f"item_id = COALESCE(excluded.item_id, item_id), last_seen = excluded.last_seen, "
+                                      f"missed_runs = 0",
+                                      ((table_name, file_name, item_id, timestamp) for file_name, _, item_id in rows))
+                self.conn.execute(f"UPDATE {PRESENCE_TABLE} SET missed_runs = missed_runs + 1 "
+                                  f"WHERE table_name = ? AND last_seen < ?", (table_name, timestamp))
+            self.conn.execute(f"DELETE FROM {PENDING_TABLE} WHERE table_name = ?", (table_name,))
+            for write in self.deferred.pop(table_name, []):
+                write()
+
+    def untrack_presence(self, table_name: str) -> None:
+        """
+        Do not track the presence of the files of the change table, e.g. when the files removed from it are reported
+        otherwise; its presence recorded before is removed
+        """
+        self.untracked.add(table_name)
+        with self.conn:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {PRESENCE_TABLE} "
+                              f"(table_name text, file_name text, item_id text, last_seen text, missed_runs integer, "
+                              f"PRIMARY KEY (table_name, file_name))")
+            self.conn.execute(f"DELETE FROM {PRESENCE_TABLE} WHERE table_name = ?", (table_name,))
+
+    def ensure_pending_table(self) -> None:
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {PENDING_TABLE} "
+                          f"(table_name text, item_id text, PRIMARY KEY (table_name, item_id))")
+
+    def add_pending_ids(self, table_name: str, ids: Iterable[str]) -> None:
+        """
+        Keep the ids until they are handled, so they are reported again by the next run if this one fails before
+        (see pending_ids)
+
+        table_name (str): a change table, its pending ids (e.g. of the files removed by the harvest) are cleared when
+            its next batch is recorded; or another key (e.g. harvester.PENDING_DELETIONS), whose ids are kept until they
+            are removed with remove_pending_ids
+        """
+        with self.conn:
+            self.ensure_pending_table()
+            self.conn.executemany(f"INSERT OR IGNORE INTO {PENDING_TABLE} (table_name, item_id) VALUES (?, ?)",
+                                  ((table_name, item_id) for item_id in ids))
+
+    def pending_ids(self, table_name: str) -> List[str]:
+        """
+        The ids kept by add_pending_ids which are not handled yet
+        """
+        with self.conn:
+            self.ensure_pending_table()
+        rows = self.conn.execute(f"SELECT item_id FROM {PENDING_TABLE} WHERE table_name = ? ORDER BY item_id",
+                                 (table_name,))
+        return [item_id for item_id, in rows]
+
+    def remove_pending_ids(self, table_name: str, ids: Iterable[str]) -> None:
+        with self.conn:
+            self.ensure_pending_table()
+            self.conn.executemany(f"DELETE FROM {PENDING_TABLE} WHERE table_name = ? AND item_id = ?",
+                                  ((table_name, item_id) for item_id in ids))
+
+    def present_ids(self, table_name: str) -> set:
+        """
+        The ids of the files of the table which are in its last batch
+        """
+        self.ensure_table(table_name)
+        rows = self.conn.execute(f"SELECT item_id FROM {PRESENCE_TABLE} "
+                                 f"WHERE table_name = ? AND missed_runs = 0 AND item_id IS NOT NULL", (table_name,))
+        return {item_id for item_id, in rows}
+
+    def write(self, write: Callable[[], None], with_batch: Optional[str] = None) -> None:
+        """
+        Run the write (statements on self.conn, without a commit) in a transaction, or, if with_batch is given, in the
+        transaction recording the next batch of the change table with_batch (see record_batch)
+        """
+        if with_batch is not None:
+            self.deferred.setdefault(with_batch, []).append(write)
+            return
+        with self.conn:
+            write()
+
+    def absent(self, table_name: str, threshold: int) -> List[Tuple[str, Optional[str], str, int]]:
+        """
+        The files of the table which were absent in more than threshold batches since they were last seen
+
+        return (list): (file_name, id, last_seen, missed_runs) of every absent file, the id is None if it is not known
+        """
+        self.ensure_table(table_name)
+        return self.conn.execute(f"SELECT file_name, item_id, last_seen, missed_runs FROM {PRESENCE_TABLE} "
+                                 f"WHERE table_name = ? AND missed_runs > ? ORDER BY file_name",
+                                 (table_name, threshold)).fetchall()
+
+    def forget_absent(self, table_name: str, threshold: int) -> int:
+        """
+        Remove the presence of the files which were absent in more than threshold batches, once they are listed (see
+        absent); a file which comes back later is recorded as a new one
+
+        return (int): the number of removed files
+        """
+        self.ensure_table(table_name)
+        with self.conn:
+            cursor = self.conn.execute(f"DELETE FROM {PRESENCE_TABLE} WHERE table_name = ? AND missed_runs > ?",
+                                       (table_name, threshold))
+        return cursor.rowcount
+
+    def files_with_id(self, table_name: str) -> set:
+        """
+        The files of the table whose id is known, see record_batch
+        """
+        self.ensure_table(table_name)
+        rows = self.conn.execute(f"SELECT file_name FROM {PRESENCE_TABLE} WHERE table_name = ? AND item_id IS NOT NULL",
+                                 (table_name,))
+        return {file_name for file_name, in rows}
+
+    def compact(self, table_name: str, keep_batches: int = HISTORY_BATCHES) -> int:
+        """
+        Remove the batches of the change table before the last keep_batches batches. The presence of the files of
+        the removed batches is kept in the presence table.
+
+        return (int): the number of removed rows
+        """
+        self.ensure_table(table_name)
+        with self.conn:
+            cursor = self.conn.execute(f"DELETE FROM {table_name} WHERE timestamp < "
+                                       f"(SELECT timestamp FROM (SELECT DISTINCT timestamp FROM {table_name}) "
+                                       f"ORDER BY timestamp DESC LIMIT 1 OFFSET ?)", (max(keep_batches, 1) - 1,))
+        logger.info(f"Removed {cursor.rowcount} rows of the batches before the last {keep_batches} from {table_name}")
+        return cursor.rowcount
+
+    def vacuum_if_due(self, days: int = VACUUM_DAYS, now: Optional[datetime] = None) -> bool:
+        """
+        VACUUM the database if it was not vacuumed in the last days, e.g. to return the space of the compacted rows
+
+        return (bool): True if the database was vacuumed
+        """
+        now = now or datetime.now()
+        with self.conn:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {MAINTENANCE_TABLE} (task text PRIMARY KEY, last_run text)")
+        row = self.conn.execute(f"SELECT last_run FROM {MAINTENANCE_TABLE} WHERE task = 'vacuum'").fetchone()
+        if row is not None and now - datetime.strptime(row[0], "%Y%m%d%H%M%S") < timedelta(days=days):
+            return False
+        self.conn.execute("VACUUM")
+        with self.conn:
+            self.conn.execute(f"INSERT OR REPLACE INTO {MAINTENANCE_TABLE} (task, last_run) VALUES ('vacuum', ?)",
+                              (now.strftime("%Y%m%d%H%M%S"),))
+        logger.info(f"Vacuumed {self.db_file_name}")
+        return True
+
+    def load_validators(self) -> Dict[str, Tuple[Optional[str], Optional[str]]]:
+        """
+        The validators (ETag, Last-Modified) of the downloaded files
+        """
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {VALIDATORS_TABLE} "
+                          f"(file_name text PRIMARY KEY, etag text, last_modified text)")
+        rows = self.conn.execute(f"SELECT file_name, etag, last_modified FROM {VALIDATORS_TABLE}").fetchall()
+        return {file_name: (etag, last_modified) for file_name, etag, last_modified in rows
+                if etag is not None or last_modified is not None}
+
+    def save_validators(self, validators: Dict[str, Tuple[Optional[str], Optional[str]]],
+                        with_batch: Optional[str] = None) -> None:
+        """
+        with_batch (str): optional, the change table of the downloaded files, the validators are then saved with its
+            next batch (see write)
+        """
+        def write():
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {VALIDATORS_TABLE} "
+                              f"(file_name text PRIMARY KEY, etag text, last_modified text)")
+            self.conn.executemany(f"INSERT OR REPLACE INTO {VALIDATORS_TABLE} (file_name, etag, last_modified) "
+                                  f"VALUES (?, ?, ?)",
+                                  [(file_name, etag, last_modified)
+                                   for file_name, (etag, last_modified) in validators.items()])
+        self.write(write, with_batch)
+
+    def get_harvest_state(self, query: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        The state of the harvest of the Solr query
+
+        return (tuple): the highest modification time of the harvested records and the timestamp of the last full
+            harvest, (None, None) if the query was never harvested
+        """
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {HARVEST_STATE_TABLE} "
+                          f"(query text PRIMARY KEY, high_water_mark text, full_harvest text)")
+        row = self.conn.execute(f"SELECT high_water_mark, full_harvest FROM {HARVEST_STATE_TABLE} WHERE query = ?",
+                                (query,)).fetchone()
+        return (row[0], row[1]) if row is not None else (None, None)
+
+    def save_harvest_state(self, query: str, high_water_mark: Optional[str], full_harvest: Optional[str],
+                           with_batch: Optional[str] = None) -> None:
+        """
+        with_batch (str): optional, the change table of the harvested files, the state is then saved with its next
+            batch (see write)
+        """
+        def write():
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {HARVEST_STATE_TABLE} "
+                              f"(query text PRIMARY KEY, high_water_mark text, full_harvest text)")
+            self.conn.execute(f"INSERT OR REPLACE INTO {HARVEST_STATE_TABLE} (query, high_water_mark, full_harvest) "
+                              f"VALUES (?, ?, ?)", (query, high_water_mark, full_harvest))
+        self.write(write, with_batch)
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+# the stores of this process by database file, see get_change_store
+change_stores: Dict[str, ChangeStore] = {}
+
+
+def get_change_store(db_file_name: str = DB_FILE) -> ChangeStore:
+    """
+    Get the store of the database file, it is opened on first use and kept open until close_change_stores.
+    The same file is always the same store, also when it is named differently (e.g. "./data/ineo.db" and
+    "data/ineo.db"), so the writes deferred to a batch (see ChangeStore.write) are run with it.
+    """
+    key = os.path.abspath(db_file_name)
+    store = change_stores.get(key)
+    if store is None:
+        store = change_stores[key] = ChangeStore(db_file_name)
+    return store
+
+
+def close_change_stores() -> None:
+    for store in change_stores.values():
+        store.close()
+    change_stores.clear()
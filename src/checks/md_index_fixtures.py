@@ -0,0 +1,120 @@
+import argparse
+import json
+import logging
+import os
+import sys
+
+# the modules of the harvester are in the parent folder, this check is not part of it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import get_logger, get_basex_client
+from md_index import MetadataIndex
+from template_compiler import get_id_key, fallback_query
+
+logger = get_logger("template.log", __name__, level=logging.WARNING)
+
+"""
+An offline check of the in-process lookups of md_index.MetadataIndex, without BaseX.
+
+The fixtures folder has a folder of records per template type and expected.json, with per template type the
+"lookups" ({id, field, basex}), the responses of the fallback queries, and the "deferred" lookups ({id, field}) the
+index must leave to BaseX. A lookup must give the expected response exactly, byte for byte.
+
+The "source" in expected.json tells where the responses come from: written by hand following the xml-to-json
+serialization, until they are recorded on a live BaseX with --record. Only recorded responses check the parity with
+BaseX; the hand-written ones check the index against the serialization it is meant to follow.
+
+    python checks/md_index_fixtures.py [--record]
+"""
+
+# the records per template type and the expected responses of the fallback queries
+FIXTURES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "md_index")
+
+
+def load_fixtures(fixtures_folder: str = FIXTURES_FOLDER) -> dict:
+    with open(os.path.join(fixtures_folder, "expected.json"), "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def check_fixtures(fixtures_folder: str = FIXTURES_FOLDER) -> list[dict]:
+    """
+    Compare the in-process lookups with the expected responses of the fixtures
+
+    return (list[dict]): the differences, empty if the index gives the expected responses
+    """
+    differences = []
+    for template_type, cases in load_fixtures(fixtures_folder)["cases"].items():
+        index = MetadataIndex(os.path.join(fixtures_folder, template_type), get_id_key(template_type)).load()
+        for case in cases["lookups"]:
+            local = index.lookup(case["id"], case["field"])
+            if local != case["basex"]:
+                differences.append({**case, "template_type": template_type, "index": local})
+        for case in cases["deferred"]:
+            local = index.lookup(case["id"], case["field"])
+            if local is not None:
+                differences.append({**case, "template_type": template_type, "index": local, "basex": None})
+    return differences
+
+
+def record_fixtures(fixtures_folder: str = FIXTURES_FOLDER) -> None:
+    """
+    Record the responses of the fallback queries of the fixtures on BaseX, in a temporary database per template type
+    created from the records of the fixtures, parsed as db:create parses the harvested files (see
+    main.prepare_basex_tables).
+    """
+    client = get_basex_client()
+    fixtures = load_fixtures(fixtures_folder)
+    for template_type, cases in fixtures["cases"].items():
+        folder = os.path.join(fixtures_folder, template_type)
+        records = []
+        for root, _, file_names in os.walk(folder):
+            for file_name in sorted(file_names):
+                if file_name.endswith(".json"):
+                    with open(os.path.join(root, file_name), "r", encoding="utf-8") as file:
+                        records.append([os.path.relpath(os.path.join(root, file_name), folder), file.read()])
+        dbname = f"md_index_fixtures_{template_type}"
+        response = client.query("""
+            declare variable $DB external;
+            declare variable $RECORDS external;
+            let $records := parse-json($RECORDS)?*
+            return db:create($DB,
+                             for $record in $records
+                             return json:parse($record?2, map { "format": "basic", "liberal": true() }),
+                             for $record in $records return $record?1,
+                             map { "textindex": true() })
+            """, None, {"DB": dbname, "RECORDS": json.dumps(records)})
+        if response.status_code != 200:
+            raise Exception(f"HttpError {response.status_code} creating {dbname}: {response.text}")
+        try:
+            for case in cases["lookups"]:
+                response = client.query(fallback_query(case["field"], template_type), dbname,
+                                        {"DB": dbname, "ID": case["id"]})
+                if response.status_code != 200:
+                    raise Exception(f"HttpError {response.status_code} querying {dbname}: {response.text}")
+                case["basex"] = response.text
+        finally:
+            client.query("declare variable $DB external; db:drop($DB)", None, {"DB": dbname})
+
+    fixtures["source"] = f"recorded on BaseX {client.url}"
+    with open(os.path.join(fixtures_folder, "expected.json"), "w", encoding="utf-8") as file:
+        json.dump(fixtures, file, indent=2, ensure_ascii=False)
+        file.write("\n")
+    logger.info(f"Recorded the BaseX responses of {fixtures_folder}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the in-process lookups against the fixtures, offline")
+    parser.add_argument("--record", action="store_true", help="record the responses of the fixtures on BaseX first")
+    args = parser.parse_args()
+
+    if args.record:
+        record_fixtures()
+    print(f"Expected responses: {load_fixtures()['source']}")
+    differences = check_fixtures()
+    for difference in differences:
+        print(json.dumps(difference))
+    exit(1 if differences else 0)
+
+
+if __name__ == "__main__":
+    main()
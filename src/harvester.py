@@ -1,20 +1,22 @@
+import codecs
 import concurrent.futures
 import os
 import re
 import requests
 import hashlib
-import sqlite3
 import jsonlines
 import json
-import shutil
 import subprocess
 import yaml
 import dotenv
 import logging
-from typing import List, Optional, AnyStr, Union, Dict, Tuple
-from bs4 import BeautifulSoup
-from datetime import datetime
-from utils import get_logger, get_files, remove_html_tags, shorten_list_or_string, get_id_from_file_name
+from typing import List, Optional, AnyStr, Dict, Tuple, Iterator
+from html.parser import HTMLParser
+from datetime import datetime, timedelta
+from change_store import get_change_store, close_change_stores
+from snapshot_store import get_snapshot_store
+from utils import (get_logger, get_files, remove_html_tags, shorten_list_or_string, get_id_from_file_name, normalize_ruc,
+                   make_http_session)
 
 log_file_path = 'harvester.log'
 logger = get_logger(log_file_path, __name__, level=logging.ERROR)
@@ -45,6 +47,37 @@ more_characters: str = "..."
 # ID length limit
 id_limit: int = 128
 
+# number of codemeta files downloaded at the same time, see download_json_files
+DOWNLOAD_CONCURRENCY = 16
+# (connect, read) timeout in seconds of a single download
+DOWNLOAD_TIMEOUT = (10, 60)
+# transient errors of the server which are retried
+DOWNLOAD_RETRY_STATUS = (429, 500, 502, 503, 504)
+# the largest fraction of the local codemeta files that may be unlisted in the index for them to be removed, more is
+# taken for a truncated or partial index, see remove_unlisted_files
+UNLISTED_LIMIT = 0.1
+# the key of the ids of the tools and datasets to be deleted from INEO in the pending ids of the change store, they
+# are kept until the deletion is confirmed by the sync, see write_deleted_ids and confirm_deleted_ids
+PENDING_DELETIONS = "ineo_deletions"
+# the fields ignored in the hash of a harvested file (see get_canonical), as paths of keys per source (the suffix of
+# the file name); e.g. the review of a codemeta file gets a new @id and datePublished on every review of the tool
+CANON_PURGE_RULES = {
+    "codemeta.json": (("review", "@id"), ("review", "datePublished")),
+}
+# number of Solr records per page, see fetch_solr_records
+SOLR_ROWS = 1000
+# the unique key of the Solr records, paging with a cursor requires sorting on it
+SOLR_UNIQUE_KEY = "id"
+# the field of the Solr records with the time the record was last modified (indexed)
+SOLR_MODIFIED_FIELD = "timestamp"
+# number of days after which the datasets are harvested in full again, to find the records deleted from Solr
+SOLR_RECONCILE_DAYS = 7
+# the Github repository with the Rich User Content (RUC) and its local clone; a local (bare) repository works as well
+RUC_GITHUB_URL = "https://github.com/CLARIAH/ineo-content.git"
+RUC_GITHUB_DIR = "./ineo-content"
+# the folder of the RUC markdown files in the repository
+RUC_FOLDER = "src/tools"
+
 
 def create_folder(folder_name: str):
     """
@@ -116,112 +149,236 @@ def extract_ruc(ruc_content: AnyStr) -> dict:
     return dictionary
 
 
-def get_db_cursor(db_file_name=os.path.join(output_path_data, "ineo.db"), table_name="tools_metadata"):
+def get_purge_rules(file_name: str) -> tuple:
     """
-    Get a cursor to the database SQLite3 file which is used to track the changes in the harvested files.
+    The purge rules of the source of the file, see CANON_PURGE_RULES
     """
-    # init db and check if the table exists
-    conn = init_check_db(db_file_name, table_name)
-    if conn is None:
-        logger.error("Error in creating the database connection!")
-        exit(1)
-    # create a cursor
-    c = conn.cursor()
-    return c, conn
+    for suffix, purge_rules in CANON_PURGE_RULES.items():
+        if file_name.endswith(suffix):
+            return purge_rules
+    return ()
 
 
-def get_canonical(file_name):
+def purge_field(data, path: tuple):
     """
-    Create a canonical version of the json file. 
-    For ignoring fields that do not contain necessary changes for the MD5 to change.
+    A copy of the json data without the field at the path (a tuple of keys), the data itself is not changed
     """
-    logger.debug(f"making canon file for {file_name}")
-    print(f"making canon file for {file_name}")
-    canon_file = f"{file_name}.canon"
-    with open(file_name, 'r') as json_file:
-        data = json.load(json_file)
-        if 'review' in data:
-            data['review']['@id'] = '__canon_purge__'
-            data['review']['datePublished'] = '__canon_purge__'
-        else:
-            logger.debug("no review!")
-    with open(canon_file, 'w') as json_file:
-        json.dump(data, json_file, indent=2)
-    return canon_file
+    if not isinstance(data, dict) or path[0] not in data:
+        return data
+    data = dict(data)
+    if len(path) == 1:
+        del data[path[0]]
+    else:
+        data[path[0]] = purge_field(data[path[0]], path[1:])
+    return data
+
+
+def get_canonical(data, purge_rules: tuple = ()) -> bytes:
+    """
+    Create a canonical serialization of the json data, with sorted keys and without whitespace.
+    For ignoring fields that do not contain necessary changes for the MD5 to change (purge_rules).
+    """
+    for path in purge_rules:
+        data = purge_field(data, path)
+    return json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def canonical_md5(data, purge_rules: tuple = ()) -> str:
+    return hashlib.md5(get_canonical(data, purge_rules)).hexdigest()
 
 
 def get_md5(file_name):
     """
-    Getting MD5 of each individual json file
+    Getting MD5 of the canonical form of each individual json file, see get_canonical
     """
-    md5_file = file_name
-    if file_name.endswith('codemeta.json'):
-        md5_file = get_canonical(file_name)
-    hasher = hashlib.md5()
-    with open(md5_file, 'rb') as file:
-        for chunk in iter(lambda: file.read(4096), b""):
-            hasher.update(chunk)
-    return hasher.hexdigest()
+    with open(file_name, 'rb') as file:
+        content = file.read()
+    try:
+        data = json.loads(content)
+    except json.JSONDecodeError:
+        logger.warning(f"{file_name} is not valid json, hashing it as is")
+        return hashlib.md5(content).hexdigest()
+    return canonical_md5(data, get_purge_rules(file_name))
+
+
+def remove_canon_files(folder_name: str) -> None:
+    """
+    Remove the <file>.canon files the hashing used to write next to the harvested files
+    """
+    for file_name in get_files(folder_name, "canon") or []:
+        os.remove(file_name)
+
+
+class LinkExtractor(HTMLParser):
+    """
+    Collect the href of the <a> elements with the given suffix while the html is fed, without building a tree.
+    """
+
+    def __init__(self, suffix: str = ""):
+        super().__init__()
+        self.suffix = suffix
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            href = dict(attrs).get("href")
+            if href is not None and href.endswith(self.suffix):
+                self.links.append(href)
+
+
+def list_links(session: requests.Session, url: str, suffix: str) -> List[str]:
+    """
+    The links with the suffix in the html index at the url, the index is parsed while it is downloaded.
+    """
+    extractor = LinkExtractor(suffix)
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=65536):
+            extractor.feed(decoder.decode(chunk))
+    extractor.feed(decoder.decode(b"", final=True))
+    extractor.close()
+    return extractor.links
+
+
+def fetch_file(session: requests.Session, file_url: str,
+               validators: Optional[Tuple[Optional[str], Optional[str]]] = None) -> Tuple[Optional[bytes], Optional[str], Optional[str]]:
+    """
+    Download a file, conditionally if the validators (ETag, Last-Modified) of the local copy are given.
+
+    return (tuple): the content, None if the local copy is not modified (304), and the validators of the response
+    """
+    logger.debug(f"Downloading {file_url}")
+    etag, last_modified = validators or (None, None)
+    headers = {}
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    if last_modified is not None:
+        headers["If-Modified-Since"] = last_modified
+    response = session.get(file_url, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+    if response.status_code == 304:
+        logger.debug(f"Not modified {file_url}")
+        return None, response.headers.get("ETag", etag), response.headers.get("Last-Modified", last_modified)
+    response.raise_for_status()
+    return response.content, response.headers.get("ETag"), response.headers.get("Last-Modified")
+
+
+def write_codemeta_file(content: bytes, file_name: str) -> str:
+    """
+    Shorten the name and description of a downloaded codemeta file and write it, runs in a worker process.
+
+    return (str): the MD5 of the written file, see get_md5
+    """
+    # loads binary response content as string and dump it to json file
+    content_json = json.loads(content.decode('utf-8'))
+    # shorten name and description
+    content_json["name"] = shorten_list_or_string(content_json.get("name", ""), title_limit, more_characters)
+    content_json["description"] = shorten_list_or_string(content_json.get("description", ""), description_limit, more_characters)
+    with open(file_name, 'w') as file:
+        json.dump(content_json, file, indent=2)
+    return canonical_md5(content_json, get_purge_rules(file_name))
+
+
+def remove_unlisted_files(save_directory: str, files_list: List[str], unlisted_limit: float = UNLISTED_LIMIT) -> None:
+    """
+    Remove the codemeta files which are no longer listed in the index, so they are absent from the next batch (see
+    get_absent_ids); the snapshot of backup_json_files still has them. Nothing is removed if the index is empty, or
+    if more than the fraction unlisted_limit of the local files is not listed (e.g. a truncated index page); the files
+    are then kept, and only removed by a run with a complete listing.
+    """
+    if not files_list:
+        logger.error(f"No codemeta files listed, keeping the files in {save_directory}")
+        return
+    listed = set(files_list)
+    local_files = [file_name for file_name in get_files(save_directory) or [] if file_name.endswith('.codemeta.json')]
+    unlisted = [file_name for file_name in local_files if file_name not in listed]
+    if len(unlisted) > unlisted_limit * len(local_files):
+        logger.error(f"{len(unlisted)} of the {len(local_files)} codemeta files in {save_directory} are not listed, "
+                     f"more than {unlisted_limit:.0%}; keeping them, the index may be incomplete: "
+                     f"{', '.join(os.path.basename(file_name) for file_name in unlisted)}")
+        return
+    for file_name in unlisted:
+        logger.info(f"Removing {file_name}, it is no longer listed")
+        os.remove(file_name)
 
 
 def download_json_files(
         url: str = "https://tools.clariah.nl/files/",
-        save_directory: str = os.path.join(output_path_data, "tools_metadata")) -> List[str]:
+        save_directory: str = os.path.join(output_path_data, "tools_metadata"),
+        not_modified: Optional[set] = None,
+        db_file_name: str = os.path.join(output_path_data, "ineo.db"),
+        hashes: Optional[Dict[str, str]] = None,
+        table_name: str = "tools_metadata") -> List[str]:
     """
-    Download and count all individual json files using beautifulsoup to harvest contents from the given URL. 
-
+    Download and count all individual json files listed in the index at the given URL.
+
+    The files are downloaded by DOWNLOAD_CONCURRENCY threads sharing a session with keep-alive connections, which
+    retries on connection errors and transient errors. A downloaded file is shortened and written by a pool of
+    processes, while the other files are being downloaded.
+    The ETag and Last-Modified of every file are stored in the database (change_store.VALIDATORS_TABLE) and sent with the next
+    download of the file (If-None-Match, If-Modified-Since). The local copy of a file that is not modified is kept.
+    The validators are saved with the next batch of table_name (see get_changed_ids), so the files of a run that fails
+    before are downloaded again.
+
+    not_modified (set): optional, the (normalized) paths of the files that were not modified are added to it, so
+        get_changed_ids can reuse their hashes
+    hashes (dict): optional, the MD5 of every written file is added to it by (normalized) path, so get_changed_ids
+        does not need to read the files again
     """
     # first backup previous JSON files
-    backup_directory = os.path.join(output_path_data, "tools_metadata_backup")
-    backup_json_files(save_directory, backup_directory)
-
-    files_list = []
+    backup_json_files(save_directory)
 
     if not os.path.exists(save_directory):
         os.makedirs(save_directory)
 
-    response = requests.get(url)
-    soup = BeautifulSoup(response.content, 'html.parser')
-    links = soup.find_all('a')
-
-    count = 0
-
-    for link in links:
-        href = link.get('href')
-        if href.endswith('.codemeta.json'):
-            file_url = url + href
-            logger.debug(f"Downloading {file_url}")
-            response = requests.get(file_url)
-            file_name = os.path.join(save_directory, href)
-            files_list.append(file_name)
-            # loads binary response content as string and dump it to json file
-            with open(file_name, 'w') as file:
-                content = response.content.decode('utf-8')
-                content_json = json.loads(content)
-                # shorten name and description
-                content_json["name"] = shorten_list_or_string(content_json.get("name", ""), title_limit, more_characters)
-                content_json["description"] = shorten_list_or_string(content_json.get("description", ""), description_limit, more_characters)
-                json.dump(content_json, file, indent=2)
-            count += 1
-
-    logger.info(f"Downloaded all the tools metadata! Total JSON files: {count}")
+    store = get_change_store(db_file_name)
+    validators = store.load_validators()
+    new_validators = {}
+    not_modified_count = 0
+    session = make_http_session(DOWNLOAD_CONCURRENCY, 3, DOWNLOAD_RETRY_STATUS)
+    with session, concurrent.futures.ProcessPoolExecutor() as writers:
+        hrefs = list_links(session, url, '.codemeta.json')
+        files_list = [os.path.join(save_directory, href) for href in hrefs]
+        remove_unlisted_files(save_directory, files_list)
+
+        # the workers are started before the download threads, forking a process with running threads is unsafe
+        writers.submit(os.getpid).result()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY) as downloads:
+            # a conditional request only if there still is a local copy to keep
+            fetches = {downloads.submit(fetch_file, session, url + href,
+                                        validators.get(file_name) if os.path.exists(file_name) else None): file_name
+                       for href, file_name in zip(hrefs, files_list)}
+            writes = []
+            for future in concurrent.futures.as_completed(fetches):
+                file_name = fetches[future]
+                content, etag, last_modified = future.result()
+                new_validators[file_name] = (etag, last_modified)
+                if content is None:
+                    not_modified_count += 1
+                    if not_modified is not None:
+                        not_modified.add(os.path.normpath(file_name))
+                else:
+                    writes.append((file_name, writers.submit(write_codemeta_file, content, file_name)))
+        for file_name, future in writes:
+            md5 = future.result()
+            if hashes is not None:
+                hashes[os.path.normpath(file_name)] = md5
+
+    # only stored once the hashes of the files are recorded, a file whose change was not recorded is downloaded again
+    store.save_validators(new_validators, with_batch=table_name)
+    logger.info(f"Downloaded all the tools metadata! Total JSON files: {len(files_list)}, "
+                f"not modified: {not_modified_count}")
     return files_list
 
 
-def backup_json_files(source_directory: str, backup_directory: str) -> None:
+def backup_json_files(source_directory: str, snapshot_name: str = "tools_metadata") -> None:
     """
-    Make a backup copy of the previously downloaded JSON files.
+    Make a snapshot of the previously downloaded JSON files, only the changed files are stored (see snapshot_store).
     """
     if not os.path.exists(source_directory):
         os.makedirs(source_directory)
 
-    if not os.path.exists(backup_directory):
-        os.makedirs(backup_directory)
-
-    for file_name in os.listdir(source_directory):
-        source_file = os.path.join(source_directory, file_name)
-        backup_file = os.path.join(backup_directory, file_name)
-        shutil.copyfile(source_file, backup_file)
+    get_snapshot_store().snapshot(snapshot_name, [source_directory])
 
     logger.info("Backup of previous JSON files created.")
 
@@ -280,29 +437,6 @@ def compare_lists(list1: Optional[List[str]], list2: Optional[List[str]]) -> Lis
     return diff + diff2
 
 
-def create_db_table(conn: sqlite3.Connection, table_name: str) -> None:
-    """
-    Create a table in the database
-    """
-    c = conn.cursor()
-    if table_name == "rich_user_contents":
-        c.execute(f"CREATE TABLE {table_name} (file_name text, md5 text, timestamp text DEFAULT CURRENT_TIMESTAMP)")
-    else:
-        c.execute(f"CREATE TABLE {table_name} (file_name text, md5 text, timestamp text DEFAULT CURRENT_TIMESTAMP)")
-    conn.commit()
-
-
-def db_table_exists(conn: sqlite3.Connection, table_name: str) -> bool:
-    """
-    check if the table exists in the data
-    """
-    c = conn.cursor()
-    c.execute(f"SELECT count(name) FROM sqlite_master WHERE type='table' AND name='{table_name}'")
-    if c.fetchone()[0] == 1:
-        return True
-    return False
-
-
 def get_id_from_ruc_file_name(file_name: str) -> str:
     full_file_name = file_name.split("/")[-1]
     id_part = full_file_name.split(".")[0]
@@ -319,9 +453,9 @@ def get_id_from_field(file_name: str) -> str:
 
 
 def process_list(ids: list, folder_name, db_file_name, table_name, diff_list, current_timestamp,
-                 previous_batch_dict=None):
+                 previous_batch_dict=None, unchanged: Optional[set] = None, hashes: Optional[Dict[str, str]] = None):
     """
-    This function tracks changes in json files, get a canon file form it, and records those changes in a JSON Lines file, and maintains a record of the changes in a database.
+    This function tracks changes in json files, hashes their canonical form, and records those changes in a JSON Lines file, and maintains a record of the changes in a database.
     The function compares MD5 hashes between the current batch and the previous batch.
 
     diff_list: list of files to process
@@ -330,134 +464,162 @@ def process_list(ids: list, folder_name, db_file_name, table_name, diff_list, cu
 
     if previous batch dict is none, then it will always add the file to the jsonlines file
     if previous batch dict is not none, then it will compare the md5 of the current file with the md5 of the previous batch
+    unchanged: Optional set of the files that are known to be unchanged (not modified on the server), the md5 of the previous batch is reused for them
+    hashes: Optional dictionary of the md5 of the files computed while they were written, {file_name: md5}
     """
-    c, conn = get_db_cursor(db_file_name, table_name)
-
+    store = get_change_store(db_file_name)
+    # the files whose id is recorded, the id of an unchanged file is read if it is not, see get_absent_ids
+    files_with_id = store.files_with_id(table_name) if table_name not in store.untracked else None
+    rows = []
     for file in diff_list:
         file = os.path.normpath(os.path.join(folder_name, file))
         logger.info(f"### Processing {file}")
-        md5 = get_md5(file)
         previous_md5 = previous_batch_dict.get(file, None) if previous_batch_dict is not None else None
+        if hashes is not None and file in hashes:
+            md5 = hashes[file]
+        elif unchanged is not None and file in unchanged and previous_md5 is not None:
+            md5 = previous_md5
+        else:
+            md5 = get_md5(file)
 
+        item_id = None
         if md5 != previous_md5:
             if previous_md5 is not None:
                 logger.debug(f"File {file} has changed! Old hash was: {previous_md5}")
-            ids.append(get_id_from_field(file))
+            item_id = get_id_from_field(file)
+            ids.append(item_id)
             logger.debug(f"### Adding {ids[-1]}")
         else:
             logger.debug(f"File {file} has not changed.")
-        c.execute(f"INSERT INTO {table_name} (file_name, md5, timestamp) VALUES (?, ?, ?)",
-                  (file, md5, current_timestamp))
-        conn.commit()
-
-
-def init_check_db(db_file_name: str, table_name: str) -> Optional[sqlite3.Connection]:
-    """
-    check if the database exists, if not create one
-    Creates tables in the database.
-    """
-    conn = sqlite3.connect(db_file_name)
-
-    # check if table exists
-    if not db_table_exists(conn, table_name):
-        logger.info(f"Table {table_name} does not exist, creating!")
-        create_db_table(conn, table_name)
-
-    return conn
+            if files_with_id is not None and file not in files_with_id:
+                # e.g. the presence derived from the batches before the presence table
+                item_id = get_id_from_field(file)
+        rows.append((file, md5, item_id))
+    store.record_batch(table_name, rows, current_timestamp)
 
 
 def get_previous_batch(db_file_name, table_name, previous_timestamp) -> List[str]:
-    c, conn = get_db_cursor(db_file_name, table_name)
-    c.execute(f"SELECT file_name FROM {table_name} WHERE timestamp = ?", (previous_timestamp,))
-    previous_batch = c.fetchall()
-    # process list of tuples to list of strings
-    previous_batch = [x[0] for x in previous_batch]
+    return list(get_change_store(db_file_name).get_batch(table_name, previous_timestamp))
 
-    return previous_batch
 
+def git(github_dir: str, *args: str) -> str:
+    """
+    Run a git command in the repository, without changing the working directory
 
-def sync_ruc(github_url, github_dir):
+    return (str): the output of the command, subprocess.CalledProcessError is raised if it fails
     """
-    Retrieves Rich User Content of Gihub repository "ineo-content".
+    result = subprocess.run(["git", "-C", github_dir, *args], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            text=True, check=True)
+    return result.stdout
+
+
+def sync_ruc(github_url: str, github_dir: str) -> str:
     """
-    # store the current working directory
-    current_dir = os.getcwd()
+    Retrieves Rich User Content of Gihub repository "ineo-content". Local changes of the clone are discarded.
 
+    return (str): the commit of the checkout (HEAD)
+    """
     # Check if the ineo-content github repository directory exists
     if not os.path.exists(github_dir):
         logger.info(f"The github directory '{github_dir}' does not exist. Cloning...")
-        # Clone the repository
-        subprocess.run(["git", "clone", github_url])
+        subprocess.run(["git", "clone", "--quiet", github_url, github_dir], check=True)
     else:
-        logger.info(f"The github directory '{github_dir}' already exists. Pulling...")
+        logger.info(f"The github directory '{github_dir}' already exists. Fetching...")
+        try:
+            git(github_dir, "fetch", "--quiet", "origin")
+            git(github_dir, "reset", "--hard", "--quiet", "@{upstream}")
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Could not update {github_dir}, using the current checkout: {e.stderr}")
+    return git(github_dir, "rev-parse", "HEAD").strip()
 
-        # cd ineo-content
-        os.chdir(github_dir)
 
-        # Run git pull and capture the output
-        result = subprocess.run(["git", "stash"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        result = subprocess.run(["git", "stash", "clear"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        result = subprocess.run(["git", "pull"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+def get_ruc_changes(github_dir: str, last_commit: Optional[str], commit: str) -> Optional[Tuple[List[str], List[str]]]:
+    """
+    The RUC files changed between the last processed commit and the commit, from git diff --name-status. A renamed
+    file is a deleted and an added file.
 
-        # Check if the "Already up to date" message is in the output
-        if "Already up to date." in result.stdout:
-            logger.info("Repository is already up to date. The RUC have not changed")
+    return (tuple): the file names in RUC_FOLDER which were added or changed, and those which were deleted; None if
+        there is no last commit or it is not in the repository (e.g. after a force push), all files are then read
+    """
+    if last_commit is None:
+        return None
+    try:
+        git(github_dir, "cat-file", "-e", f"{last_commit}^{{commit}}")
+    except subprocess.CalledProcessError:
+        logger.warning(f"The last processed commit {last_commit} is not in {github_dir}")
+        return None
+
+    output = git(github_dir, "diff", "--name-status", "--no-renames", "-z", last_commit, commit, "--", RUC_FOLDER)
+    fields = output.split("\0")
+    changed, deleted = [], []
+    for status, path in zip(fields[0::2], fields[1::2]):
+        # only the files in the folder itself are RUC, see get_ruc_contents
+        if os.path.dirname(path) != RUC_FOLDER:
+            continue
+        if status == "D":
+            deleted.append(os.path.basename(path))
         else:
-            logger.info("Repository is not up to date.")
+            changed.append(os.path.basename(path))
+    return changed, deleted
+
 
-        # Change back to the previous working directory
-        os.chdir(current_dir)
+def get_ruc_key(filename: str, ruc_data: dict) -> str:
+    """
+    The key of the RUC in the RUC dictionary, the file name or the identifier if the file name is not identical to it
+    """
+    identifier = ruc_data.get('identifier', '').lower()  # Get the lowercase identifier from the RUC dictionary
+    filename_ruc = os.path.splitext(filename)[0].lower()
+    if filename_ruc != identifier:
+        logger.debug(f"Filename '{filename_ruc}' is not identical to the identifier '{identifier}'")
+        logger.debug("Replacing the filename with the identifier...")
+        return identifier
+    return filename
 
 
-def get_ruc_contents() -> dict:
+def get_ruc_contents(folder_path: str, filenames: List[str]) -> dict:
     """
-    This script synchronizes with the GitHub repository of ineo-content, extracts Rich User Content (RUC)
-    and returns the RUC data in a dictionary.
+    Extracts the Rich User Content (RUC) of the files in the folder of the ineo-content repository and returns the RUC
+    data in a dictionary, by file name or by identifier if the file name is not identical to it (see get_ruc_key).
 
     The 'extract_ruc' function is used to parse the RUC data from a given content string using regex.
     It extracts metadata fields, descriptions, and sections, returning them as a dictionary.
     """
-    github_url = "https://github.com/CLARIAH/ineo-content.git"
-    github_dir = "./ineo-content"
-    sync_ruc(github_url, github_dir)
-
-    folder_path = "./ineo-content/src/tools"
     all_ruc_contents = {}
-
-    for filename in os.listdir(folder_path):
+    for filename in filenames:
         file_path = os.path.join(folder_path, filename)
         with open(file_path, 'r') as file:
             contents: AnyStr = file.read()
             ruc_contents: dict = extract_ruc(contents)
             logger.debug(f"Rich User Contents of {file_path} is:\n{ruc_contents}\n")
-            all_ruc_contents[filename] = ruc_contents
-
-    # Check if the RUC filename is identical to the identifier and replace if not
-    modified_contents = {}
-    for filename, ruc_data in all_ruc_contents.items():
-        identifier = ruc_data.get('identifier', '').lower()  # Get the lowercase identifier from the RUC dictionary
-        filename_ruc = os.path.splitext(filename)[0].lower()
-        if filename_ruc != identifier:
-            logger.debug(f"Filename '{filename_ruc}' is not identical to the identifier '{identifier}'")
-            logger.debug("Replacing the filename with the identifier...")
-            modified_contents[identifier] = ruc_data
-        else:
-            modified_contents[filename] = ruc_data
+            all_ruc_contents[get_ruc_key(filename, ruc_contents)] = ruc_contents
+    return all_ruc_contents
 
-    all_ruc_contents = modified_contents
 
-    return all_ruc_contents
+def get_deleted_ruc(github_dir: str, last_commit: str, filenames: List[str]) -> Dict[str, str]:
+    """
+    The keys and identifiers of the RUC files deleted since the last commit, read from the last commit
+
+    return (dict): {key: identifier}, the key as in get_ruc_contents
+    """
+    deleted = {}
+    for filename in filenames:
+        ruc_contents = extract_ruc(git(github_dir, "show", f"{last_commit}:{RUC_FOLDER}/{filename}"))
+        deleted[get_ruc_key(filename, ruc_contents)] = ruc_contents.get('identifier', os.path.splitext(filename)[0])
+    return deleted
 
 
-def serialize_ruc_to_json(ruc_contents_dict, output_dir="./data") -> Union[dict, list]:
+def serialize_ruc_to_json(ruc_contents_dict, output_dir="./data") -> List[str]:
     """
     Serialize the RUC dictionary into JSON files.
 
     Args:
         ruc_contents_dict (dict): A dictionary containing RUC data
         output_dir (str): The directory where the RUC JSON files will be saved. Defaults to "./data".
+    Returns:
+        list: the (normalized) paths of the written JSON files
     """
     ruc_subfolder = "rich_user_contents"
+    written = []
     for filename, ruc_contents in ruc_contents_dict.items():
         subfolder_path = os.path.join(output_dir, ruc_subfolder)
         os.makedirs(subfolder_path, exist_ok=True)
@@ -475,77 +637,53 @@ def serialize_ruc_to_json(ruc_contents_dict, output_dir="./data") -> Union[dict,
                 _ = ruc_contents.pop(org_title)
 
         with open(json_file_path, "w") as json_file:
-            json.dump(ruc_contents, json_file)
-
+            # the keys lowercased, as template.load_ruc looks them up
+            json.dump(normalize_ruc(ruc_contents), json_file)
+        written.append(os.path.normpath(json_file_path))
+    return written
 
-# Initialize a dictionary to store the absence count for each file_name
-absence_count = {}
 
-
-def get_matching_timesamps(db_file_name, table_name, threshold):
+def get_absent_ids(db_file_name, table_name, threshold) -> List[str]:
     """
-    This function determines whether each file_name is present or absent based on the timestamp in the records. 
-    It Iterates through the distinct filenames and retrieves the most recent record for each file_name. It then 
-    checks if the timestamp matches the current date. If it does, the file_name is considered present in the latest download.
-    If the timestamp does not match the current date, it calculate the time elapsed in days since the last run of the file_name and
-    updates the absence count for the file_name in the absence_count dictionary.
-
-    Returns a list of records, where each record includes information about the file_name, whether it matches the current date, and the time elapsed (if not present).
+    The ids of the files which were absent in more than threshold harvests of the table, e.g. the tools which are no
+    longer listed. The id is the one recorded when the file was read (see process_list); a file whose id was never
+    recorded (it was already gone before the ids were recorded) is skipped, as its file name may not be its id.
+    The absent files are listed once, see ChangeStore.forget_absent.
     """
+    ids = []
+    for file_name, item_id, last_seen, missed_runs in get_change_store(db_file_name).absent(table_name, threshold):
+        logger.info(f"{file_name} has been absent for {missed_runs} runs, last seen in the batch of {last_seen}")
+        if item_id is None:
+            logger.warning(f"The id of the absent file {file_name} is not known, it is not deleted from INEO")
+            continue
+        ids.append(item_id)
+    return ids
 
-    c, conn = get_db_cursor(db_file_name, table_name)
-
-    # Get a list of distinct filenames
-    c.execute("SELECT DISTINCT file_name FROM tools_metadata")
-    distinct_filenames = [row[0] for row in c.fetchall()]
-
-    results = []
-    limit = threshold + 1
-
-    # Iterate through distinct filenames and retrieve the top 3 records for each
-    for file_name in distinct_filenames:
-        c.execute(f"SELECT * FROM tools_metadata WHERE file_name = ? ORDER BY timestamp DESC LIMIT {limit}",
-                  (file_name,))
-        records = c.fetchall()
-
-        if records:
-            current_date = datetime.now().strftime('%Y%m%d')
-
-            # Check if the date part of the latest timestamp matches the current date
-            for record in records:
-                record_list = list(record)
-                timestamp = record_list[2]  # the timestamp is in the third column of the table
-                matches_date = current_date == timestamp[:8]  # compare %Y%m%d
-                record_list.append(matches_date)
-
-                if not matches_date:
-                    # Calculate the time elapsed between the current date and the timestamp
-                    timestamp_date = datetime.strptime(timestamp, '%Y%m%d%H%M%S')
-                    current_date_date = datetime.strptime(current_date, '%Y%m%d')
-                    time_elapsed = current_date_date - timestamp_date
-                    record_list.append(time_elapsed)
 
-                    # Update the absence count for this file_name
-                    tool_name = record_list[0]
-                    absence_count[tool_name] = absence_count.get(tool_name, 0) + 1
-
-                results.append(record_list)
-
-    # Close the cursor and connection
-    c.close()
-    conn.close()
-
-    return results
+def write_deleted_ids(deleted_ids: List[str], delete_folder: str = delete_path) -> str:
+    """
+    Write the ids to be deleted from INEO to <delete_folder>/deleted_tool_ids.json, for the deletion in
+    ineo_sync.main (not enabled yet). harvest writes all the ids whose deletion is not confirmed yet (see
+    confirm_deleted_ids), so the file of a run that is not synced does not lose them; the file is also written
+    without ids.
+    """
+    if deleted_ids:
+        logger.debug(f"IDs of the tools to be deleted: {', '.join(deleted_ids)}")
+    os.makedirs(delete_folder, exist_ok=True)
+    file_path = os.path.join(delete_folder, 'deleted_tool_ids.json')
+    with open(file_path, 'w') as json_file:
+        json.dump(deleted_ids, json_file)
+        logger.debug(f"JSON containing tools to be deleted saved to {file_path}")
+    return file_path
 
 
-def process_records_timestamps(records):
-    for record in records:
-        if record[-2]:  # Check if the record matches the current date
-            logger.info(f"Record {record} matches the current date")
-        else:
-            time_elapsed = record[-1]
-            time_elapsed_in_days = time_elapsed.days
-            logger.info(f"Record {record} does not match the current date. Time elapsed (days): {time_elapsed_in_days}")
+def confirm_deleted_ids(deleted_ids: List[str], db_file_name: str = os.path.join(output_path_data, "ineo.db")) -> None:
+    """
+    The ids were deleted from INEO, they are no longer written to deleted_tool_ids.json
+    """
+    store = get_change_store(db_file_name)
+    store.remove_pending_ids(PENDING_DELETIONS, deleted_ids)
+    close_change_stores()
 
 
 def create_minimal_ruc(ruc_file, ruc_contents_dict):
@@ -566,57 +704,110 @@ def create_minimal_ruc(ruc_file, ruc_contents_dict):
         json.dump(ruc_template, json_file, indent=4)
 
 
-def _fetch_solr_records(query: str, solr_url: str, username, password, start=0, rows=10000) -> Dict:
+def _fetch_solr_page(session: requests.Session, query: str, solr_url: str, cursor_mark: str, rows: int,
+                     filter_query: Optional[str] = None) -> Dict:
     """
-    Retrieve Solr records in parallel with a given query.
+    Retrieve a page of Solr records with a given query (and filter query), starting at the cursor mark.
+
+    return (dict): the Solr response, with the docs in ["response"]["docs"] and the cursor mark of the next page in
+        ["nextCursorMark"]
     """
     params = {
         "q": query,
         "wt": "json",
-        "start": start,
         "rows": rows,
+        "sort": f"{SOLR_UNIQUE_KEY} asc",
+        "cursorMark": cursor_mark,
     }
-    response = requests.get(f"{solr_url}/select", params=params, auth=(username, password))
+    if filter_query is not None:
+        params["fq"] = filter_query
+    response = session.get(f"{solr_url}/select", params=params, timeout=DOWNLOAD_TIMEOUT)
     response.raise_for_status()  # Raise exception if the request failed
-    data = response.json()
-    return data["response"]
+    return response.json()
 
 
-def fetch_solr_records(query: str, solr_url: str, username: str, password: str, start=0, rows=10000) -> List[Dict]:
+def fetch_solr_records(query: str, solr_url: str, username: str, password: str, rows: int = SOLR_ROWS,
+                       filter_query: Optional[str] = None) -> Iterator[List[Dict]]:
     """
-    Retrieve Solr records in parallel with a given query.
-    """
-    # Retrieve the total number of records
-    response = _fetch_solr_records(query, solr_url, username, password, start=start, rows=0)
-    total_records = response["numFound"]
-    logger.info(f"Total records in Solr: {total_records}")
-
-    # Retrieve the records in parallel
-    records = []
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        for start in range(0, total_records, rows):
-            futures.append(
-                executor.submit(
-                    _fetch_solr_records, query, solr_url, username, password, start=start, rows=rows
-                )
-            )
-        for future in concurrent.futures.as_completed(futures):
-            records.extend(future.result()["docs"])
-    return records
+    Retrieve the Solr records with a given query, a page of (at most) rows records at a time.
 
-
-def store_solr_response(base_query: str, solr_url: str, username, password, parsed_datasets_directory: str):
+    The pages are retrieved with a cursor (cursorMark) instead of an offset, so a deep page costs Solr as much as the
+    first one. While a page is being processed by the caller, the next page is retrieved in the background, so at
+    most two pages are kept in memory.
+    """
+    session = make_http_session(1, 3, DOWNLOAD_RETRY_STATUS)
+    session.auth = (username, password)
+    with session, concurrent.futures.ThreadPoolExecutor(max_workers=1) as prefetcher:
+        cursor_mark = "*"
+        future = prefetcher.submit(_fetch_solr_page, session, query, solr_url, cursor_mark, rows, filter_query)
+        while future is not None:
+            data = future.result()
+            if cursor_mark == "*":
+                logger.info(f"Total records in Solr: {data['response']['numFound']}")
+            next_cursor_mark = data["nextCursorMark"]
+            # the cursor mark does not change after the last page
+            future = None
+            if next_cursor_mark != cursor_mark:
+                future = prefetcher.submit(_fetch_solr_page, session, query, solr_url, next_cursor_mark, rows,
+                                           filter_query)
+            cursor_mark = next_cursor_mark
+            docs = data["response"]["docs"]
+            del data
+            if docs:
+                yield docs
+
+
+def store_solr_doc(doc: Dict, parsed_datasets_directory: str) -> Tuple[str, str]:
     """
-    Store the list of records from fetch_solr_records into individual JSON files.
+    Save a Solr record as an individual JSON file, with the HTML tags removed from the description and the title,
+    description and id shortened.
+
+    return (tuple): the file name of the record and its MD5, see get_md5
     """
+    # remove HTML tags from the description field
+    temp_list = []
+    for elem in doc.get("description", []):
+        temp_list.append(remove_html_tags(elem))
+    doc["description"] = temp_list
+    # shorten title and description
+    doc["name"] = shorten_list_or_string(doc.get("name", ""), title_limit, more_characters)
+    doc["description"] = shorten_list_or_string(doc.get("description", ""), description_limit, more_characters)
+
+    # get the id of the dataset and shorten it to 128 characters if it is longer
+    current_id: str | None = doc.get("id", None)
+    if current_id is None:
+        raise Exception(f"Dataset {doc} does not have 'id'!")
+    if len(current_id) > id_limit:
+        current_id = current_id[:id_limit]
+
+    dataset_filename = os.path.join(parsed_datasets_directory, f"{current_id}.json")
+    logger.debug(f"Saving dataset to {dataset_filename}")
+    try:
+        with open(dataset_filename, 'w') as dataset_file:
+            json.dump(doc, dataset_file, indent=2)
+    except Exception as ex:
+        logger.error(f"Error saving dataset to {dataset_filename}: {ex}")
+        print(doc)
+        exit()
+    return dataset_filename, canonical_md5(doc, get_purge_rules(dataset_filename))
+
+
+def solr_date(value: str) -> datetime:
+    # e.g. "2024-05-01T12:00:00.123Z"
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def store_solr_response(base_query: str, solr_url: str, username, password, parsed_datasets_directory: str,
+                        filter_query: Optional[str] = None) -> Tuple[Dict[str, str], Optional[str]]:
     """
-    Saves individual datasets as separate JSON files
+    Saves the records from fetch_solr_records as individual JSON files, a page is saved as soon as it is retrieved.
 
     Args:
     parsed_datasets_directory (str): Path to the directory to save the parsed datasets.
-    dataset_file_path (str): Path to the dataset JSON file.
+    filter_query (str): Optional Solr filter query, e.g. to only get the records modified since the previous harvest
 
+    return (tuple): the MD5 of the saved records by (normalized) file name, and the highest SOLR_MODIFIED_FIELD of
+        the records (None if the records do not have the field)
     """
     # Create the parsed_datasets folder if it doesn't exist
     if not os.path.exists(parsed_datasets_directory):
@@ -624,35 +815,19 @@ def store_solr_response(base_query: str, solr_url: str, username, password, pars
 
     # Get datasets
     logger.info(f"Getting and parsing datasets ...")
-    docs: List[Dict] = fetch_solr_records(base_query, solr_url, username, password)
-
-    # Extract individual datasets from the 'docs' array
-    for doc in docs:
-        # remove HTML tags from the description field
-        temp_list = []
-        for elem in doc.get("description", []):
-            temp_list.append(remove_html_tags(elem))
-        doc["description"] = temp_list
-        # shorten title and description
-        doc["name"] = shorten_list_or_string(doc.get("name", ""), title_limit, more_characters)
-        doc["description"] = shorten_list_or_string(doc.get("description", ""), description_limit, more_characters)
-
-        # get the id of the dataset and shorten it to 128 characters if it is longer
-        current_id: str | None = doc.get("id", None)
-        if current_id is None:
-            raise Exception(f"Dataset {doc} does not have 'id'!")
-        if len(current_id) > id_limit:
-            current_id = current_id[:id_limit]
-
-        dataset_filename = os.path.join(parsed_datasets_directory, f"{current_id}.json")
-        logger.debug(f"Saving dataset to {dataset_filename}")
-        try:
-            with open(dataset_filename, 'w') as dataset_file:
-                json.dump(doc, dataset_file, indent=2)
-        except Exception as ex:
-            logger.error(f"Error saving dataset to {dataset_filename}: {ex}")
-            print(doc)
-            exit()
+    saved = {}
+    high_water_mark = None
+    for docs in fetch_solr_records(base_query, solr_url, username, password, filter_query=filter_query):
+        # Extract individual datasets from the 'docs' array
+        for doc in docs:
+            modified = doc.get(SOLR_MODIFIED_FIELD)
+            if isinstance(modified, str) and (high_water_mark is None or
+                                              solr_date(modified) > solr_date(high_water_mark)):
+                high_water_mark = modified
+            dataset_filename, md5 = store_solr_doc(doc, parsed_datasets_directory)
+            saved[os.path.normpath(dataset_filename)] = md5
+    logger.info(f"Saved {len(saved)} datasets in {parsed_datasets_directory}")
+    return saved, high_water_mark
 
 
 def get_id_from_change_list(diff_list_ruc: list) -> list[str]:
@@ -698,83 +873,165 @@ def reduce_id(input_path: str, id_limit: int = id_limit):
         logger.info(f"### {counter} files have id length > {id_limit}")
 
 
-def _harvest_datasets():
+def _harvest_datasets(unchanged: Optional[set] = None, reconcile: bool = False,
+                      db_file_name: str = os.path.join(output_path_data, "ineo.db"),
+                      hashes: Optional[Dict[str, str]] = None):
     """
     This function downloads the latest datasets from the Solr API and saves them as individual JSON files.
+
+    Only the records modified since the previous harvest of the base query are downloaded (the high-water mark in
+    change_store.HARVEST_STATE_TABLE). Every SOLR_RECONCILE_DAYS days, or if reconcile is True, all records are downloaded and the
+    files of the records which are no longer in Solr are removed. The high-water mark is saved with the next batch of
+    the datasets table, so it only moves on once the hashes of the harvested datasets are recorded.
+
+    unchanged (set): optional, the (normalized) file names of the datasets which were not downloaded again are
+        added to it, so get_changed_ids can reuse their hashes
+    hashes (dict): optional, the MD5 of every downloaded dataset is added to it by (normalized) file name
     """
     # Get INEO records from Solr and save them as individual JSON files
     # current_path = os.path.dirname(os.path.abspath(__file__))
     parsed_datasets_directory = './data/parsed_datasets'
-    store_solr_response(base_query, solr_url, username, password, parsed_datasets_directory)
+    store = get_change_store(db_file_name)
+    high_water_mark, full_harvest = store.get_harvest_state(base_query)
+    now = datetime.now()
+    if high_water_mark is None or full_harvest is None or \
+            now - datetime.strptime(full_harvest, "%Y%m%d%H%M%S") > timedelta(days=SOLR_RECONCILE_DAYS):
+        reconcile = True
+
+    if reconcile:
+        logger.info("Harvesting all datasets ...")
+        saved, new_high_water_mark = store_solr_response(base_query, solr_url, username, password,
+                                                         parsed_datasets_directory)
+        # the records which are no longer in Solr
+        for file_name in get_files(parsed_datasets_directory) or []:
+            if os.path.normpath(file_name) not in saved:
+                logger.info(f"Removing {file_name}, the dataset is no longer in Solr")
+                os.remove(file_name)
+        full_harvest = now.strftime("%Y%m%d%H%M%S")
+    else:
+        # inclusive, the records modified at the high-water mark itself may not all have been harvested
+        logger.info(f"Harvesting datasets modified since {high_water_mark} ...")
+        saved, new_high_water_mark = store_solr_response(base_query, solr_url, username, password,
+                                                         parsed_datasets_directory,
+                                                         filter_query=f"{SOLR_MODIFIED_FIELD}:[{high_water_mark} TO *]")
+        if unchanged is not None:
+            unchanged.update(os.path.normpath(file_name) for file_name in get_files(parsed_datasets_directory) or []
+                             if os.path.normpath(file_name) not in saved)
+
+    if hashes is not None:
+        hashes.update(saved)
+    if new_high_water_mark is None and reconcile:
+        logger.warning(f"The datasets do not have the field {SOLR_MODIFIED_FIELD}, the next harvest is a full one")
+    # saved with the datasets batch (see get_changed_ids), the datasets of a run failing before are harvested again
+    store.save_harvest_state(base_query, new_high_water_mark or high_water_mark, full_harvest, with_batch="datasets")
     logger.info("reducing id length according to the INEO standard")
     reduce_id(parsed_datasets_directory, id_limit)
     logger.debug(f"Datasets are saved in {parsed_datasets_directory}")
 
 
-def _harvest_ruc():
+def _harvest_ruc(unchanged: Optional[set] = None,
+                db_file_name: str = os.path.join(output_path_data, "ineo.db"),
+                table_name: str = "rich_user_contents") -> List[str]:
     """
     This function downloads the latest Rich User Content (RUC) from the Github repository "ineo-content".
-    """
-    ruc_contents_dict = get_ruc_contents()
-    serialize_ruc_to_json(ruc_contents_dict)
-
 
-def _harvest_tools_codemeta():
-    # download the codemeta files
-    _ = download_json_files()
+    Only the RUC files added, changed or deleted since the last processed commit (in change_store.HARVEST_STATE_TABLE)
+    are read and serialized, see get_ruc_changes. All files are read if there is no last commit, or no serialized RUC;
+    the JSON files of the RUC which are no longer in the repository are then removed as well.
+    The commit is saved with the next batch of table_name (see get_changed_ids), and the identifiers of the deleted
+    RUC are kept in the database until then, so a run failing before harvests the changes again and still reports
+    the deletions.
 
+    unchanged (set): optional, the (normalized) file names of the RUC which were not serialized again are added to
+        it, so get_changed_ids can reuse their hashes
 
-def get_changed_ids(db_file_name, db_table_name, current_timestamp, download_dir_part, diff_ids):
-    (c, conn) = get_db_cursor(db_file_name=db_file_name, table_name=db_table_name)
+    return (list): the identifiers of the tools whose RUC was deleted, also by a previous run which failed
+    """
+    ruc_directory = os.path.join(output_path_data, "rich_user_contents")
+    folder_path = os.path.join(RUC_GITHUB_DIR, RUC_FOLDER)
+    state_key = f"ruc:{RUC_GITHUB_URL}"
+    store = get_change_store(db_file_name)
+    last_commit, full_harvest = store.get_harvest_state(state_key)
+    commit = sync_ruc(RUC_GITHUB_URL, RUC_GITHUB_DIR)
+
+    changes = get_ruc_changes(RUC_GITHUB_DIR, last_commit, commit) if get_files(ruc_directory) else None
+    # the JSON files of the deleted RUC, {file name: identifier}
+    deleted = {}
+    if changes is None:
+        logger.info(f"Harvesting all RUC of commit {commit} ...")
+        written = serialize_ruc_to_json(get_ruc_contents(folder_path, sorted(os.listdir(folder_path))))
+        for file_name in get_files(ruc_directory) or []:
+            if os.path.normpath(file_name) not in written:
+                deleted[os.path.normpath(file_name)] = get_id_from_field(file_name)
+        full_harvest = datetime.now().strftime("%Y%m%d%H%M%S")
+    else:
+        changed, removed = changes
+        logger.info(f"Harvesting the RUC changed from commit {last_commit} to {commit}: "
+                    f"{len(changed)} added or changed, {len(removed)} deleted")
+        written = serialize_ruc_to_json(get_ruc_contents(folder_path, changed))
+        for key, identifier in get_deleted_ruc(RUC_GITHUB_DIR, last_commit, removed).items():
+            file_name = os.path.normpath(os.path.join(ruc_directory, os.path.splitext(key)[0] + ".json"))
+            # e.g. a renamed file with the same identifier is written again
+            if file_name not in written and os.path.exists(file_name):
+                deleted[file_name] = identifier
+        if unchanged is not None:
+            unchanged.update(os.path.normpath(file_name) for file_name in get_files(ruc_directory) or []
+                             if os.path.normpath(file_name) not in written)
+
+    store.add_pending_ids(table_name, deleted.values())
+    for file_name, identifier in deleted.items():
+        logger.info(f"Removing {file_name}, the RUC of {identifier} was deleted")
+        os.remove(file_name)
+        if unchanged is not None:
+            unchanged.discard(file_name)
+    store.save_harvest_state(state_key, commit, full_harvest, with_batch=table_name)
+    return store.pending_ids(table_name)
+
+
+def _harvest_tools_codemeta(not_modified: Optional[set] = None, hashes: Optional[Dict[str, str]] = None):
+    # download the codemeta files, the files not modified since the previous run are added to not_modified
+    remove_canon_files(os.path.join(output_path_data, "tools_metadata"))
+    _ = download_json_files(not_modified=not_modified, hashes=hashes)
+
+
+def get_changed_ids(db_file_name, db_table_name, current_timestamp, download_dir_part, diff_ids,
+                    unchanged: Optional[set] = None, hashes: Optional[Dict[str, str]] = None):
+    store = get_change_store(db_file_name)
     download_dir = os.path.join(output_path_data, download_dir_part)
 
-    # check if previous batch exists in the "tools_metadata" table
-    c.execute(f"SELECT * FROM {db_table_name} ORDER BY timestamp DESC LIMIT 1")
-    has_previous_batch = c.fetchone()
-    if has_previous_batch is None:
+    # check if previous batch exists in the table
+    previous_timestamp = store.latest_timestamp(db_table_name)
+    if previous_timestamp is None:
         logger.debug(f"No {db_table_name} previous batch exists in the database")
-        previous_batch = None
-        previous_timestamp = None
+        previous_batch_dict = None
     else:
-        previous_timestamp = has_previous_batch[2]
-        if previous_timestamp is None:
-            logger.error("Error in getting the previous batch!")
-            exit(1)
-
-        previous_batch = get_previous_batch(db_file_name, db_table_name, previous_timestamp=previous_timestamp)
+        # previous_batch_dict contains key value pair in the form of {file_name: md5}
+        previous_batch_dict = store.get_batch(db_table_name, previous_timestamp)
 
     current_batch = get_files(download_dir)
     if current_batch is None:
         logger.error("No codemeta files found in the current batch!")
         exit(1)
 
-    # compare the 2 lists and get the difference
-    diff_list = compare_lists(current_batch, previous_batch)
-
-    if has_previous_batch is not None:
-        # get previous batch from db
-        c.execute(f"SELECT file_name, md5 FROM {db_table_name} WHERE timestamp = ?", (previous_timestamp,))
-        previous_batch = c.fetchall()
-
-        # previous_batch_dict contains key value pair in the form of {file_name: md5}
-        previous_batch_dict = {x[0]: x[1] for x in previous_batch}
-
+    if previous_batch_dict is not None:
         batch = [x.split("/")[-1] for x in current_batch]
 
         # loop through current batch and compare with previous batch using hash values
-        process_list(diff_ids, download_dir, db_file_name, db_table_name, batch, current_timestamp, previous_batch_dict)
+        process_list(diff_ids, download_dir, db_file_name, db_table_name, batch, current_timestamp, previous_batch_dict,
+                     unchanged, hashes)
     else:
-        process_list(diff_ids, download_dir, db_file_name, db_table_name, diff_list, current_timestamp, None)
+        # compare the 2 lists and get the difference
+        diff_list = compare_lists(current_batch, None)
+        process_list(diff_ids, download_dir, db_file_name, db_table_name, diff_list, current_timestamp, None,
+                     hashes=hashes)
 
-    conn.commit()
-    conn.close()
 
-
-def harvest(threshold: int = 3, debug: bool = False) -> Tuple:
+def harvest(threshold: int = 3, debug: bool = False, reconcile: bool = False) -> Tuple:
     """
     This script downloads the latest Codemeta JSON files and Rich User Content (RUC) from Github,
-    threshold: int : The number of iterations after which a file is considered absent.
-    TODO: The threshold is implemented, but need test
+    threshold: int : The number of iterations after which a file is considered absent, the ids of the absent tools
+        and datasets are written to deleted_tool_ids.json (see write_deleted_ids)
+    reconcile: bool : Harvest all datasets, instead of only those modified since the previous harvest
     """
     if debug:
         if os.path.exists("tools.json") and os.path.exists("datasets.json"):
@@ -804,13 +1061,18 @@ def harvest(threshold: int = 3, debug: bool = False) -> Tuple:
     """
     # harvest datasets
     logger.info("Harvesting datasets ...")
-    _harvest_datasets()
+    unchanged_datasets = set()
+    dataset_hashes = {}
+    _harvest_datasets(unchanged_datasets, reconcile, db_file_name, dataset_hashes)
     # harvest tools_codemeta
     logger.info("Harvesting tools codemeta ...")
-    _harvest_tools_codemeta()
+    not_modified = set()
+    codemeta_hashes = {}
+    _harvest_tools_codemeta(not_modified, codemeta_hashes)
     # harvest ruc
     logger.info("Harvesting rich user content ...")
-    _harvest_ruc()
+    unchanged_ruc = set()
+    deleted_ruc_ids = _harvest_ruc(unchanged_ruc, db_file_name)
 
     """
     Getting the changed ids after harvesting
@@ -818,9 +1080,18 @@ def harvest(threshold: int = 3, debug: bool = False) -> Tuple:
     codemeta_ids: list = []
     datasets_ids: list = []
 
-    get_changed_ids(db_file_name, "tools_metadata", current_timestamp, "tools_metadata", codemeta_ids)
-    get_changed_ids(db_file_name, "rich_user_contents", current_timestamp, "rich_user_contents", codemeta_ids)
-    get_changed_ids(db_file_name, "datasets", current_timestamp, "parsed_datasets", datasets_ids)
+    get_changed_ids(db_file_name, "tools_metadata", current_timestamp, "tools_metadata", codemeta_ids, not_modified,
+                    codemeta_hashes)
+    # the deleted RUC are reported by _harvest_ruc, the presence of the RUC files is not needed
+    get_change_store(db_file_name).untrack_presence("rich_user_contents")
+    get_changed_ids(db_file_name, "rich_user_contents", current_timestamp, "rich_user_contents", codemeta_ids,
+                    unchanged_ruc)
+    # the tools whose RUC was deleted are templated again, without it
+    if deleted_ruc_ids:
+        logger.info(f"The RUC of {len(deleted_ruc_ids)} tools was deleted: {', '.join(deleted_ruc_ids)}")
+        codemeta_ids.extend(deleted_ruc_ids)
+    get_changed_ids(db_file_name, "datasets", current_timestamp, "parsed_datasets", datasets_ids, unchanged_datasets,
+                    dataset_hashes)
 
     """
     Make sure the ids are unique and save them to the files for debugging
@@ -832,34 +1103,31 @@ def harvest(threshold: int = 3, debug: bool = False) -> Tuple:
             json.dump(codemeta_ids, f)
         with open("datasets.json", "w") as f:
             json.dump(datasets_ids, f)
-    return codemeta_ids, datasets_ids
 
-    # TODO <<<DELETION SCENERIO >>>
-    # Search for inactive tools to delete in INEO (inactive after a tool is absent for three runs in the database)
-    codemeta_records = get_matching_timesamps(db_file_name, table_name_tools, threshold)
-    # Iterate through the absent records and compare the timestamps in the db with the current date 
-    process_records_timestamps(codemeta_records)
-
-    ids_to_delete = []
-    for file_name, count in absence_count.items():
-        if count > threshold:
-            # Extract the ID from the file_name
-            tool_id = get_id_from_file_name(file_name)
-            if tool_id:
-                ids_to_delete.append(tool_id)
-
-    if ids_to_delete:
-        logger.debug(f"IDs of the tools to be deleted: {', '.join(ids_to_delete)}")
-
-        # Write the IDs to a JSON file in the "delete_tools" folder
-        deleted_documents_folder = delete_path
-        if not os.path.exists(deleted_documents_folder):
-            os.makedirs(deleted_documents_folder)
-
-        file_path = os.path.join(delete_path, 'deleted_tool_ids.json')
-        with open(file_path, 'w') as json_file:
-            json.dump(ids_to_delete, json_file)
-            logger.debug(f"JSON containing tools to be deleted saved to {file_path}")
+    """
+    Search for inactive tools and datasets to delete in INEO (inactive after being absent for threshold runs)
+    """
+    # the ids are pending until the sync confirms their deletion (see confirm_deleted_ids), the absent files are then
+    # forgotten: a file which comes back later is recorded as a new one. The RUC are not checked, a deleted RUC is no
+    # tool to delete but a tool to template again, see _harvest_ruc
+    store = get_change_store(db_file_name)
+    store.add_pending_ids(PENDING_DELETIONS, get_absent_ids(db_file_name, "tools_metadata", threshold) +
+                          get_absent_ids(db_file_name, "datasets", threshold))
+    for table_name in ("tools_metadata", "datasets"):
+        store.forget_absent(table_name, threshold)
+    # a tool or dataset which came back before its deletion was synced is not deleted
+    deleted_ids = store.pending_ids(PENDING_DELETIONS)
+    present_ids = store.present_ids("tools_metadata") | store.present_ids("datasets")
+    store.remove_pending_ids(PENDING_DELETIONS, [item_id for item_id in deleted_ids if item_id in present_ids])
+    write_deleted_ids(store.pending_ids(PENDING_DELETIONS))
+
+    # the presence of the files is kept in the store, only the last batches are needed for the comparison
+    for table_name in ("tools_metadata", "rich_user_contents", "datasets"):
+        store.compact(table_name)
+    store.vacuum_if_due()
+
+    close_change_stores()
+    return codemeta_ids, datasets_ids
 
 
 if __name__ == '__main__':
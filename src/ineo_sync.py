@@ -1,16 +1,24 @@
 import os
 import time
 import json
+import asyncio
+import itertools
 import requests
 import sys
 import logging
+from typing import Iterable, Iterator
 from dotenv import load_dotenv
 import dotenv
-from harvester import get_logger, get_files
+from harvester import get_logger, confirm_deleted_ids
+from utils import AsyncHttpClient
+from vocabs import normalize_properties
+from package_sink import spool_path, read_spool, read_directory, batches
 
 log_file_path = 'ineo_sync.log'
 logger = get_logger(log_file_path, __name__)
 BULK_SIZE = 1000
+# maximum number of requests in flight to the INEO API from the asyncio variants
+INEO_CONCURRENCY = 50
 
 """
 This file loads some environment variables from a .env file
@@ -44,6 +52,18 @@ It's possible structure is as follows:
 ineo_api_error = {}
 
 
+def get_packages(folder_path: str) -> Iterator[list]:
+    """
+    The processed packages of the folder, from the spool written by the templating (see package_sink.py) or, if
+    there is no spool, from the <id>_processed.json files in the folder.
+    The packages are read one by one, so they can be synced in batches while they are read.
+    """
+    if os.path.exists(spool_path(folder_path)):
+        logger.debug(f"Reading the packages of {folder_path} from its spool")
+        return read_spool(folder_path)
+    return read_directory(folder_path)
+
+
 def get_id_json(folder_path) -> list:
     """
     This function retrieves the ids of the processed files that need to go to INEO.  
@@ -51,32 +71,50 @@ def get_id_json(folder_path) -> list:
     So a document with id "alud" will be available at https://www.ineo.tools/resources/alud.
     """
     ineo_ids = []
-    for filename in os.listdir(folder_path):
-        if filename.endswith(".json"):
-            file_path = os.path.join(folder_path, filename)
-            with open(file_path, 'r') as json_file:
-                try:
-                    document = json.load(json_file)
-                    # a document is a list with a single dictionary element
-                    if isinstance(document, list) and len(document) == 1:
-                        # a document must always contain an id
-                        id_value = document[0].get("document", {}).get("id")
-                        if id_value is not None:
-                            ineo_ids.append(id_value)
-                        else:
-                            logger.error(f"ERROR: File {filename} does not contain an 'id' field.")
-                    else:
-                        logger.error(f"ERROR: File {filename} does not have the expected INEO structure.")
-                except json.JSONDecodeError as e:
-                    logger.error(f"Error reading processed JSON from file {filename}: {str(e)}")
+    for document in get_packages(folder_path):
+        # a document is a list with a single dictionary element
+        if isinstance(document, list) and len(document) == 1:
+            # a document must always contain an id
+            id_value = document[0].get("document", {}).get("id")
+            if id_value is not None:
+                ineo_ids.append(id_value)
+            else:
+                logger.error(f"ERROR: A package of {folder_path} does not contain an 'id' field.")
+        else:
+            logger.error(f"ERROR: A package of {folder_path} does not have the expected INEO structure.")
     # The unique "id" values from all processed JSON files to be fed or updated into INEO
     return ineo_ids
 
 
-def load_processed_document(id, folder_path):
-    file_path = os.path.join(folder_path, f"{id}_processed.json")
-    with open(file_path, 'r') as json_file:
-        return json.load(json_file)
+def load_processed_documents(folder_path) -> dict:
+    """
+    The processed packages of the folder by their document id, from the spool or the files (see get_packages)
+    """
+    documents = {}
+    for document in get_packages(folder_path):
+        if isinstance(document, list) and len(document) == 1:
+            id_value = document[0].get("document", {}).get("id")
+            if id_value is not None:
+                documents[id_value] = document
+    return documents
+
+
+def load_processed_document(id, folder_path, documents: dict = None):
+    """
+    The processed package of the id
+
+    documents (dict): optional, the packages of the folder by id (see load_processed_documents), so the spool is only
+        read once for many ids; without it, the <id>_processed.json file is read, or the spool if there is no such file
+    """
+    if documents is None:
+        file_path = os.path.join(folder_path, f"{id}_processed.json")
+        if os.path.exists(file_path):
+            with open(file_path, 'r') as json_file:
+                return json.load(json_file)
+        documents = load_processed_documents(folder_path)
+    if id not in documents:
+        raise FileNotFoundError(f"There is no processed package of {id} in {folder_path}")
+    return documents[id]
 
 
 def save_json_data_to_file(data, file_path):
@@ -84,90 +122,49 @@ def save_json_data_to_file(data, file_path):
         json.dump(data, json_file, indent=4)
 
 
-def check_properties(id, folder_path, vocabs) -> None:
-    """"
-    This function checks whether the researchDomains and researchActivities in the processed templates matches INEO.
-    There are some discrepancies, e.g. https://w3id.org/nwo-research-fields#TextualAndContentAnalysis (INEO) 
-    and https://w3id.org/nwo-research-fields#TextualandContentAnalysis (processed Json file of Alud). 
-    """
-    properties_file_path = f"./properties/{vocabs}.json"
-    
-    if os.path.exists(properties_file_path):
-        with open(properties_file_path, "r") as json_file:
-            properties = json.load(json_file)
-            processed_files = load_processed_document(id, folder_path)
-            try:
-                research_domains = processed_files[0]['document']['properties'][f'{vocabs}']
-            except KeyError as e:
-                research_domains = None
-            
-            # Check if research_domains is not None
-            if research_domains is not None:
-                # Filter out None values from research_domains
-                research_domains = [domain for domain in research_domains if domain]
-
-                updated_research_domains = []
-                non_matches = []
-
-                # Print results and update research domains
-                for domain in research_domains:
-                    # Check if the researchdomain (template) is directly in the links (INEO property). If there is a match found (case-insensitive e.g. TextualAndContentAnalysis (INEO) == TextualandContentAnalysis (codemeta))
-                        # the value of the processed.jsonfile is replaced with the property from INEO (so TextualAndContentAnalysis)
-                    matches = [entry for entry in properties if entry['link'].lower() == domain.lower()]
-                    if matches:
-                        logger.info(f"Match found: {domain}")
-                        corresponding_link = matches[0]['link']
-                        updated_research_domains.append(corresponding_link)
-                    else:
-                        # Check if the domain is in the titles (mapping subjects datasets)
-                        matches_in_titles = [entry for entry in properties if domain.lower() in entry['title'].lower()]
-                        if matches_in_titles:
-                            logger.info(f"Match found in title: {domain}")
-                            corresponding_entry = matches_in_titles[0]
-                            updated_research_domains.append(corresponding_entry['link'])
-                        else:
-                            logger.info(f"No match found for: {domain}")
-                            non_matches.append(domain)
-                            logger.info(f"no matches for: {non_matches}")
-
-                # Update the researchDomains value in the data
-                processed_files[0]['document']['properties'][f'{vocabs}'] = updated_research_domains
-
-                # Save the updated data back to the same JSON file
-                json_file_path = f"./{folder_path}/{id}_processed.json"
-                save_json_data_to_file(processed_files, json_file_path)
-
-
 def get_document(ids: list[str], processed_jsonfiles: list[str]) -> tuple[list, list, list]:
     """
     This code first checks if a tool with the given identifier exists in INEO by performing a GET request. 
     If a resource exists (status code 200) and does not return an empty list, it returns a list with the processed resources. 
     If the resource does not exist the API returns an empty list [] (not a status code 404). 
+    The GET requests run concurrently, see get_document_async.
 
     - id (str): Identifier of the processed files.
     - folder_path (str): Path to the folder containing the processed files.
     - vocabs (str): Name of the property (e.g., "researchDomains" or "researchActivities").
 
+    """
+    return asyncio.run(get_document_async(ids, processed_jsonfiles))
+
+
+async def get_document_async(ids: list[str], processed_jsonfiles: list[str],
+                             concurrency: int = INEO_CONCURRENCY) -> tuple[list, list, list]:
+    """
+    The asyncio variant of get_document, up to concurrency GET requests are in flight.
+    The results are in the order of the ids.
     """
     processed_document = []
     ids_to_update = []
-    ids_to_create = []  
-    for id in ids:
-        get_url = f"{api_url}{id}"
-        get_response = requests.get(get_url, headers=header)
+    ids_to_create = []
+    async with AsyncHttpClient(concurrency=concurrency, headers=header) as client:
+        responses = await asyncio.gather(*(client.get(f"{api_url}{id}") for id in ids))
+
+    # the packages of the folder are read once, the templating writes them to a spool by default
+    documents = load_processed_documents(processed_jsonfiles)
+    for id, get_response in zip(ids, responses):
         if get_response.status_code == 200:
             if get_response.text == '[]':
                 resource_exists(get_response, id, ids_to_create)
             else:
                 logger.info(f"{id} is present in INEO")
                 logger.info(get_response.text)
-                json_data = load_processed_document(id, processed_jsonfiles)
+                json_data = load_processed_document(id, processed_jsonfiles, documents)
                 processed_document.append(json_data)
                 ids_to_update.append(id)
         else:
             logger.error("Error retrieving the resource from INEO")
             logger.info(get_response.text)
-    
+
     return processed_document, ids_to_create, ids_to_update
 
 
@@ -190,6 +187,7 @@ def handle_empty(ids, processed_jsonfiles, force_yes=False):
     if not force_yes:
         force_yes = input("Do you want to force 'yes' for all new tools (create)? (y/n): ").lower() == 'y'
 
+    documents = load_processed_documents(processed_jsonfiles)
     for id in ids:
         if not force_yes:
             confirmation = input(f"Are you sure you want to create {id}? (y/n): ")
@@ -198,12 +196,8 @@ def handle_empty(ids, processed_jsonfiles, force_yes=False):
                 continue
         
         logger.info(f"Sending {id} to INEO...")
-        file_name = f"{id}_processed.json"
-        file_path = os.path.join(processed_jsonfiles, file_name)
-  
-        with open(file_path, 'r') as new_document:
-            new_document = json.load(new_document)
-            create_response = requests.post(api_url, json=new_document, headers=header)
+        new_document = load_processed_document(id, processed_jsonfiles, documents)
+        create_response = requests.post(api_url, json=new_document, headers=header)
         
         if create_response.status_code == 200:
             logger.info(f"Creation of {id} is successful")
@@ -271,10 +265,12 @@ def create_delete_template():
     return delete_template 
 
 
-def delete_document(delete_list, force_yes=False):
+def delete_document(delete_list, force_yes=False, deleted_ids: list = None):
     """
     If a document contains a delete operation, with a post request we can delete resources in INEO. 
     Only the id is needed to delete a resource.
+
+    deleted_ids (list): optional, the ids which are confirmed to be deleted are appended to it
     """
     # Check if the "deleted_documents" folder exists, and create it if not
     deleted_documents_folder = "deleted_documents"
@@ -308,6 +304,8 @@ def delete_document(delete_list, force_yes=False):
             get_response = requests.get(get_url, headers=header)
             if get_response.status_code == 200 and get_response.text == '[]':
                 logger.info(f"Resource with id {id} deleted successfully.")
+                if deleted_ids is not None:
+                    deleted_ids.append(id)
             else:
                 raise ToolStillPresentError(f"ERROR: {id} is still present in INEO")
         else:
@@ -363,6 +361,43 @@ def call_ineo_bulk(ineo_package: list, api_url: str) -> None:
     print(f"#### Response {response.status_code} - {api_url} - {response.text}")
 
 
+async def call_ineo_bulk_async(client: AsyncHttpClient, ineo_package: list, api_url: str) -> bool:
+    """
+    The asyncio variant of call_ineo_bulk, an error is logged instead of exiting.
+
+    :param client: AsyncHttpClient, within its context
+    :param ineo_package: list
+    :param api_url: str
+    :return: bool, True if INEO accepted the packages
+    """
+    try:
+        response = await client.post(api_url, json=ineo_package)
+    except Exception as e:
+        logger.error(f"Error calling INEO API: {str(e)}")
+        return False
+
+    if response.status_code != 200:
+        logger.error(f"Action on resources failed.")
+    logger.info(f"#### Response {response.status_code} - {api_url} - {response.text}")
+    return response.status_code == 200
+
+
+async def sync_bulk_package_async(bulk_package: list, api_url: str, bulk_size: int = BULK_SIZE,
+                                  concurrency: int = INEO_CONCURRENCY) -> int:
+    """
+    Send the packages in batches of bulk_size, up to concurrency batches are in flight.
+
+    :return: int, the number of failed batches
+    """
+    batches = [bulk_package[i:i + bulk_size] for i in range(0, len(bulk_package), bulk_size)]
+    async with AsyncHttpClient(concurrency=concurrency, headers=header) as client:
+        results = await asyncio.gather(*(call_ineo_bulk_async(client, batch, api_url) for batch in batches))
+    failed = results.count(False)
+    if failed:
+        logger.error(f"{failed} of {len(batches)} batches could not be synced with INEO.")
+    return failed
+
+
 def get_processed_files_folder_from_type(record_type: str = "tools") -> str:
     # check tool properties and replace with INEO property if match is found
     if record_type == "tools":
@@ -438,17 +473,12 @@ def bulk_del_from_ineo_by_local_type(record_type: str = "tools") -> None:
     """
     processed_files = get_processed_files_folder_from_type(record_type)
 
-    ineo_packages: list | None = get_files(processed_files)
-    if ineo_packages is None or len(ineo_packages) == 0:
+    bulk_package: list = [ineo_package[0] for ineo_package in get_packages(processed_files)]
+    if len(bulk_package) == 0:
         logger.info(f"No packages found in the {record_type} processed folder.")
         exit(0)
     else:
-        logger.info(f"Found {len(ineo_packages)} packages in the {record_type}. Syncing ...")
-        bulk_package: list = []
-        for package in ineo_packages:
-            with open(package, 'r') as json_file:
-                ineo_package = json.load(json_file)
-                bulk_package.append(ineo_package[0])
+        logger.info(f"Found {len(bulk_package)} packages in the {record_type}. Syncing ...")
 
     bulk_delete_package = [{"operation": "delete", "document": {"id": package["document"]["id"]}} for package in bulk_package]
     print(f"sample ineo package to be removed: {bulk_delete_package[0]}")
@@ -457,13 +487,21 @@ def bulk_del_from_ineo_by_local_type(record_type: str = "tools") -> None:
     exit(0)
 
 
-def sync_with_ineo(record_type: str = "tools", limit: int = 0) -> None:
+def sync_with_ineo(record_type: str = "tools", limit: int = 0, concurrency: int = 1,
+                   renormalize: bool = False, packages: Iterable[list] = None) -> None:
     """
     This function syncs either tools or datasets with ineo depends on the parameters passed.
+    The researchDomains and researchActivities are already mapped to INEO by the templating (vocabs.normalize_properties).
+    The packages are sent in batches of BULK_SIZE while they are read, they are not loaded all at once.
 
     :param record_type: str
     :param limit: int limit the amount of packages to sync
     :param remove_first: bool remove the packages first before syncing
+    :param concurrency: int the number of batches sent to INEO at the same time, 1 sends them one by one with a pause
+    :param renormalize: bool map the researchDomains and researchActivities again, in memory, e.g. for packages
+        templated before the properties were updated
+    :param packages: the packages to sync, e.g. from a package_sink.QueueSink, by default those of the processed
+        folder of the record type (see get_packages)
     :return: None
 
     """
@@ -471,33 +509,26 @@ def sync_with_ineo(record_type: str = "tools", limit: int = 0) -> None:
         new_record_type = "datasets"
     else:
         new_record_type = record_type
-    existing_ineo_resources_ids = get_resources_id_from_ineo_api_by_type(new_record_type)
-    # check tool properties and replace with INEO property if match is found
-    processed_files = get_processed_files_folder_from_type(record_type)
-    processed_document_ids = get_id_json(processed_files)
-    for processed_id in processed_document_ids:
-        if record_type in ["tools", "datasets"]:
-            check_properties(processed_id, processed_files, vocabs="researchDomains")
-        if record_type == "tools":
-            check_properties(processed_id, processed_files, vocabs="researchActivities")
+    existing_ineo_resources_ids = set(get_resources_id_from_ineo_api_by_type(new_record_type))
+    if packages is None:
+        packages = get_packages(get_processed_files_folder_from_type(record_type))
 
     # call ineo api on given record type
     if limit > 0:
         logger.debug(f"Limiting the number of {record_type} packages to sync to {limit}")
-        ineo_packages: list = get_files(processed_files)[:limit]
+        packages = itertools.islice(packages, limit)
     else:
         logger.debug(f"Syncing all {record_type} packages.")
-        ineo_packages: list | None = get_files(processed_files)
 
-    if ineo_packages is None or len(ineo_packages) == 0:
-        logger.info(f"No packages found in the {record_type} processed folder.")
-        exit(0)
-    else:
-        logger.info(f"Found {len(ineo_packages)} packages in the {record_type}. Syncing ...")
+    synced = 0
+    # the batches sent at the same time when concurrency > 1
+    pending: list = []
+    for batch in batches(packages, BULK_SIZE):
         bulk_package: list = []
-        for package in ineo_packages:
-            with open(package, 'r') as json_file:
-                ineo_package = json.load(json_file)
+        for ineo_package in batch:
+            if renormalize:
+                # check the properties and replace with INEO property if match is found
+                normalize_properties(ineo_package, record_type)
             if ineo_package[0]["document"]["id"] in existing_ineo_resources_ids:
                 logger.info(f"Resource {ineo_package[0]['document']['id']} already exists in INEO. Updating the record")
                 update_ineo_package = {"operation": "update", "document": ineo_package[0]["document"]}
@@ -506,17 +537,32 @@ def sync_with_ineo(record_type: str = "tools", limit: int = 0) -> None:
                 logger.debug(f"Resource {ineo_package[0]['document']['id']} does not exist in INEO. Creating the record")
                 bulk_package.append(ineo_package[0])
 
-        # Syncing the packages in bulk or batch
-        logger.info(f"Syncing in total {len(bulk_package)} {record_type} packages.")
-        if len(bulk_package) > BULK_SIZE:
-            logger.info(f"Syncing {len(bulk_package)} {record_type} packages in batches of size {BULK_SIZE}.")
-            for i in range(0, len(bulk_package), BULK_SIZE):
-                logger.info(f"Syncing {i} to {i + BULK_SIZE} {record_type} packages.")
-                call_ineo_bulk(bulk_package[i:i + BULK_SIZE], api_url)
-                time.sleep(10)
+        # Syncing the packages in batches
+        if concurrency > 1:
+            pending.extend(bulk_package)
+            if len(pending) >= BULK_SIZE * concurrency:
+                logger.info(f"Syncing {synced} to {synced + len(pending)} {record_type} packages in batches of size "
+                            f"{BULK_SIZE}, {concurrency} at a time.")
+                asyncio.run(sync_bulk_package_async(pending, api_url, BULK_SIZE, concurrency))
+                synced += len(pending)
+                pending = []
         else:
-            logger.info(f"Syncing {len(bulk_package)} {record_type} packages in bulk.")
+            if synced > 0:
+                time.sleep(10)
+            logger.info(f"Syncing {synced} to {synced + len(bulk_package)} {record_type} packages.")
             call_ineo_bulk(bulk_package, api_url)
+            synced += len(bulk_package)
+
+    if pending:
+        logger.info(f"Syncing {synced} to {synced + len(pending)} {record_type} packages in batches of size "
+                    f"{BULK_SIZE}, {concurrency} at a time.")
+        asyncio.run(sync_bulk_package_async(pending, api_url, BULK_SIZE, concurrency))
+        synced += len(pending)
+
+    if synced == 0:
+        logger.info(f"No packages found in the {record_type} processed folder.")
+    else:
+        logger.info(f"Synced in total {synced} {record_type} packages.")
 
 
 def main(record_type: str, limit: int = 5) -> None:
@@ -535,11 +581,15 @@ def main(record_type: str, limit: int = 5) -> None:
         delete_file_path = f"{delete_path}/deleted_tool_ids.json"
         with open(delete_file_path, 'r') as json_file:
             delete_list = json.load(json_file)
+            deleted_ids = []
             try:
-                delete_document(delete_list)
+                delete_document(delete_list, deleted_ids=deleted_ids)
             except ToolStillPresentError as e:
                 logger.error(str(e))
-                sys.exit(1) 
+                sys.exit(1)
+            finally:
+                # the other ids stay in deleted_tool_ids.json, see harvester.write_deleted_ids
+                confirm_deleted_ids(deleted_ids)
 
 
 if __name__ == "__main__":
@@ -3,9 +3,9 @@ import os.path
 import random
 import shutil
 import string
-from datetime import datetime
-from typing import Tuple
+from typing import Optional, Tuple
 
+import asyncio
 import concurrent.futures
 import requests
 import rating
@@ -16,8 +16,15 @@ import logging
 import harvester
 from tqdm import tqdm
 
-from template import main as templating
-from utils import get_logger, call_basex, call_basex_with_file, call_basex_with_query
+from template import (template_package, get_plan, prefetch_md_results, init_ruc_cache, template_block_async,
+                      MD_BATCH_SIZE, USE_MD_INDEX, RUC_FOLDER)
+from template_cache import get_template_cache, TemplateCache
+from package_sink import PackageSink, DirectorySink, JsonlSpoolSink, QueueSink, TeeSink, spool_path, SPOOL_FOLDER
+from template_profile import TemplateProfile, profile_var
+from snapshot_store import get_snapshot_store
+from md_index import get_md_index
+from utils import (get_logger, get_basex_client, init_basex_client, BaseXClient, AsyncBaseXClient,
+                   ASYNC_CONCURRENCY)
 
 import cProfile
 import pstats
@@ -38,6 +45,22 @@ JSONL_datasets_rdb = "/data/datasets.jsonl"
 TOOLS_TEMPLATE = "./template_tools.json"
 DATASETS_TEMPLATE = "./template_datasets.json"
 
+# number of templating workers and the maximum number of BaseX requests running at the same time over all workers
+TEMPLATE_WORKERS = 12
+BASEX_MAX_IN_FLIGHT = 24
+# restore the templated files of the ids whose inputs did not change, see template_cache.py
+USE_TEMPLATE_CACHE = True
+# the sink of the templated packages, "spool" for a JSONL spool per processed folder or "directory" for a file per
+# package, see package_sink.py
+PACKAGE_SINK = "spool"
+# also write a file per package to the processed folders when spooling, e.g. for debugging
+WRITE_PROCESSED_FILES = False
+# record the time per directive kind, query and record, reported in ./logs/template_profile_<type>.json
+PROFILE_TEMPLATING = True
+
+# maximum length of the strings in the basex indexes, must be larger than the maximum length of an id (128)
+BASEX_INDEX_MAXLEN = 256
+
 
 def profile(toprankers: int = 10):
     def decorator_profile(func):
@@ -127,73 +150,244 @@ def get_ids_from_jsonl(jsonl_file: str) -> list[str]:
     return all_ids
 
 """
-Single processing version
-avg time: 1.95s
+Single processing version, see call_template for the parallel versions.
+Reproduce the numbers with benchmark.py, e.g. for 1000 tools against the BaseX stand-in with a latency of 5 ms and
+12 workers (python benchmark.py template tools --sizes 1000 --latency 5), in records/sec:
+serial (a query per id) 7.0, batched 250.1, thread 826.1, process 688.6, async 773.4
 """
-def call_template_subprocess(ids: list, template_type: str = 'tools'):
+def call_template_subprocess(ids: list, template_type: str = 'tools', batch_size: int = MD_BATCH_SIZE,
+                             sink: PackageSink = None, profile: TemplateProfile = None) -> Tuple[dict, dict]:
+    """
+    Template the ids one block after the other in this process, see call_template for the parallel version.
+
+    return (tuple): id -> error message for the ids which could not be templated, and the new template cache entries
+    """
     template_path = TOOLS_TEMPLATE if template_type == 'tools' else DATASETS_TEMPLATE
-    for current_id in tqdm(ids):
+    init_ruc_cache()
+    errors, entries = {}, {}
+    with tqdm(total=len(ids)) as progress:
+        for i in range(0, len(ids), batch_size):
+            block = ids[i:i + batch_size]
+            block_errors, block_entries, packages, stats = template_block(block, template_path, template_type,
+                                                                          profile is not None)
+            emit_packages(sink, packages)
+            if profile is not None:
+                profile.merge(stats)
+            errors.update(block_errors)
+            entries.update(block_entries)
+            progress.update(len(block))
+    return errors, entries
+
+
+def emit_packages(sink: Optional[PackageSink], packages: list) -> None:
+    """
+    Emit the packages of a block, (id, folder, package), to the sink
+    """
+    if sink is not None:
+        for current_id, folder, package in packages:
+            sink.emit(current_id, folder, package)
+
+
+def get_cache(template_path: str, template_type: str) -> Optional[TemplateCache]:
+    """
+    The template cache of this process, None if the cache is not used
+    """
+    return get_template_cache(template_path, template_type, RUC_FOLDER) if USE_TEMPLATE_CACHE else None
+
+
+def template_block(block: list, template_path: str, template_type: str,
+                   profiled: bool = False) -> Tuple[dict, dict, list, Optional[dict]]:
+    """
+    Template a block of ids, the md queries are evaluated once for the whole block.
+    The ids whose inputs did not change since they were templated are restored from the template cache.
+    A failing id does not stop the block, its error is returned instead.
+
+    block (list): The ids to be templated
+    template_path (str): The path to the template
+    template_type (str): 'tools' or 'datasets'
+    profiled (bool): Record the time per directive kind, query and record, see template_profile.py
+
+    return (tuple): id -> error message for the ids which could not be templated, the new template cache entries,
+        the packages as (id, folder, package), emitted to the sink by the calling process, and the stats of the
+        profile of the block (None if not profiled), merged by the calling process
+    """
+    profile = TemplateProfile() if profiled else None
+    token = profile_var.set(profile)
+    try:
+        errors, entries, packages = _template_block(block, template_path, template_type)
+    finally:
+        profile_var.reset(token)
+    return errors, entries, packages, profile.stats if profile is not None else None
+
+
+def _template_block(block: list, template_path: str, template_type: str) -> Tuple[dict, dict, list]:
+    # compiled once per process
+    plan = get_plan(template_path, template_type)
+    cache = get_cache(template_path, template_type)
+    packages = []
+    misses = []
+    for current_id in block:
+        restored = cache.restore(current_id) if cache is not None else None
+        if restored is None:
+            misses.append(current_id)
+        else:
+            packages.append((current_id, *restored))
+    md_results = prefetch_md_results(plan, misses) if len(misses) > 1 else None
+    errors, entries = {}, {}
+    for current_id in misses:
         try:
             logger.debug(f"Making a json file for INEO for {current_id} with template [{template_path}]...")
-            # print(f"Making a json file for INEO for {current_id} with template [{template_path}]...")
-            templating(current_id, template_path, template_type)
-        except Exception:
-            logger.error(f"Cannot template the file: [{current_id}] with template: [{template_path}]")
-            raise
+            dependencies = set()
+            folder, package = template_package(current_id, template_path, template_type, plan, md_results,
+                                               dependencies)
+            packages.append((current_id, folder, package))
+            if cache is not None:
+                entries[current_id] = cache.store(current_id, folder, package, dependencies)
+        except Exception as ex:
+            logger.error(f"Cannot template the file: [{current_id}] with template: [{template_path}]: {ex}")
+            errors[current_id] = f"{type(ex).__name__}: {ex}"
+    return errors, entries, packages
+
+
+def _init_template_worker(template_path: str, template_type: str, basex_pool_size: int) -> None:
+    """
+    Initializer of the template workers: the compiled template, the listing of the RUC folder, the index of the
+    metadata, the template cache and the keep-alive BaseX connections are set up once per worker instead of once
+    per id.
+    """
+    get_plan(template_path, template_type)
+    init_ruc_cache()
+    if USE_MD_INDEX or USE_TEMPLATE_CACHE:
+        get_md_index(template_type)
+    get_cache(template_path, template_type)
+    init_basex_client(basex_pool_size)
 
-"""
-multiprocessing version
-avg time: 3.5s
-"""
-# def process_id(args):
-#     current_id, template_path, template_type = args
-#     try:
-#         logger.debug(f"Making a json file for INEO for {current_id} with template [{template_path}]...")
-#         templating(current_id, template_path, template_type)
-#     except Exception:
-#         logger.error(f"Cannot template the file: [{current_id}] with template: [{template_path}]")
-#         raise
-#
-# def call_template_subprocess(ids: list, template_type: str = 'tools', workers: int = 4):
-#     template_path = TOOLS_TEMPLATE if template_type == 'tools' else DATASETS_TEMPLATE
-#     args = [(current_id, template_path, template_type) for current_id in ids]
-#
-#     with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
-#         list(tqdm(executor.map(process_id, args), total=len(ids)))
 
+async def call_template_async(ids: list, template_type: str = 'tools', batch_size: int = MD_BATCH_SIZE,
+                              concurrency: int = ASYNC_CONCURRENCY, sink: PackageSink = None,
+                              profile: TemplateProfile = None) -> Tuple[dict, dict]:
+    """
+    Template the ids from a single process with asyncio, up to concurrency BaseX requests are in flight.
 
-"""
-mutithreading version
-avg time: <2.8s
-"""
-# def call_template_subprocess(ids: list, template_type: str = 'tools'):
-#     template_path = TOOLS_TEMPLATE if template_type == 'tools' else DATASETS_TEMPLATE
-#
-#     def process_id(current_id):
-#         try:
-#             logger.debug(f"Making a json file for INEO for {current_id} with template [{template_path}]...")
-#             templating(current_id, template_path, template_type)
-#         except Exception:
-#             logger.error(f"Cannot template the file: [{current_id}] with template: [{template_path}]")
-#             raise
-#
-#     with concurrent.futures.ThreadPoolExecutor() as executor:
-#         list(tqdm(executor.map(process_id, ids), total=len(ids)))
-
-
-def split_list(input_list, num_sublists):
-    sublist_length = len(input_list) // num_sublists
-    return [input_list[i:i + sublist_length] for i in range(0, len(input_list), sublist_length)]
-
-
-def call_template(ids: list, template_type: str = 'tools', workers: int = 12):
+    return (tuple): id -> error message for the ids which could not be templated, and the new template cache entries
+    """
+    template_path = TOOLS_TEMPLATE if template_type == 'tools' else DATASETS_TEMPLATE
+    plan = get_plan(template_path, template_type)
+    cache = get_cache(template_path, template_type)
+    init_ruc_cache()
+    blocks = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+
+    async with AsyncBaseXClient(concurrency=concurrency) as client:
+        with tqdm(total=len(ids)) as progress:
+            async def run_block(block: list) -> Tuple[dict, dict]:
+                # every block runs in its own task, so it has its own profile
+                block_profile = TemplateProfile() if profile is not None else None
+                profile_var.set(block_profile)
+                block_errors, block_entries, packages = await template_block_async(client, plan, block, cache)
+                emit_packages(sink, packages)
+                if profile is not None:
+                    profile.merge(block_profile.stats)
+                progress.update(len(block))
+                return block_errors, block_entries
+
+            results = await asyncio.gather(*(run_block(block) for block in blocks))
+
+    errors, entries = {}, {}
+    for block_errors, block_entries in results:
+        errors.update(block_errors)
+        entries.update(block_entries)
+    return errors, entries
+
+
+def call_template(ids: list, template_type: str = 'tools', workers: int = TEMPLATE_WORKERS,
+                  mode: str = "process", batch_size: int = MD_BATCH_SIZE,
+                  max_in_flight: int = None, sink: PackageSink = None) -> dict:
+    """
+    Template the ids with a pool of workers.
+
+    The ids are dispatched in blocks, every block is templated by a single worker (see template_block).
+    The number of BaseX requests running at the same time is bounded by max_in_flight over all workers.
+    The packages are emitted to the sink by this process, as the blocks are templated.
+    The manifest of the template cache is updated by this process, once all ids are templated.
+
+    ids (list): The ids to be templated
+    template_type (str): 'tools' or 'datasets'
+    workers (int): The number of workers, 1 templates the ids in this process
+    mode (str): 'process' for a pool of processes, 'thread' for a pool of threads,
+        'async' for asyncio in this process (workers is then ignored, max_in_flight bounds the requests)
+    batch_size (int): The maximum number of ids in a block
+    max_in_flight (int): The maximum number of BaseX requests running at the same time, by default
+        BASEX_MAX_IN_FLIGHT for the pools and ASYNC_CONCURRENCY for asyncio
+    sink (PackageSink): The sink of the packages (see package_sink.py), by default a file per package
+
+    return (dict): id -> error message, for the ids which could not be templated
+    """
     if len(ids) <= 0:
         logger.info(f"No IDs found for {template_type}. ids list contains {len(ids)} ids.")
-        return
+        return {}
 
-    logger.debug(f"Templating for {len(ids)} {template_type} ...")
+    logger.debug(f"Templating for {len(ids)} {template_type} with {workers} workers ...")
     logger.debug(f"first 5 ids: {ids[:5]} ...")
-    call_template_subprocess(ids, template_type)
+    template_path = TOOLS_TEMPLATE if template_type == 'tools' else DATASETS_TEMPLATE
+    if USE_MD_INDEX or USE_TEMPLATE_CACHE:
+        # loaded before a pool is started, so the (forked) workers share it
+        get_md_index(template_type)
+    cache = get_cache(template_path, template_type)
+    if sink is None:
+        sink = DirectorySink()
+    profile = TemplateProfile() if PROFILE_TEMPLATING else None
+
+    if mode == "async":
+        errors, entries = asyncio.run(
+            call_template_async(ids, template_type, batch_size, max_in_flight or ASYNC_CONCURRENCY, sink, profile))
+    elif workers <= 1:
+        errors, entries = call_template_subprocess(ids, template_type, batch_size, sink, profile)
+    else:
+        max_in_flight = max_in_flight or BASEX_MAX_IN_FLIGHT
+        # smaller blocks for small lists, so that all workers get work
+        block_size = max(1, min(batch_size, -(-len(ids) // workers)))
+        blocks = [ids[i:i + block_size] for i in range(0, len(ids), block_size)]
+
+        if mode == "process":
+            executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_template_worker,
+                initargs=(template_path, template_type, max(1, max_in_flight // workers)))
+        elif mode == "thread":
+            # the threads share the plan, the RUC listing and the client (with its bound) of this process
+            _init_template_worker(template_path, template_type, max_in_flight)
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        else:
+            raise ValueError(f"Invalid mode {mode}; Valid modes are 'process', 'thread' and 'async'")
+
+        errors, entries = {}, {}
+        with executor, tqdm(total=len(ids)) as progress:
+            futures = {executor.submit(template_block, block, template_path, template_type, PROFILE_TEMPLATING): block
+                       for block in blocks}
+            for future in concurrent.futures.as_completed(futures):
+                block = futures[future]
+                try:
+                    block_errors, block_entries, packages, stats = future.result()
+                    emit_packages(sink, packages)
+                    if profile is not None:
+                        profile.merge(stats)
+                    errors.update(block_errors)
+                    entries.update(block_entries)
+                except Exception as ex:
+                    # e.g. a worker died, all ids of the block are reported
+                    logger.error(f"Cannot template a block of {len(block)} ids: {ex}")
+                    errors.update({current_id: f"{type(ex).__name__}: {ex}" for current_id in block})
+                progress.update(len(block))
+
+    if cache is not None:
+        cache.update(entries)
+        cache.save()
+        logger.info(f"Templated {len(entries)} of {len(ids)} {template_type}, the others are restored from the "
+                    f"template cache or failed")
+    if profile is not None:
+        logger.info(f"The profile of the templating is saved in {profile.save(template_type)}")
+    if errors:
+        logger.error(f"{len(errors)} of {len(ids)} {template_type} could not be templated: {list(errors)[:10]} ...")
+    return errors
 
 
 def call_ineo_sync(record_type: str, limit: int = 0):
@@ -203,21 +397,20 @@ def call_ineo_sync(record_type: str, limit: int = 0):
 
 def prepare_basex_tables(table_name: str,
                          folder: str,
-                         host: str = "basex",
-                         port: int = 8080,
-                         user: str = "admin",
-                         password: str = "pass",
-                         action: str = "post") -> None:
+                         client: BaseXClient = None) -> None:
     """
     This function prepares the basex tables for the tools and datasets
+    The text and attribute indexes are built, the queries look up a record by its id with db:text instead of
+    scanning every record. MAXLEN is raised so that also the longest ids (see harvester.id_limit) are indexed.
 
     table_name (str): The name of the table to be created
     folder (str): The folder containing the json files to be inserted into the basex table
+    client (BaseXClient): The client to be used, by default the client of this process
 
     return (None)
     """
     logger.info(f"Preparing basex table {table_name} with folder {folder} ...")
-    content_type: str = "application/xml"
+    client = client or get_basex_client()
 
     content = """
     <query>
@@ -231,15 +424,19 @@ def prepare_basex_tables(table_name: str,
       map {{
         "createfilter": "*.json",
         "parser": "json",
-        "jsonparser": "format=basic,liberal=yes,encoding=UTF-8"
+        "jsonparser": "format=basic,liberal=yes,encoding=UTF-8",
+        "textindex": true(),
+        "attrindex": true(),
+        "maxlen": {maxlen}
       }}
     )
     ]]></text>
     </query>
-    """.format(table_name=table_name, folder=folder)
+    """.format(table_name=table_name, folder=folder, maxlen=BASEX_INDEX_MAXLEN)
 
     # Create the basex table
-    response = call_basex(content, host, port, user, password, action, content_type=content_type)
+    # creating the table takes a while for large folders
+    response = client.call(content, timeout=(client.timeout[0], 3600))
     if 199 < response.status_code < 300:
         logger.info(f"Basex table {table_name} created with folder {folder} ...")
     else:
@@ -263,42 +460,82 @@ def _init_basex():
     prepare_basex_tables(datasets_table_name, datasets_folder)
 
 
-def move_old_files(old_folder: str, new_folder: str):
+def move_old_files(snapshot_name: str, paths: list[str]):
     """
-    Move all files under old_folder to new_folder, keeping the old_folder itself intact.
+    Take a snapshot of the files under the paths (see snapshot_store) and remove them, keeping the folders themselves
+    intact. Only the files directly in a folder are removed, not those in its subfolders.
     """
-    # Ensure the new_folder exists
-    if not os.path.exists(new_folder):
-        os.makedirs(new_folder)
+    get_snapshot_store().snapshot(snapshot_name, paths)
 
-    # Iterate over all files and directories in old_folder
-    for item in os.listdir(old_folder):
-        old_path = os.path.join(old_folder, item)
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(path)
+        elif os.path.isdir(path):
+            # Remove only files, not directories
+            for item in os.listdir(path):
+                old_path = os.path.join(path, item)
+                if os.path.isfile(old_path):
+                    os.remove(old_path)
 
-        # Move only files, not directories
-        if os.path.isfile(old_path):
-            new_path = os.path.join(new_folder, item)
-            if os.path.isfile(new_path):
-                os.remove(new_path)
-            shutil.move(old_path, new_folder)
+
+def get_package_sink() -> PackageSink:
+    """
+    The sink of the templated packages, see PACKAGE_SINK and WRITE_PROCESSED_FILES
+    """
+    if PACKAGE_SINK == "directory":
+        return DirectorySink()
+    if PACKAGE_SINK != "spool":
+        raise ValueError(f"Invalid package sink {PACKAGE_SINK}; Valid sinks are 'spool' and 'directory'")
+    if WRITE_PROCESSED_FILES:
+        return TeeSink([JsonlSpoolSink(), DirectorySink()])
+    return JsonlSpoolSink()
 
 
-def template_tools(ineo_records: list, processed_folder: str, backup_folder: str, template: str) -> None:
+def template_and_sync(ids: list, record_type: str = "tools", limit: int = 0, concurrency: int = 1) -> dict:
     """
-    This function creates ineo package using corresponding template for tools and datasets
+    Template the ids and sync the packages with INEO at the same time: the packages are passed to ineo_sync over an
+    in-process queue and sent in batches as they come in, nothing is written to the processed folders.
+
+    ids (list): The ids to be templated
+    record_type (str): 'tools' or 'datasets'
+    limit (int): The maximum number of packages to sync, 0 for all
+    concurrency (int): The number of batches sent to INEO at the same time, see ineo_sync.sync_with_ineo
+
+    return (dict): id -> error message, for the ids which could not be templated
+    """
+    # not bounded, the templating must not wait for a sync which stopped at the limit
+    sink = QueueSink()
+    folder = ineo_sync.get_processed_files_folder_from_type(record_type)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        synced = executor.submit(ineo_sync.sync_with_ineo, record_type, limit, concurrency,
+                                 packages=sink.packages(folder))
+        try:
+            errors = call_template(ids, record_type, sink=sink)
+        finally:
+            sink.close()
+        synced.result()
+    return errors
+
+
+def template_tools(ineo_records: list, processed_folder: str, template: str) -> None:
+    """
+    This function creates ineo package using corresponding template for tools and datasets.
+    The packages of the previous run are kept in the snapshot processed_<template> (see move_old_files).
 
     ineo_records (list): The list of records to be templated
     processed_folder (str): The folder to store the processed files
-    backup_folder (str): The folder to store the backup files
     template (str): The type of template to be used
 
     return (None)
     """
     logger.info(f"Making template(s) for {len(ineo_records)} records ...")
-    # move older files to backup folder
-    move_old_files(processed_folder, backup_folder)
+    # move older files, and the spool of the previous run (the packages are appended to it), to a snapshot
+    move_old_files(f"processed_{template}", [processed_folder, spool_path(processed_folder)])
     # call template function
-    call_template(ineo_records, template)
+    with get_package_sink() as sink:
+        errors = call_template(ineo_records, template, sink=sink)
+    if errors:
+        logger.warning(f"Templated {len(ineo_records) - len(errors)} of {len(ineo_records)} records ...")
 
 
 def move_files_to_subfolders(folder_path: str, max_files_per_subfolder: int = 200):
@@ -355,9 +592,9 @@ def main():
         logger.info("No new updates in the JSONL files of RUC, Codemeta, and Datasets")
     else:
         if len(tools_to_INEO) > 0:
-            template_tools(tools_to_INEO, "./processed_jsonfiles_tools", "./processed_jsonfiles_tools_backup", "tools")
+            template_tools(tools_to_INEO, "./processed_jsonfiles_tools", "tools")
         if len(datasets_to_INEO) > 0:
-            template_tools(datasets_to_INEO, "./processed_jsonfiles_datasets", "./processed_jsonfiles_datasets_backup", "datasets")
+            template_tools(datasets_to_INEO, "./processed_jsonfiles_datasets", "datasets")
 
         logger.info("Done preparation. Going to sync with INEO ...")
         print("Done preparation. Going to sync with INEO ...")
@@ -383,67 +620,36 @@ def main():
         # Define the maximum number of runs to keep backups of the c3 JSONL file
         max_backup_runs = 3
 
-        # Create the main backup folder if it doesn't exist
-        main_backup_folder = "./backups"
-        os.makedirs(main_backup_folder, exist_ok=True)
-
-        # Create a list to store backup timestamps
-        backup_timestamps = []
-
-        # Generate a timestamp for the backup folder name
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        backup_folder = os.path.join(main_backup_folder, f"backup_{timestamp}")
-
-        # Backup the processed_jsonfiles folder
-        shutil.copytree("processed_jsonfiles_tools", os.path.join(backup_folder, "processed_json_templates"))
-
-        # Backup the rich_user_contents folder
-        shutil.copytree("./data/rich_user_contents", os.path.join(backup_folder, "rich_user_contents_json"))
-
-        # Create a folder for jsonl_files
-        jsonl_files_folder = os.path.join(backup_folder, "jsonl_files")
-        os.makedirs(jsonl_files_folder, exist_ok=True)
-
-        # Backup individual files within jsonl_files folder
-        shutil.copy("./data/c3.jsonl", os.path.join(jsonl_files_folder, "c3.jsonl"))
-        shutil.copy("./data/codemeta.jsonl", os.path.join(jsonl_files_folder, "codemeta.jsonl"))
-
-        # Copy the tools_metadata_backup folder to the backup folder
-        shutil.copytree("./data/tools_metadata_backup", os.path.join(backup_folder, "tools_metadata_backup"))
-
-        # Check if the deleted_documents folder exists and back it up if present. Then delete it. 
+        # Snapshot the processed packages (the spools, and the files if written, see PACKAGE_SINK), the rich user
+        # contents, the jsonl files and the documents to be deleted; only the files which changed since the previous
+        # run are stored. The tools metadata are in the snapshot taken by the harvester, see
+        # harvester.backup_json_files
         deleted_documents_path = "./deleted_documents"
-        if os.path.exists(deleted_documents_path) and os.path.isdir(deleted_documents_path):
-            shutil.copytree(deleted_documents_path, os.path.join(backup_folder, "deleted_documents_backup"))
+        processed_folders = ["./processed_jsonfiles_tools", "./processed_jsonfiles_datasets"]
+        get_snapshot_store().snapshot("run", processed_folders + [SPOOL_FOLDER, "./data/rich_user_contents",
+                                                                  "./data/c3.jsonl", "./data/codemeta.jsonl",
+                                                                  deleted_documents_path],
+                                      keep_runs=max_backup_runs)
 
         logger.info("backups created, clearing folders for the next run...")
 
-        # Clear the processed_jsonfiles folder
-        shutil.rmtree("processed_jsonfiles")
-        shutil.rmtree(deleted_documents_path)
+        # Clear the processed packages
+        for folder in processed_folders + [SPOOL_FOLDER]:
+            shutil.rmtree(folder, ignore_errors=True)
+        if os.path.isdir(deleted_documents_path):
+            shutil.rmtree(deleted_documents_path)
 
         for item in os.listdir("./data"):
             # the database cannot be deleted because it needs to get track of the inactive tools and md5 comparison.
-            # Implement way to delete old entries (e.g. > 3 runs) in the databases.
-            if item != "ineo.db":
+            # Old entries are removed by the harvester, see change_store.ChangeStore.compact
+            # (the write-ahead log of the database, ineo.db-wal, is kept as well)
+            if not item.startswith("ineo.db"):
                 item_path = os.path.join("./data", item)
                 if os.path.isfile(item_path):
                     os.remove(item_path)
                 elif os.path.isdir(item_path):
                     shutil.rmtree(item_path)
 
-        # Add the current timestamp to the list
-        backup_timestamps.append(timestamp)
-
-        # Check if there are more than max_backup_runs backups
-        if len(backup_timestamps) > max_backup_runs:
-            # Sort the list and remove the oldest backup
-            backup_timestamps.sort()
-            oldest_backup = backup_timestamps.pop(0)
-            oldest_backup_path = os.path.join(main_backup_folder, f"backup_{oldest_backup}")
-
-            shutil.rmtree(oldest_backup_path)
-
     logger.info("All done!")
 
 
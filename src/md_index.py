@@ -0,0 +1,225 @@
+import argparse
+import json
+import logging
+import math
+import os
+from decimal import Decimal
+from typing import Optional
+
+from utils import get_logger, get_basex_client
+from query_registry import query_registry
+from template_compiler import get_dbname, get_id_key, compile_template, fallback_query_key
+
+logger = get_logger("template.log", __name__, level=logging.WARNING)
+
+"""
+An in-memory index of the harvested metadata, to evaluate the plain field lookups of the templates (e.g. "md:subject")
+in process instead of with a fallback query on BaseX.
+
+The index is loaded from the same folders the BaseX databases are created from (see main._init_basex) and mimics
+the fallback query (template_compiler.fallback_query):
+
+    for $i in db:text($DB, $ID)/parent::js:string[@key='identifier']/parent::js:map[parent::document-node()]
+    return xml-to-json($i/js:*[@key='{path}'][1])
+
+- only records (json files) with a top-level object and a string id are found
+- the first occurrence of a key is used, also when the key is repeated in the json file
+- the value is serialized as xml-to-json does, numbers are converted to xs:double
+
+Ids the index cannot answer exactly (the id is in more than one record, or a file could not be parsed) are left to
+BaseX. Run this module to check the parity with BaseX, the responses must be identical byte for byte:
+
+    python md_index.py tools --limit 1000
+
+checks/md_index_fixtures.py checks the lookups offline, against the responses in its fixtures.
+"""
+
+# the folders the basex databases are created from, as seen by this container
+METADATA_FOLDERS = {
+    "tools": "./data/tools_metadata",
+    "datasets": "./data/parsed_datasets",
+}
+
+
+def first_key_object(pairs: list) -> dict:
+    """
+    object_pairs_hook keeping the first value of a repeated key, like $i/js:*[@key=...][1]
+    """
+    result = {}
+    for key, value in pairs:
+        result.setdefault(key, value)
+    return result
+
+
+def xs_double_string(value: float) -> str:
+    """
+    The canonical string of an xs:double, e.g. 2.0 -> "2", 0.5 -> "0.5", 1e7 -> "1.0E7"
+    """
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "INF" if value > 0 else "-INF"
+    if value == 0:
+        return "-0" if math.copysign(1, value) < 0 else "0"
+
+    number = Decimal(repr(value))
+    if 1e-6 <= abs(value) < 1e6:
+        text = format(number, "f")
+        if "." in text:
+            text = text.rstrip("0").rstrip(".")
+        return text
+
+    sign, digits, exponent = number.normalize().as_tuple()
+    digits = "".join(map(str, digits))
+    exponent += len(digits) - 1
+    return f"{'-' if sign else ''}{digits[0]}.{digits[1:] or '0'}E{exponent}"
+
+
+JSON_ESCAPES = {'"': '\\"', "\\": "\\\\", "/": "\\/", "\b": "\\b", "\f": "\\f", "\n": "\\n", "\r": "\\r",
+                "\t": "\\t"}
+
+
+def json_string(text: str) -> str:
+    escaped = []
+    for char in text:
+        if char in JSON_ESCAPES:
+            escaped.append(JSON_ESCAPES[char])
+        elif ord(char) < 0x20 or 0x7F <= ord(char) <= 0x9F:
+            escaped.append(f"\\u{ord(char):04X}")
+        else:
+            escaped.append(char)
+    return f'"{"".join(escaped)}"'
+
+
+def xml_to_json(value) -> str:
+    """
+    Serialize a value loaded from json as xml-to-json serializes its (basic format) xml representation
+    """
+    if isinstance(value, str):
+        return json_string(value)
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return xs_double_string(float(value))
+    if isinstance(value, list):
+        return f"[{','.join(xml_to_json(item) for item in value)}]"
+    if isinstance(value, dict):
+        return f"{{{','.join(f'{json_string(key)}:{xml_to_json(item)}' for key, item in value.items())}}}"
+    raise TypeError(f"Invalid json value type {type(value)}")
+
+
+class MetadataIndex:
+    """
+    folder (str): the folder with the json files, searched recursively like db:create does
+    id_key (str): the key of the id in the records, "identifier" for tools and "id" for datasets
+    """
+
+    def __init__(self, folder: str, id_key: str):
+        self.folder = folder
+        self.id_key = id_key
+        self.records = {}
+        # id -> the files of the record(s), e.g. to hash the inputs of the templating
+        self.paths = {}
+        # ids found in more than one record, BaseX returns all of them
+        self.duplicates = set()
+        # False if a file could not be parsed, BaseX (with its liberal parser) may still know its id
+        self.complete = True
+
+    def load(self) -> "MetadataIndex":
+        for root, _, file_names in os.walk(self.folder):
+            for file_name in file_names:
+                if not file_name.endswith(".json"):
+                    continue
+                file_path = os.path.join(root, file_name)
+                try:
+                    with open(file_path, "r", encoding="utf-8") as file:
+                        record = json.load(file, object_pairs_hook=first_key_object)
+                except (ValueError, UnicodeDecodeError) as ex:
+                    logger.warning(f"Cannot index {file_path}, its ids are left to BaseX: {ex}")
+                    self.complete = False
+                    continue
+
+                current_id = record.get(self.id_key) if isinstance(record, dict) else None
+                if not isinstance(current_id, str):
+                    continue
+                if current_id in self.records:
+                    self.duplicates.add(current_id)
+                self.records[current_id] = record
+                self.paths.setdefault(current_id, []).append(file_path)
+        logger.info(f"Indexed {len(self.records)} records of {self.folder}")
+        return self
+
+    def lookup(self, current_id: str, path: str) -> Optional[str]:
+        """
+        The response text of the fallback query for the path, or None if the index cannot answer it
+        """
+        if current_id in self.duplicates:
+            return None
+        record = self.records.get(current_id)
+        if record is None:
+            return "" if self.complete else None
+        if path not in record:
+            return ""
+        return xml_to_json(record[path])
+
+
+# the indexes of this process, see get_md_index
+md_indexes = {}
+
+
+def get_md_index(template_type: str) -> MetadataIndex:
+    """
+    Get the index of the template type, it is loaded on first use.
+    Loading it before starting a pool of processes shares it with the workers.
+    """
+    if template_type not in md_indexes:
+        md_indexes[template_type] = MetadataIndex(METADATA_FOLDERS[template_type], get_id_key(template_type)).load()
+    return md_indexes[template_type]
+
+
+def check_parity(template_type: str, template_path: str, limit: int = 0) -> list[dict]:
+    """
+    Compare the in-process lookups with the fallback queries on BaseX, for every plain field of the template.
+
+    return (list[dict]): the differences, empty if the index gives the same responses as BaseX, byte for byte
+    """
+    plan = compile_template(template_path, template_type)
+    fields = sorted(plan.fields)
+    index = get_md_index(template_type)
+    dbname = get_dbname(template_type)
+    client = get_basex_client()
+
+    ids = sorted(index.records)
+    if limit > 0:
+        ids = ids[:limit]
+    differences = []
+    for field in fields:
+        query = query_registry.get(fallback_query_key(field, template_type))
+        for current_id in ids:
+            local = index.lookup(current_id, field)
+            if local is None:
+                continue
+            response = client.query(query, dbname, {"DB": dbname, "ID": current_id})
+            if response.status_code != 200 or local != response.text:
+                differences.append({"id": current_id, "field": field, "index": local, "basex": response.text})
+    logger.info(f"{len(differences)} differences for {len(ids)} {template_type} and the fields {fields}")
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the parity of the in-process lookups with BaseX")
+    parser.add_argument("template_type", choices=["tools", "datasets"])
+    parser.add_argument("--limit", type=int, default=0, help="the number of ids to check, 0 for all")
+    args = parser.parse_args()
+
+    template_path = "./template_tools.json" if args.template_type == "tools" else "./template_datasets.json"
+    differences = check_parity(args.template_type, template_path, args.limit)
+    for difference in differences:
+        print(json.dumps(difference))
+    exit(1 if differences else 0)
+
+
+if __name__ == "__main__":
+    main()
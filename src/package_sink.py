@@ -0,0 +1,176 @@
+import json
+import logging
+import os
+import queue
+from typing import Iterable, Iterator, Optional
+
+from utils import get_logger, get_files
+
+logger = get_logger("template.log", __name__, level=logging.WARNING)
+
+"""
+The sinks the templated INEO packages are emitted to, and the readers ineo_sync.py consumes them with.
+
+- DirectorySink: a pretty-printed <id>_processed.json file per package, e.g. for debugging
+- JsonlSpoolSink: a package per line, appended to a spool file per processed folder
+- QueueSink: the packages are put on an in-process queue, to be synced while the ids are still being templated
+
+The packages are emitted by the process calling main.call_template, also when the ids are templated by a pool of
+workers, so a sink is only written to by a single process.
+"""
+
+# the folder with the spool files, one per processed folder, e.g. ./processed_spool/processed_jsonfiles_tools.jsonl
+SPOOL_FOLDER = "./processed_spool"
+
+
+def spool_path(folder: str, spool_folder: str = SPOOL_FOLDER) -> str:
+    """
+    The spool file of a processed folder, e.g. "./processed_jsonfiles_tools"
+    """
+    return os.path.join(spool_folder, f"{os.path.basename(os.path.normpath(folder))}.jsonl")
+
+
+class PackageSink:
+    """
+    The interface of the sinks, a sink is closed when all ids are templated.
+    """
+
+    def emit(self, current_id: str, folder: str, package: list) -> None:
+        """
+        current_id (str): the templated id
+        folder (str): the processed folder of the package, e.g. "processed_jsonfiles_tools"
+        package (list): the INEO package, a list with a single document
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "PackageSink":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+class DirectorySink(PackageSink):
+    """
+    Write a file per package, <folder>/<id>_processed.json
+    """
+
+    def emit(self, current_id: str, folder: str, package: list) -> None:
+        os.makedirs(folder, exist_ok=True)
+        filename = os.path.join(folder, f"{current_id}_processed.json")
+        with open(filename, "w") as file:
+            json.dump(package, file, indent=2)
+        logger.info(f"JSON files saved successfully. {filename}")
+
+
+class JsonlSpoolSink(PackageSink):
+    """
+    Append a line per package to the spool file of its folder, see spool_path.
+    The spool files are kept open until the sink is closed.
+    """
+
+    def __init__(self, spool_folder: str = SPOOL_FOLDER):
+        self.spool_folder = spool_folder
+        self.files = {}
+
+    def emit(self, current_id: str, folder: str, package: list) -> None:
+        if folder not in self.files:
+            os.makedirs(self.spool_folder, exist_ok=True)
+            self.files[folder] = open(spool_path(folder, self.spool_folder), "a")
+        self.files[folder].write(json.dumps(package))
+        self.files[folder].write("\n")
+
+    def close(self) -> None:
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+
+
+class QueueSink(PackageSink):
+    """
+    Put (id, folder, package) on a queue, None is put on it when the sink is closed.
+    With maxsize the templating waits for the consumer when it is behind.
+    """
+
+    def __init__(self, maxsize: int = 0):
+        self.queue = queue.Queue(maxsize)
+
+    def emit(self, current_id: str, folder: str, package: list) -> None:
+        self.queue.put((current_id, folder, package))
+
+    def close(self) -> None:
+        self.queue.put(None)
+
+    def packages(self, folder: Optional[str] = None) -> Iterator[list]:
+        """
+        The packages put on the queue until the sink is closed, only those of the folder if given
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if folder is None or os.path.normpath(item[1]) == os.path.normpath(folder):
+                yield item[2]
+
+
+class TeeSink(PackageSink):
+    """
+    Emit the packages to all sinks, e.g. to a spool and to a directory for debugging
+    """
+
+    def __init__(self, sinks: list[PackageSink]):
+        self.sinks = sinks
+
+    def emit(self, current_id: str, folder: str, package: list) -> None:
+        for sink in self.sinks:
+            sink.emit(current_id, folder, package)
+
+    def close(self) -> None:
+        for sink in self.sinks:
+            sink.close()
+
+
+def read_spool(folder: str, spool_folder: str = SPOOL_FOLDER) -> Iterator[list]:
+    """
+    The packages in the spool file of the folder, in the order they were emitted
+    """
+    with open(spool_path(folder, spool_folder), "r") as spool_file:
+        for line_number, line in enumerate(spool_file, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as ex:
+                # e.g. the last line of a run which was interrupted
+                logger.error(f"Cannot read line {line_number} of the spool of {folder}: {ex}")
+
+
+def read_directory(folder: str) -> Iterator[list]:
+    """
+    The packages in the <id>_processed.json files of the folder
+    """
+    for file_path in get_files(folder) or []:
+        with open(file_path, "r") as json_file:
+            try:
+                package = json.load(json_file)
+            except json.JSONDecodeError as ex:
+                logger.error(f"Error reading processed JSON from file {file_path}: {ex}")
+                continue
+        yield package
+
+
+def batches(packages: Iterable[list], size: int) -> Iterator[list[list]]:
+    """
+    The packages in lists of (at most) size packages
+    """
+    batch = []
+    for package in packages:
+        batch.append(package)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,99 @@
+import glob
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from utils import get_logger, build_batch_query
+
+logger = get_logger("template.log", __name__, level=logging.WARNING)
+
+"""
+A registry of the XQuery files used by the templates (queries/*.xq for tools and dsqueries/*.xq for datasets).
+
+Every query is read from disk once and kept in memory, together with its batch form (see utils.build_batch_query).
+The queries bind the id (and database) as external variables, so the text of a query is the same for every record.
+A file is read again when its modification time changes, the modification time is checked at most once per
+check_interval seconds.
+"""
+
+QUERY_FOLDERS = ("queries", "dsqueries")
+
+
+class QueryRegistry:
+    """
+    folders (tuple): the folders with the .xq files to be loaded
+    check_interval (float): the minimum number of seconds between two checks of the modification time of a file
+    """
+
+    def __init__(self, folders: tuple = QUERY_FOLDERS, check_interval: float = 1.0):
+        self.folders = folders
+        self.check_interval = check_interval
+        # key -> {"path": str | None, "mtime": float, "checked": float, "query": str, "batch": str | None}
+        self._queries = {}
+        self._lock = threading.Lock()
+
+    def load_all(self) -> None:
+        """
+        Load every .xq file in the folders of the registry.
+        """
+        for folder in self.folders:
+            for path in sorted(glob.glob(os.path.join(folder, "*.xq"))):
+                self.get(path)
+
+    def register(self, key: str, query: str) -> str:
+        """
+        Register a query which is not a file, e.g. the fallback query of a template.
+        """
+        with self._lock:
+            self._queries[key] = {"path": None, "mtime": 0, "checked": 0, "query": query, "batch": None}
+        return key
+
+    def _entry(self, key: str) -> dict:
+        entry = self._queries.get(key)
+        if entry is not None and entry["path"] is None:
+            return entry
+
+        now = time.monotonic()
+        if entry is not None and now - entry["checked"] < self.check_interval:
+            return entry
+
+        with self._lock:
+            mtime = os.stat(key).st_mtime
+            entry = self._queries.get(key)
+            if entry is None or entry["mtime"] != mtime:
+                logger.debug(f"Loading query {key}")
+                with open(key, "r") as file:
+                    query = file.read()
+                entry = {"path": key, "mtime": mtime, "checked": now, "query": query, "batch": None}
+                self._queries[key] = entry
+            else:
+                entry["checked"] = now
+        return entry
+
+    def get(self, key: str) -> str:
+        """
+        Get the query of a file (e.g. "queries/author.xq") or of a registered key.
+        """
+        return self._entry(key)["query"]
+
+    def get_batch(self, key: str) -> str:
+        """
+        Get the batch form of the query, evaluated for a block of ids bound to $IDS.
+        """
+        entry = self._entry(key)
+        if entry["batch"] is None:
+            entry["batch"] = build_batch_query(entry["query"])
+        return entry["batch"]
+
+    def mtime(self, key: str) -> Optional[float]:
+        """
+        The modification time of the file of the query, None for registered queries.
+        """
+        entry = self._entry(key)
+        return entry["mtime"] if entry["path"] is not None else None
+
+
+# the registry of this process
+query_registry = QueryRegistry()
@@ -1,6 +1,7 @@
 import json
 import os
 from utils import get_logger, get_files, get_id_from_file_name
+from package_sink import spool_path, read_spool
 
 logger = get_logger(__name__, "reduce_id.log")
 
@@ -44,6 +45,10 @@ def reduce_id(input_path: str = input_path, id_limit: int = id_limit):
 
     return: None
     """
+    if os.path.exists(spool_path(input_path)):
+        # the processed packages are in a spool instead of a file per package, see package_sink.py
+        reduce_spool_ids(input_path, id_limit)
+        return
     files = get_files(input_path)
     print(f"### checking length of {len(files)} files in {input_path} ###")
     logger.info(f"### checking length of {len(files)} files in {input_path} ###")
@@ -80,6 +85,39 @@ def reduce_id(input_path: str = input_path, id_limit: int = id_limit):
         logger.info(f"### {counter} files have id length > {id_limit}")
 
 
+def reduce_spool_ids(input_path: str, id_limit: int = id_limit) -> int:
+    """
+    This function reduces the id length of the packages in the spool of the processed folder (see
+    package_sink.spool_path), the spool is rewritten if an id is reduced
+
+    input_path (str): The processed folder of the spool, e.g. "processed_jsonfiles_datasets"
+    id_limit (int): The limit of the id length
+
+    return (int): the number of reduced ids
+    """
+    packages = list(read_spool(input_path))
+    logger.info(f"### checking length of {len(packages)} packages in the spool of {input_path} ###")
+    counter: int = 0
+    for package in packages:
+        current_id: str = package[0]["document"]["id"]
+        if len(current_id) > id_limit:
+            counter += 1
+            logger.info(f"### {current_id} has id length {len(current_id)} > {id_limit}")
+            # new id is the last 128 characters of the current id
+            package[0]["document"]["id"] = current_id[-id_limit:]
+
+    if counter > 0:
+        file_path = spool_path(input_path)
+        with open(f"{file_path}.tmp", "w") as f:
+            for package in packages:
+                f.write(json.dumps(package))
+                f.write("\n")
+        os.replace(f"{file_path}.tmp", file_path)
+        print(f"### {counter} packages have id length > {id_limit}")
+        logger.info(f"### {counter} packages have id length > {id_limit}")
+    return counter
+
+
 if __name__ == "__main__":
     reduce_id("processed_jsonfiles_datasets")
     # test = get_id_field([{"document": {"id": "1234"}}], [0, "document", "id"])
@@ -0,0 +1,213 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+from datetime import datetime
+from typing import Optional
+
+from utils import get_logger
+
+logger = get_logger("snapshot.log", __name__, level=logging.INFO)
+
+"""
+A content-addressed store of the backups of the harvested files and the outputs of a run.
+
+A snapshot is a manifest of the files under the given paths, per file its digest (sha256), size and modification
+time. The content of every file is stored once, compressed, under its digest in the objects folder, so a snapshot
+only adds the files which changed since the previous one. A file with the same size and modification time as in the
+previous snapshot of the same name is not even read again, its digest is taken from the previous manifest.
+
+The snapshots are kept per name (e.g. "tools_metadata") for the last SNAPSHOT_RUNS runs, the objects no snapshot
+refers to anymore are removed. A snapshot is restored into a folder with restore.
+"""
+
+SNAPSHOT_FOLDER = "./snapshots"
+# number of snapshots kept per name
+SNAPSHOT_RUNS = 3
+
+
+def hash_path(file_path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def relative_path(file_path: str, root: str) -> str:
+    """
+    The path of the file relative to the root, as stored in a manifest; ValueError if the file is not under the root
+    """
+    path = os.path.relpath(os.path.abspath(file_path), os.path.abspath(root))
+    if path == os.pardir or path.startswith(os.pardir + os.sep):
+        raise ValueError(f"{file_path} is not under the root {root} of the snapshot")
+    return path
+
+
+def list_files(paths: list[str]) -> list[str]:
+    """
+    The files under the paths, a path is a file or a folder; paths which do not exist are skipped
+    """
+    files = []
+    for path in paths:
+        if os.path.isfile(path):
+            files.append(os.path.normpath(path))
+        elif os.path.isdir(path):
+            for folder, _, file_names in os.walk(path):
+                files.extend(os.path.normpath(os.path.join(folder, file_name)) for file_name in file_names)
+    return sorted(files)
+
+
+class SnapshotStore:
+    """
+    folder (str): the folder of the store, with the objects and a manifests folder per name
+    """
+
+    def __init__(self, folder: str = SNAPSHOT_FOLDER):
+        self.folder = folder
+        self.objects_folder = os.path.join(folder, "objects")
+        self.manifests_folder = os.path.join(folder, "manifests")
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_folder, digest[:2], f"{digest}.gz")
+
+    def manifest_path(self, name: str, run: str) -> str:
+        return os.path.join(self.manifests_folder, name, f"{run}.json")
+
+    def runs(self, name: str) -> list[str]:
+        """
+        The runs of the snapshots of the name, the oldest first
+        """
+        folder = os.path.join(self.manifests_folder, name)
+        if not os.path.isdir(folder):
+            return []
+        return sorted(file_name[:-len(".json")] for file_name in os.listdir(folder) if file_name.endswith(".json"))
+
+    def load_manifest(self, name: str, run: Optional[str] = None) -> Optional[dict]:
+        """
+        The manifest of the snapshot of the run, of the latest run if not given; None if there is no snapshot
+        """
+        runs = self.runs(name)
+        if run is None:
+            run = runs[-1] if runs else None
+        if run is None or run not in runs:
+            return None
+        with open(self.manifest_path(name, run), "r") as manifest_file:
+            return json.load(manifest_file)
+
+    def store_object(self, file_path: str, digest: str) -> int:
+        """
+        Store the content of the file under its digest, if it is not stored yet
+
+        return (int): the number of bytes written
+        """
+        object_path = self.object_path(digest)
+        if os.path.exists(object_path):
+            return 0
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        temp_path = f"{object_path}.{os.getpid()}.tmp"
+        with open(file_path, "rb") as file, gzip.open(temp_path, "wb") as object_file:
+            shutil.copyfileobj(file, object_file)
+        os.replace(temp_path, object_path)
+        return os.path.getsize(object_path)
+
+    def snapshot(self, name: str, paths: list[str], run: Optional[str] = None, keep_runs: int = SNAPSHOT_RUNS,
+                 root: str = ".") -> dict:
+        """
+        Take a snapshot of the files under the paths, and remove the snapshots of the name before the last keep_runs.
+
+        name (str): the name of the snapshot, e.g. "tools_metadata"
+        paths (list): the files and folders, under the root
+        run (str): the run, the current time (%Y%m%d%H%M%S) if not given; a snapshot of the same run is replaced
+        root (str): the root of the snapshot, the working directory by default; the paths of the files are stored
+            relative to it, as they are restored relative to the target folder
+
+        return (dict): the manifest, {"name", "run", "files": {path: [digest, size, mtime_ns]}}
+        """
+        run = run or datetime.now().strftime("%Y%m%d%H%M%S")
+        previous = (self.load_manifest(name) or {}).get("files", {})
+        files = {}
+        read = written = 0
+        for file_path in list_files(paths):
+            stat = os.stat(file_path)
+            path = relative_path(file_path, root)
+            entry = previous.get(path)
+            if entry is not None and entry[1] == stat.st_size and entry[2] == stat.st_mtime_ns \
+                    and os.path.exists(self.object_path(entry[0])):
+                digest = entry[0]
+            else:
+                digest = hash_path(file_path)
+                read += 1
+                written += self.store_object(file_path, digest)
+            files[path] = [digest, stat.st_size, stat.st_mtime_ns]
+
+        manifest = {"name": name, "run": run, "files": files}
+        manifest_path = self.manifest_path(name, run)
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        temp_path = f"{manifest_path}.tmp"
+        with open(temp_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(temp_path, manifest_path)
+        logger.info(f"Snapshot {name} {run}: {len(files)} files, {read} read, {written} bytes written")
+
+        self.prune(name, keep_runs)
+        return manifest
+
+    def prune(self, name: str, keep_runs: int = SNAPSHOT_RUNS) -> None:
+        """
+        Remove the snapshots of the name before the last keep_runs, and the objects no snapshot refers to anymore
+        """
+        runs = self.runs(name)
+        if len(runs) <= keep_runs:
+            return
+        for run in runs[:len(runs) - keep_runs]:
+            os.remove(self.manifest_path(name, run))
+
+        # the objects of all names share the folder
+        digests = set()
+        for manifest_name in os.listdir(self.manifests_folder):
+            for run in self.runs(manifest_name):
+                digests.update(entry[0] for entry in self.load_manifest(manifest_name, run)["files"].values())
+        for prefix in os.listdir(self.objects_folder):
+            prefix_folder = os.path.join(self.objects_folder, prefix)
+            for file_name in os.listdir(prefix_folder):
+                if file_name.endswith(".gz") and file_name[:-len(".gz")] not in digests:
+                    os.remove(os.path.join(prefix_folder, file_name))
+
+    def restore(self, name: str, target: str, run: Optional[str] = None) -> int:
+        """
+        Restore the files of the snapshot of the run (the latest if not given) under the target folder. Nothing is
+        restored if a path of the manifest is absolute or resolves outside the target folder (ValueError).
+
+        return (int): the number of restored files
+        """
+        manifest = self.load_manifest(name, run)
+        if manifest is None:
+            raise FileNotFoundError(f"There is no snapshot {name} {run or ''}")
+        target_folder = os.path.realpath(target)
+        target_paths = {}
+        for file_path in manifest["files"]:
+            target_path = os.path.realpath(os.path.join(target_folder, file_path))
+            if os.path.isabs(file_path) or os.path.commonpath([target_folder, target_path]) != target_folder \
+                    or target_path == target_folder:
+                raise ValueError(f"The path {file_path} of the snapshot {name} is outside the target folder {target}")
+            target_paths[file_path] = target_path
+        for file_path, (digest, _, _) in manifest["files"].items():
+            target_path = target_paths[file_path]
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            with gzip.open(self.object_path(digest), "rb") as object_file, open(target_path, "wb") as file:
+                shutil.copyfileobj(object_file, file)
+        return len(manifest["files"])
+
+
+# the store of this process, see get_snapshot_store
+snapshot_store: Optional[SnapshotStore] = None
+
+
+def get_snapshot_store() -> SnapshotStore:
+    global snapshot_store
+    if snapshot_store is None:
+        snapshot_store = SnapshotStore()
+    return snapshot_store
@@ -1,16 +1,26 @@
 import sys
+import asyncio
 import json
 import re
 import os
 import logging
+import functools
+import time
 from datetime import datetime
 
-import requests
-from utils import get_logger, call_basex, call_basex_with_file, call_basex_with_query
+from utils import get_logger, get_basex_client, AsyncBaseXClient, normalize_ruc
+from query_registry import query_registry
+from md_index import get_md_index
+from template_cache import record_dependency, dependencies_var, TemplateCache
+from package_sink import PackageSink, DirectorySink
+from template_profile import record_time
+from vocabs import get_vocabulary, normalize_properties, PROPERTIES_FOLDER
+from template_compiler import (compile_template, get_dbname, fallback_query_key, TemplatePlan,
+                               Node, DictNode, ListNode, DirectiveChain, RucDirective, MdDirective, ApiDirective,
+                               DefaultDirective, ErrDirective, NullDirective)
 
 logger = get_logger("template.log", __name__, level=logging.WARNING)
 
-basex_session = requests.Session()
 """
 This script is designed to process JSON data using a template and retrieve information based on a set of rules defined in the template. 
 https://github.com/CLARIAH/clariah-plus/blob/main/requirements/software-metadata-requirements.md
@@ -24,6 +34,14 @@ JSONL = "/data/c3.jsonl"
 JSONL_datasets = "/data/datasets.jsonl"
 
 PROCESSED_FILES = "./processed_jsonfiles"
+# the processed folders of the packages, by their resourceTypes
+TOOLS_FOLDER = "processed_jsonfiles_tools"
+DATASETS_FOLDER = "processed_jsonfiles_datasets"
+RUC_FOLDER = "./data/rich_user_contents"
+# number of ids evaluated by a single batched BaseX query
+MD_BATCH_SIZE = 250
+# evaluate the plain field lookups (e.g. "md:description") in process, see md_index.py
+USE_MD_INDEX = True
 TOOLS_TEMPLATE = "./template_tools.json"
 
 # ID and TEMPLATE can be overridden by command-line arguments. Default value is "grlc"
@@ -37,80 +55,64 @@ if len(sys.argv) > 2:
 
 def resolve_path(ruc, path):
     """
-    Function to resolve a path within a nested dictionary. It splits the path into steps, and if a step starts with "$", 
-    it looks for a matching key in the dictionary to access the nested values.
+    Function to resolve a path within a nested dictionary. It splits the path into steps, and if a step starts with "$",
+    the value of that key is used as the key to access the nested values (e.g. "$title" for the description).
+    The keys of the RUC are lowercased on load (see load_ruc), so every step is a dictionary lookup.
     """
     logger.debug(f"path[{path}]")
-    steps = path.split("/")
-    step = steps[0]
-    logger.debug(f"step[{step}]")
-    if step.startswith("$"):
-        step = step.replace("$", "")
-        ruc_key = step
-        for key in ruc.keys():
-            if key.lower() == step.lower():
-                ruc_key = key
-        step = ruc[ruc_key]
-        logger.debug(f"$step[{step}]")
-    ruc_key = None
-    for key in ruc.keys():
-        logger.debug(f"key[{key}]")
-        if key.lower() == step.lower():
-            ruc_key = key
-            if len(steps) == 1:
-                res = ruc[ruc_key]
-                logger.debug(f"res[{res}]")
-                return res
-            else:
-                if isinstance(ruc[ruc_key], dict):
-                    res = resolve_path(ruc[ruc_key], "/".join(steps[1:]))
-                    logger.debug(f"res[{res}]")
-                    return res
-                else:
-                    logger.debug(f"path is deeper, but dict not!")
-                    return None
+    res = ruc
+    for step in path.split("/"):
+        if not isinstance(res, dict):
+            logger.debug(f"path is deeper, but dict not!")
+            return None
+        step = step.lower()
+        if step.startswith("$"):
+            step = str(res[step.replace("$", "")]).lower()
+            logger.debug(f"$step[{step}]")
+        res = res.get(step)
+        logger.debug(f"step[{step}] res[{res}]")
+        if res is None:
+            return None
+    return res
 
 
-def traverse_data(template, ruc, template_type: str, current_id):
+def traverse_data(node: Node, ruc, template_type: str, current_id, md_results: dict = None):
     """
-    This function traverses and processes the template. 
-    
-    value: type = 'str', value of the template.json (e.g. "<md:@queries/plangs.rq,null")
-    key: type = 'str', key of the template.json (e.g. "programmingLanguages")
-    info: type = 'str', extracted information after "<" if the value starts with "<" (e.g. "<md:@queries/plangs.rq,null" > md:@queries/plangs.rq,null) 
+    This function traverses the compiled template (see template_compiler.py) and processes it.
+
+    node: type = 'Node', (a part of) the compiled template
+    ruc: type = 'dict', the Rich User Contents of the current id
+    template_type: type = 'str', 'tools' or 'datasets'
+    current_id: type = 'str', the id of the record being templated
+    md_results: type = 'dict', optional results of the md queries evaluated in batch (see prefetch_md_results)
     """
 
     res = None
 
-    # Check if the data is a dictionary
-    if isinstance(template, dict):
+    # Check if the node is a dictionary
+    if isinstance(node, DictNode):
         res = {}
-        for key, value in template.items():
-            # value is a string starting with <
-            if isinstance(value, str) and value.startswith("<"):
-                # Extract the information after the '<'
-                info = value.split("<")[1]
-                value = retrieve_info(info, ruc, template_type, current_id)
+        for key, value in node.items:
+            if isinstance(value, DirectiveChain):
+                value = retrieve_info(value, ruc, template_type, current_id, md_results)
             else:
                 # dealing with nested dictionaries or lists
-                value = traverse_data(value, ruc, template_type, current_id)
+                value = traverse_data(value, ruc, template_type, current_id, md_results)
             if value is not None:
                 if value == "null":
                     res[key] = None
                 else:
                     res[key] = value
 
-    # If the data is a list
-    elif isinstance(template, list):
+    # If the node is a list
+    elif isinstance(node, ListNode):
         res = []
-        for item in template:
-            if isinstance(item, str) and item.startswith("<"):
-                # Extract the information after the '<'
-                info = item.split("<")[1]
-                item = retrieve_info(info, ruc, template_type, current_id)
+        for item in node.items:
+            if isinstance(item, DirectiveChain):
+                item = retrieve_info(item, ruc, template_type, current_id, md_results)
             else:
                 # dealing nested dictionaries or lists
-                item = traverse_data(item, ruc, template_type, current_id)
+                item = traverse_data(item, ruc, template_type, current_id, md_results)
             if item is not None:
                 if item == "null":
                     res.append(None)
@@ -144,7 +146,7 @@ def checking_vocabs(value):
         return value
 
 
-def process_vocabs(vocabs, vocab, val):
+def process_vocabs(vocab, val):
     """
     This function compares the links of the properties (e.g. mediaType, status ) from INEO with the outcome of the jsoniq query on the codemeta files.
     To make the comparisons case-insensitive, both vocab links and val are converted to lowercase (or uppercase). 
@@ -153,290 +155,273 @@ def process_vocabs(vocabs, vocab, val):
 
     It merges the index number and title of the properties in the format {index + title} "7.23 plain"
     """
+    vocabulary = get_vocabulary(vocab)
+    if vocabulary is not None:
+        # If there is a match, return index and title (if the index is null (e.g. by status properties) return only the title)
+        result = vocabulary.match_title(val)
+        if result is None:
+            logger.debug(f"There is no match for {val}")
+        return result
 
-    # Check if the 'properties' key of e.g. MediaType is present in the properties
-    if vocab in vocabs:
-        # Iterate through the 'mediaTypes' list
-        for item in vocabs[vocab]:
-            # Check if val is present in the 'title'
-            if val.lower() == item['title'].strip().lower():
-                # If there is a match, return index and title (if the index is null (e.g. by status properties) return only the title)
-                if item['index'] is not None:
-                    result = f"{item['index']} {item['title'].strip()}"
+
+def retrieve_ruc(directive: RucDirective, ruc):
+    """
+    Extract information from the Rich User Contents, e.g. "ruc:overview:^.*(### Data.*)".
+    The optional regular expression further transforms the extracted data, the optional text replaces "$1" with it.
+    """
+    if directive.key is None:
+        return None
+
+    # get the contents of the key in the RUC
+    info = resolve_path(ruc, directive.key)
+    logger.debug(f"The value of '{directive.key}' in the RUC: {info}")
+
+    if info is not None and directive.regex is not None:
+        start = time.perf_counter()
+        regex = directive.regex
+        if isinstance(info, list):
+            match = []
+            for item in info:
+                found = regex.search(item)
+                match.append(found if found is not None else item)
+        else:
+            match = regex.search(info)
+
+        info: list | str | None = []
+        if match is not None and isinstance(match, list):
+            for m in match:
+                if isinstance(m, str):
+                    info.append(m)
                 else:
-                    result = f"{item['title'].strip()}"
+                    info.append(m.group(1))
+        elif match is not None:
+            info = match.group(1)
+        else:
+            info = None
+        logger.debug(f"The regex value of '{regex.pattern}': {info}")
+        record_time("directive", "regex", start)
+
+    if info is not None and directive.text is not None:
+        if directive.carousel:
+            # in case of carousel
+            info = [
+                directive.text.replace("$1", i)
+                if not (i.startswith("https://") or i.startswith("http://"))
+                else i
+                for i in info
+            ]
+        else:
+            # in case of string
+            info = directive.text.replace("$1", info)
+        logger.debug(f"The text value of '{directive.text}': {info}")
+
+    return info
+
+
+def retrieve_vocabs(directive: MdDirective, info):
+    """
+    Map the result of a md directive against the INEO property (vocab), e.g. "md:@queries/domains.xq:researchDomains"
+    """
+    vocab = directive.vocab
+    logger.debug(f"filter on vocab[{vocab}]")
+    record_dependency("vocab", vocab)
+
+    # the vocabulary is preloaded by the compiler if it was available, fail now it is actually needed
+    if get_vocabulary(vocab) is None:
+        raise FileNotFoundError(f"The properties file of {vocab} is not found in {PROPERTIES_FOLDER}")
+
+    vocabs_list = []
+    result_info = []
+
+    for val in info:
+        checked_val = checking_vocabs(val)
+        logger.debug(f"{vocab}: {val}")
+        try:
+            if checked_val is not None and checked_val.startswith("https://w3id.org/nwo-research-fields#"):
+                result_info.append(checked_val)
+                info = result_info
+            else:
+                # Retrieve the index number of the title of the property for mapping to INEO. E.g. for MediaTypes that is 7.23 plain
+                info = process_vocabs(vocab, val)
+                logger.debug(f"The vocab value from '{vocab}': {val}")
+                if info is not None:
+                    vocabs_list.append(info)
+                if len(vocabs_list) > 0:
+                    unique_list = list(set(vocabs_list))
+                    info = unique_list
+                else:
+                    info = None
+        except Exception as ex:
+            logger.error(f"Error processing vocabs {vocab} - {val}: {ex}")
+            exit("error found")
+    return info
+
+
+def basex_md_queries(plan: TemplatePlan) -> tuple[str, ...]:
+    """
+    The md queries of the template evaluated on BaseX, the plain field lookups are left out if they are evaluated
+    in process
+    """
+    if not USE_MD_INDEX:
+        return plan.md_queries
+    field_queries = {fallback_query_key(field, plan.template_type) for field in plan.fields}
+    return tuple(query_key for query_key in plan.md_queries if query_key not in field_queries)
+
 
-                # vocabs_list.append(result)
-                return result
+def prefetch_md_results(plan: TemplatePlan, ids: list[str]) -> dict[str, dict[str, str]]:
+    """
+    Evaluate every md query of the template once for a block of ids, instead of once per id.
+    If a batch fails, the query is left out and evaluated per id by retrieve_md.
+
+    plan (TemplatePlan): the compiled template
+    ids (list[str]): the block of ids
+
+    return (dict): query key -> {id -> response text of the query for that id}
+    """
+    md_results = {}
+    dbname = get_dbname(plan.template_type)
+    for query_key in basex_md_queries(plan):
+        start = time.perf_counter()
+        try:
+            md_results[query_key] = get_basex_client().query_batch(query_registry.get_batch(query_key), ids, dbname,
+                                                                   {"DB": dbname})
+        except Exception as ex:
+            logger.warning(f"Batch evaluation failed, falling back to a query per id: {ex}")
+        record_time("batch", query_key, start)
+    return md_results
+
+
+def run_md_query(directive: MdDirective, current_id: str, template_type: str) -> str:
+    """
+    Run the query of the directive for a single id and return the response text.
+    """
+    logger.debug(f"basex query[{directive.query_key}] id[{current_id}]")
+
+    dbname = get_dbname(template_type)
+    response = get_basex_client().query(query_registry.get(directive.query_key), dbname,
+                                        {"DB": dbname, "ID": current_id})
+    assert (
+            response.status_code == 200
+    ), f"HttpError {response.status_code} Error running {directive.query_key} for {current_id} on basex: {response.text}"
+    return response.text
+
+
+def retrieve_md(directive: MdDirective, current_id: str, template_type: str, md_results: dict = None):
+    """
+    Retrieve information from the metadata (codemeta or datasets) in BaseX, using the query of the directive.
+    The response is taken from md_results if the query was evaluated in batch for this id.
+    """
+    if directive.path is None:
+        return None
+
+    logger.info(f"Starting with md:{directive.path}")
+    record_dependency("query", directive.query_key)
+    start = time.perf_counter()
+    response_text = None
+    if USE_MD_INDEX and directive.query_file is None:
+        # None if the index cannot answer it for this id, e.g. the id is in more than one record
+        response_text = get_md_index(template_type).lookup(current_id, directive.path)
+    if response_text is None:
+        if md_results is not None and directive.query_key in md_results:
+            response_text = md_results[directive.query_key].get(current_id, "")
         else:
-            logger.debug(f"There is no match for {val}")
+            response_text = run_md_query(directive, current_id, template_type)
+    record_time("query", directive.query_key, start)
 
+    # check whether the query run was successful
+    try:
+        if response_text is not None and len(response_text) > 0:
+            resp = json.loads(response_text)
+        else:
+            resp = None
+    except json.JSONDecodeError:
+        logger.error(f"Error running {directive.path} for {current_id} on basex: {response_text}")
+        raise
+
+    if resp is not None and len(resp) > 0:
+        if isinstance(resp, str) or isinstance(resp, list):
+            info = resp
+        else:
+            raise TypeError(f"Invalid response type {type(resp)}. Allowed types are list and str.")
+    else:
+        info = None
+
+    if info is not None and directive.vocab is not None:
+        start = time.perf_counter()
+        info = retrieve_vocabs(directive, info)
+        record_time("directive", "vocab", start)
+
+    if info is not None:
+        logger.debug(f"The value of '{directive.path}' in the MD: {info}")
+    return info
 
-# global cache for vocabularies
-vocabs = {}
 
+# the kinds of the directives, as recorded in the profile of the templating (see template_profile.py)
+DIRECTIVE_KINDS = {RucDirective: "ruc", MdDirective: "md", ApiDirective: "api", DefaultDirective: "default",
+                   ErrDirective: "err", NullDirective: "null"}
 
-def retrieve_info(info, ruc, template_type: str, current_id) -> list | str | None | str:
+
+def retrieve_info(chain: DirectiveChain, ruc, template_type: str, current_id, md_results: dict = None) -> list | str | None:
     """
 
-    This scripts parses and processes a set of input instructions from template.json (info, e.g. md:@queries/domains.rq:researchDomains,null)
+    This function processes a compiled instruction from the template (chain, e.g. from "md:@queries/domains.xq:researchDomains,null")
     The function returns the result of processing these instructions (res), which could be a list, a string, or None.
 
-    The input instruction is further split using commas as delimiters (info_values), and different components of the instruction are processed. 
-    This means that the order of the instruction is important: the loop is exited if a result is found. 
-        
-    The instructions in the template include:
-        ruc: if an instruction starts with "ruc", it indicates that the function should extract information from the Rich User Contents
-            - if it starts with "ruc", the instruction is further split using colons as delimiters (info_parts), and different components of the instruction are processed.
-            - such a component can include a regular expression (e.g. "<ruc:overview:^.*(### Data.*) > "^.*(### Data.*)") which further transforms the extracted data.
-        md: if an instruction starts with "md", it indicates that the function should retrieve information from the codemeta.json files, potentially using a jsoniq query. 
-            the codemeta.json files are converted to a jsonl file that is stored in RumbleDB (done by script FAIRdatasets_tools_harvester.py)
-            - if an instruction starts with "md" the info is further split into components. If a component start with "@" it indicates that there is a path to a file path containing a jsoniq query ("@queries/author.rq" > "queries/author.rq").
-            - if is does not start with "@" (e.g. md:description > description) a query string is created. 
-            - if a query is found, the function sends a POST request to RUMBLEDB with the query and processes and filters the response.
-            - component "researchactivity" or "researchdomain" ("<md:@queries/activities.rq:researchActivity > researchActivity). Extra filter to further process the response of the jsoniq query (see functions "process_vocabs" and "checking_vocabs")
-        api: if an instruction starts with "api", it sets the res variable to the string "create".
-        err: if an instruction starts with "err", it indicates that an error message should be printed to the standard error stream (err:there is no learn!" > there is no learn!)
-        null: if an instruction starts with "null", it sets the res variable to the string "null".
-
-    info: type  = 'str', input instruction from template.json (information after "<" in def traverse_data, e.g. md:@queries/domains.rq:researchDomains)
-    ruc: type = 'dict', Rich User Contents (from Github Repository ineo-content). The ruc is processed and created in script FAIRdatasets_tools_harvester.py.
+    The directives are evaluated in the order of the instruction: the loop is exited if a result is found.
+
+    The directives in the template include:
+        ruc: extract information from the Rich User Contents (see retrieve_ruc)
+            - such a directive can include a regular expression (e.g. "<ruc:overview:^.*(### Data.*) > "^.*(### Data.*)") which further transforms the extracted data.
+        md: retrieve information from the codemeta.json files or the datasets in BaseX (see retrieve_md)
+            - if the path starts with "@" the query of that file is used ("@queries/author.xq" > "queries/author.xq").
+            - if is does not start with "@" (e.g. md:description > description) a fallback query is used.
+            - an optional vocab ("<md:@queries/domains.xq:researchDomains") maps the response to the INEO properties (see functions "process_vocabs" and "checking_vocabs")
+        api: sets the res variable to the string "create".
+        default: sets the res variable to the given value ("default:Tools" > "Tools")
+        err: logs the error message ("err:there is no learn!" > there is no learn!)
+        null: sets the res variable to None.
+
+    chain: type  = 'DirectiveChain', compiled instruction from the template
+    ruc: type = 'dict', Rich User Contents (from Github Repository ineo-content).
+    md_results: type = 'dict', optional results of the md queries evaluated in batch (see prefetch_md_results)
     res: type = 'str' | 'list' | None, the function returns the value stored in the res variable, which represents the result of processing the instructions in the template.
-    
+
     """
     # res is the final return value of the function
     res = None
 
-    global vocabs
-
-    logger.info(f"info[{info}]")
-    info_values = info.split(",")
-    for info_value in info_values:
-        logger.debug(f"info_value[{info_value}]")
-        if info_value.startswith("ruc"):
-            info_parts = info_value.split(":")
-            logger.debug(f"info_parts[{info_parts}]")
-
-            if len(info_parts) >= 2:
-                """
-                get the contents of the key in the RUC and assign it to info
-                """
-                template_key = info_parts[1].strip().lower()
-                if template_key.endswith("[]"):
-                    template_key = template_key[:-2]
-
-                info = resolve_path(ruc, template_key)
-                logger.debug(f"The value of '{template_key}' in the RUC: {info}")
-
-            if info is not None and len(info_parts) > 2:
-                regex_str = info_parts[2].strip()
-                regex = re.compile(regex_str, flags=re.DOTALL)
-                logger.debug(f"the regex string is: {regex_str}")
-                if isinstance(info, list):
-                    match = [
-                        regex.search(item) if regex.search(item) is not None else item
-                        for item in info
-                    ]
-                else:
-                    match = regex.search(info)
-
-                info: list | str | None = []
-                if match is not None and isinstance(match, list):
-                    for m in match:
-                        if isinstance(m, str):
-                            info.append(m)
-                        else:
-                            info.append(m.group(1))
-                elif match is not None:
-                    logger.debug(f"The regex value of '{regex_str}': {info}")
-                    info = match.group(1)
-                else:
-                    logger.debug(f"The regex value of '{regex_str}': {info}")
-                    info = None
-
-            org_info = info
-            if info is not None and len(info_parts) > 3:
-                template_key = info_parts[1].strip().lower()
-                if template_key.endswith("[]"):
-                    # in case of carousel
-                    text: str = ":".join(info_parts[3:])
-                    text: list = [
-                        text.replace("$1", i)
-                        if not (i.startswith("https://") or i.startswith("http://"))
-                        else i
-                        for i in info
-                    ]
-                else:
-                    # in case of string
-                    text: str = info_parts[3].strip()
-                    # text is changing type here to list
-                    text: str = text.replace("$1", info)
-
-                info = text
-                logger.debug(f"The text value of '{info_parts[3].strip()}': {info}")
-
-            res = info
-            if res is not None:
-                break  # Exit the loop once a match is found
+    logger.info(f"info[{chain.source}]")
+    for directive in chain.directives:
+        start = time.perf_counter()
+        found = False
+        if isinstance(directive, RucDirective):
+            res = retrieve_ruc(directive, ruc)
+            found = res is not None
 
         # With the http request method POST, the INEO api can perform three operations: create, update and delete.
         # the default option is create. This will be further processed in ineo_sync.py
-        if info_value.startswith("api"):
+        elif isinstance(directive, ApiDirective):
             res = "create"
 
         # The default values is defined in the template after the column
-        if info_value.startswith("default"):
-            logger.debug(f"Starting with {info_value}")
-            info_parts = info_value.split(":")
-            logger.debug(f"info_parts[{info_parts}]")
+        elif isinstance(directive, DefaultDirective):
+            res = directive.value
 
-            res = info_parts[1]
+        elif isinstance(directive, MdDirective):
+            res = retrieve_md(directive, current_id, template_type, md_results)
+            found = res is not None
 
-        # Checking if the info_value string begins with "md" (e.g. "<md:@queries/activities.rq,null")
-        # First check if the JSONL file of codemeta is not empty   
-        if info_value.startswith("md"):
-            info = None
-            logger.info(f"Starting with {info_value}")
-
-            info_parts = info_value.split(":")
-            logger.debug(f"info_parts[{info_parts}]")
-
-            if len(info_parts) >= 2:
-                path = info_parts[1]
-
-                original_path = None
-                if path.endswith("[]"):
-                    original_path = path
-                    path = path[:-2]  # Remove the '[]' suffix
-
-                query = None
-                file = None
-                # Checking if the path starts with "@" character. If it does, it indicates that the path refers to a file path containing a query.
-                if path.startswith("@"):
-                    # If the path starts with "@", this line extracts the file path by removing the "@" character. 
-                    # For example, if path is "@queries/activities.rq", the path will be set to "queries/activities.rq". 
-                    file = path[1:]
-                    logger.debug(f"path for the query[{file}]")
-                    with open(file, "r") as file:
-                        query = file.read()
-                if query is not None:
-                    # query = query.replace("{JSONL}", rumbledb_jsonl_path)
-                    query = query.replace("{ID}", current_id)
-                # This line generates a query string. It's a fallback query that is used when there is no external query file.
-                else:
-                    if "datasets" == template_type:
-                        query = f"""
-                        declare namespace js="http://www.w3.org/2005/xpath-functions";
-
-                        for $i in js:map
-                        let $ID:="{current_id}"
-                         where $i/js:string[@key='id']=$ID
-                         return xml-to-json($i/js:*[@key='{path}'][1])
-                        """.format(current_id=current_id, path=path)
-                        # query = f'for $i in json-file("{rumbledb_jsonl_path}",10) where $i.id eq "{current_id}" return $i.{path}'
-                    elif "tools" == template_type:
-                        query = f"""
-                        declare namespace js="http://www.w3.org/2005/xpath-functions";
-
-                        for $i in js:map
-                        let $ID:="{current_id}"
-                         where $i/js:string[@key='identifier']=$ID
-                         return xml-to-json($i/js:*[@key='{path}'][1])
-                        """.format(current_id=current_id, path=path)
-                    else:
-                        raise TypeError(
-                            f"Invalid template type {template_type}; Valid types are 'datasets' and 'tools'")
-                        # query = f'for $i in json-file("{rumbledb_jsonl_path}",10) where $i.identifier eq "{current_id}" return $i.{path}'
-
-                logger.debug(f"basex query[{query}]")
-
-                dbname = "datasets" if "datasets" == template_type else "tools"
-
-                # timing the query call
-                response = call_basex_with_query(query,
-                                                 "basex",
-                                                 8080,
-                                                 "admin",
-                                                 "pass",
-                                                 "post",
-                                                 dbname
-                                                 )
-                assert (
-                        response.status_code == 200
-                ), f"HttpError {response.status_code} Error running {query} on basex: {response.text}"
-
-                # check whether the query run was successful
-                try:
-                    if response.text is not None and len(response.text) > 0:
-                        resp = json.loads(response.text)
-                    else:
-                        resp = None
-                except json.JSONDecodeError:
-                    # resp = "" + response.text
-                    logger.error(f"Error running {query} on basex: {response.text}")
-                    raise
-
-                if resp is not None and len(resp) > 0:
-                    if isinstance(resp, str) or isinstance(resp, list):
-                        info = resp
-                    else:
-                        raise TypeError(f"Invalid response type {type(resp)}. Allowed types are list and str.")
-                else:
-                    info = None
+        elif isinstance(directive, ErrDirective):
+            logger.debug(f"error message given by template.json: [{directive.message}]")
 
-            if info is not None and len(info_parts) > 2:
-                vocab = info_parts[2].strip()
-                logger.debug(f"filter on vocab[{vocab}]")
-
-                if vocab not in vocabs.keys():
-                    # Load the vocabs file to be used later
-                    with open(f"/src/properties/{vocab}.json", "r") as vocabs_file:
-                        vocabs[vocab] = json.load(vocabs_file)
-
-                vocabs_list = []
-                result_info = []
-
-                for val in info:
-                    checked_val = checking_vocabs(val)
-                    logger.debug(vocab, val)
-                    try:
-                        if checked_val is not None and checked_val.startswith("https://w3id.org/nwo-research-fields#"):
-                            result_info.append(checked_val)
-                            info = result_info
-                        else:
-                            # Retrieve the index number of the title of the property for mapping to INEO. E.g. for MediaTypes that is 7.23 plain
-                            info = process_vocabs(vocabs, vocab, val)
-                            logger.debug(f"The vocab value from '{info_parts[2].strip()}': {val}")
-                            if info is not None:
-                                vocabs_list.append(info)
-                            if len(vocabs_list) > 0:
-                                unique_list = list(set(vocabs_list))
-                                info = unique_list
-                            else:
-                                info = None
-                    except Exception as ex:
-                        logger.error(f"Error processing vocabs {info_parts} - {val}: {ex}")
-                        exit("error found")
-
-            if info is not None:
-                logger.debug(f"The value of '{path}' in the MD: {info}")
-
-            res = info
-            if res is not None:
-                break  # Exit the loop once a match is found
-
-        # This line checks if info_value starts with the prefix "err" ("<ruc:learn,err:there is no learn!")
-        if info_value.startswith("err"):
-            msg = info_value.split(":")[1].strip()  # "there is no learn!"
-            # Print the error message to stderr
-            logger.debug(f"error message given by template.json: [{msg}]")
-
-        # checks if info_value starts with the prefix "null" and indicates that the result should be set to "null".
-        if info_value.startswith("null"):
-            logger.debug(f"Starting with 'null':{info_value}")
-            # TODO FIXME: replace string "null" with None to check whether it is working
+        # indicates that the result should be set to "null".
+        elif isinstance(directive, NullDirective):
             res = None
 
+        record_time("directive", DIRECTIVE_KINDS.get(type(directive), type(directive).__name__), start)
+        if found:
+            break  # Exit the loop once a match is found
+
     return res
 
 
@@ -454,70 +439,193 @@ def create_minimal_ruc(current_id: str) -> dict:
     return ruc
 
 
-def main(current_id: str = ID, template_path: str = TOOLS_TEMPLATE, template_type: str = "tools"):
-    """
-    Main function
-    
-    This script processes JSON data using a template (template.json) and retrieving information from it based on a set of instructions defined in template.py. 
-    This function starts the process of traversing the template and retrieving the information from the Rich User Contents (RUC) and codemeta files (MD)
-    then merge them into an INEO json file to ultimately feed into the INEO API. 
+# the ids with a RUC file, None until the RUC folder is listed by init_ruc_cache
+ruc_ids = None
 
-    template: type = 'dict', the template file loaded as json, by default it is always a list of dictionaries as INEO supports multiple records
-    ruc: type = 'dict', the rich user contents file loaded as json, by default it is always a dictionary as it contains only one record
-    res: type = 'list', the result of combining the RUC and the MD based on the instructions set out in template.py. 
-    
-    """
-    logger.debug(f"### Processing {current_id} of type {template_type} with {template_path}")
-    # DSL template
-    # global template
-    with open(template_path, "r") as file:
-        template = json.load(file)
 
-    # Rich User Contents
-    ruc = None
+def init_ruc_cache(ruc_folder: str = None) -> None:
+    """
+    List the RUC folder (by default RUC_FOLDER) once per process, so the many ids without a RUC file do not need a
+    lookup on disk each.
+    """
+    global ruc_ids
+    ruc_folder = ruc_folder or RUC_FOLDER
+    if os.path.isdir(ruc_folder):
+        ruc_ids = {file_name[:-len(".json")] for file_name in os.listdir(ruc_folder) if file_name.endswith(".json")}
+    else:
+        ruc_ids = set()
+    logger.debug(f"{len(ruc_ids)} RUC files in {ruc_folder}")
 
-    # Load RUC dictionary or create a minimal RUC object if not existent
-    ruc_file_path = f"./data/rich_user_contents/{current_id}.json"
 
-    if os.path.exists(ruc_file_path):
+def load_ruc(current_id: str) -> dict:
+    """
+    Load the RUC dictionary or create a minimal RUC object if not existent
+    """
+    ruc_file_path = os.path.join(RUC_FOLDER, f"{current_id}.json")
+    if (ruc_ids is None or current_id in ruc_ids) and os.path.exists(ruc_file_path):
         with open(ruc_file_path, "r") as json_file:
-            ruc = json.load(json_file)
+            ruc = normalize_ruc(json.load(json_file))
         logger.debug(f"RUC contents: {ruc}")
-    else:
-        ruc = create_minimal_ruc(current_id)
+        return ruc
+    return create_minimal_ruc(current_id)
 
-    # Combine codemeta/datasets and RUC using the template
-    res = traverse_data(template, ruc, template_type, current_id)
 
-    # Create folders if they don't exist
-    tools_folder = 'processed_jsonfiles_tools'
-    datasets_folder = 'processed_jsonfiles_datasets'
+@functools.lru_cache(maxsize=None)
+def get_plan(template_path: str, template_type: str) -> TemplatePlan:
+    """
+    Compile the template once per process, the plan is reused for every id.
+    """
+    return compile_template(template_path, template_type)
+
+
+def template_package(current_id: str, template_path: str, template_type: str, plan: TemplatePlan = None,
+                     md_results: dict = None, dependencies: set = None) -> tuple[str, list]:
+    """
+    Template a single id, see main.
 
-    if not os.path.exists(tools_folder):
-        os.makedirs(tools_folder)
+    return (tuple): the processed folder of the package (by its resourceTypes) and the package
+    """
+    logger.debug(f"### Processing {current_id} of type {template_type} with {template_path}")
+    start = time.perf_counter()
+    # DSL template, compiled only once
+    if plan is None:
+        plan = get_plan(template_path, template_type)
 
-    if not os.path.exists(datasets_folder):
-        os.makedirs(datasets_folder)
+    # Rich User Contents
+    ruc = load_ruc(current_id)
 
-    # Iterate through the results and save JSON files accordingly
+    # Combine codemeta/datasets and RUC using the template
+    token = dependencies_var.set(dependencies)
+    try:
+        res = traverse_data(plan.root, ruc, template_type, current_id, md_results)
+        # map the researchDomains and researchActivities to the links of INEO, before the package is emitted
+        for vocab in normalize_properties(res, template_type):
+            record_dependency("vocab", vocab)
+    finally:
+        dependencies_var.reset(token)
+
+    # Iterate through the results and choose the folder accordingly
     processed_results = []
 
     for result in res:
         resource_types = result.get('document', {}).get('properties', {}).get('resourceTypes', [])
 
         if "Tools" in resource_types:
-            folder_name = tools_folder
+            folder_name = TOOLS_FOLDER
         else:
-            folder_name = datasets_folder
+            folder_name = DATASETS_FOLDER
 
         processed_results.append(result)
 
-    filename = os.path.join(folder_name, f"{current_id}_processed.json")
+    record_time("record", current_id, start)
+    return folder_name, processed_results
 
-    with open(filename, 'w') as file:
-        json.dump(processed_results, file, indent=2)
 
-    logger.info(f"JSON files saved successfully. {filename}")
+def main(current_id: str = ID, template_path: str = TOOLS_TEMPLATE, template_type: str = "tools",
+         plan: TemplatePlan = None, md_results: dict = None, dependencies: set = None,
+         sink: PackageSink = None) -> tuple[str, list]:
+    """
+    Main function
+    
+    This script processes JSON data using a template (template.json) and retrieving information from it based on a set of instructions defined in template.py. 
+    This function starts the process of traversing the template and retrieving the information from the Rich User Contents (RUC) and codemeta files (MD)
+    then merge them into an INEO json file to ultimately feed into the INEO API. 
+
+    plan: type = 'TemplatePlan', the compiled template (template.json), by default it is always a list of dictionaries as INEO supports multiple records
+    ruc: type = 'dict', the rich user contents file loaded as json, by default it is always a dictionary as it contains only one record
+    md_results: type = 'dict', optional results of the md queries evaluated in batch for a block of ids including this one
+    dependencies: type = 'set', optional, the queries and vocabularies used for this id are added to it (see template_cache.py)
+    sink: type = 'PackageSink', the sink the package is emitted to (see package_sink.py), by default <id>_processed.json
+    res: type = 'list', the result of combining the RUC and the MD based on the instructions set out in template.py. 
+    
+    """
+    folder_name, processed_results = template_package(current_id, template_path, template_type, plan, md_results,
+                                                      dependencies)
+    (sink or DirectorySink()).emit(current_id, folder_name, processed_results)
+    return folder_name, processed_results
+
+
+async def prefetch_md_results_async(client: AsyncBaseXClient, plan: TemplatePlan,
+                                    ids: list[str]) -> tuple[dict[str, dict[str, str]], dict[str, str]]:
+    """
+    The asyncio counterpart of prefetch_md_results, the md queries of the template are evaluated concurrently.
+    A failing batch is evaluated per id (concurrently as well), so that the block can be templated from memory.
+
+    client (AsyncBaseXClient): the client, within its context
+    plan (TemplatePlan): the compiled template
+    ids (list[str]): the block of ids
+
+    return (tuple): query key -> {id -> response text}, and id -> error message for the ids a query failed for
+    """
+    dbname = get_dbname(plan.template_type)
+    errors = {}
+
+    async def evaluate(query_key: str) -> dict[str, str]:
+        start = time.perf_counter()
+        try:
+            results = await client.query_batch(query_registry.get_batch(query_key), ids, dbname, {"DB": dbname})
+            record_time("batch", query_key, start)
+            return results
+        except Exception as ex:
+            logger.warning(f"Batch evaluation failed, falling back to a query per id: {ex}")
+
+        query = query_registry.get(query_key)
+        responses = await asyncio.gather(*(client.query(query, dbname, {"DB": dbname, "ID": current_id})
+                                           for current_id in ids), return_exceptions=True)
+        results = {}
+        for current_id, response in zip(ids, responses):
+            if isinstance(response, Exception):
+                errors[current_id] = f"{type(response).__name__}: {response}"
+            elif response.status_code != 200:
+                errors[current_id] = (f"HttpError {response.status_code} Error running {query_key} for {current_id} "
+                                      f"on basex: {response.text}")
+            else:
+                results[current_id] = response.text
+        record_time("batch", query_key, start)
+        return results
+
+    query_keys = basex_md_queries(plan)
+    md_results = await asyncio.gather(*(evaluate(query_key) for query_key in query_keys))
+    return dict(zip(query_keys, md_results)), errors
+
+
+async def template_block_async(client: AsyncBaseXClient, plan: TemplatePlan, block: list[str],
+                               cache: TemplateCache = None) -> tuple[dict[str, str], dict[str, dict], list[tuple]]:
+    """
+    Template a block of ids, the md queries are awaited first and the ids are then templated from memory.
+    The ids restored from the cache are not templated.
+
+    return (tuple): id -> error message for the ids which could not be templated, the new cache entries and the
+        packages as (id, folder, package), to be emitted to the sink
+    """
+    packages = []
+    misses = []
+    for current_id in block:
+        restored = cache.restore(current_id) if cache is not None else None
+        if restored is None:
+            misses.append(current_id)
+        else:
+            packages.append((current_id, *restored))
+    if not misses:
+        return {}, {}, packages
+    md_results, errors = await prefetch_md_results_async(client, plan, misses)
+    entries = {}
+    for current_id in misses:
+        if current_id in errors:
+            logger.error(f"Cannot template the file: [{current_id}] with template: [{plan.template_path}]: "
+                         f"{errors[current_id]}")
+            continue
+        try:
+            dependencies = set()
+            folder, package = template_package(current_id, plan.template_path, plan.template_type, plan,
+                                               md_results, dependencies)
+            packages.append((current_id, folder, package))
+            if cache is not None:
+                entries[current_id] = cache.store(current_id, folder, package, dependencies)
+        except Exception as ex:
+            logger.error(f"Cannot template the file: [{current_id}] with template: [{plan.template_path}]: {ex}")
+            errors[current_id] = f"{type(ex).__name__}: {ex}"
+    return errors, entries, packages
 
 
 if __name__ == "__main__":
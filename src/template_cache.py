@@ -0,0 +1,195 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from contextvars import ContextVar
+from typing import Optional
+
+from utils import get_logger
+from md_index import get_md_index
+from query_registry import query_registry
+import vocabs
+
+logger = get_logger("template.log", __name__, level=logging.WARNING)
+
+"""
+A content-addressed cache of the templated packages (see package_sink.py).
+
+The key of a templated file is the hash of everything it is made of:
+- the metadata of the id (the codemeta or dataset json file) and its RUC json file
+- the template file
+- the queries and the vocabularies (INEO properties) actually used for the id, recorded while templating
+
+The manifest keeps, per id, the hash of its files and the queries and vocabularies it used. A changed query file
+therefore only invalidates the ids which used that query. The templated packages are stored once per key in the
+objects folder and emitted again on a hit, without running any query.
+"""
+
+TEMPLATE_CACHE_FOLDER = "./template_cache"
+# part of every key, to be raised when the templating itself changes
+TEMPLATE_CACHE_VERSION = "3"
+
+# the queries and vocabularies used while templating an id, see record_dependency
+dependencies_var: ContextVar[Optional[set]] = ContextVar("template_dependencies", default=None)
+
+
+def record_dependency(kind: str, name: str) -> None:
+    """
+    Record that the id being templated uses the query ("query", key) or the vocabulary ("vocab", name)
+    """
+    dependencies = dependencies_var.get()
+    if dependencies is not None:
+        dependencies.add((kind, name))
+
+
+def hash_file(hasher, file_path: str) -> None:
+    hasher.update(file_path.encode("utf-8"))
+    if os.path.exists(file_path):
+        with open(file_path, "rb") as file:
+            hasher.update(hashlib.sha256(file.read()).digest())
+    else:
+        hasher.update(b"<missing>")
+
+
+class TemplateCache:
+    """
+    template_path (str): the path to the template, e.g. ./template_tools.json
+    template_type (str): 'tools' or 'datasets'
+    ruc_folder (str): the folder with the RUC files
+    folder (str): the folder of the cache
+    """
+
+    def __init__(self, template_path: str, template_type: str, ruc_folder: str,
+                 folder: str = TEMPLATE_CACHE_FOLDER):
+        self.template_path = template_path
+        self.template_type = template_type
+        self.ruc_folder = ruc_folder
+        self.objects_folder = os.path.join(folder, "objects")
+        self.manifest_path = os.path.join(folder, f"{template_type}_manifest.json")
+        self.manifest = {}
+        # the hashes of the template, queries and vocabularies, they do not change during a run
+        self.dependency_hashes = {}
+        self.template_hash = None
+
+    def load(self) -> "TemplateCache":
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as manifest_file:
+                self.manifest = json.load(manifest_file)
+        hasher = hashlib.sha256(f"{TEMPLATE_CACHE_VERSION}:{self.template_type}".encode("utf-8"))
+        hash_file(hasher, self.template_path)
+        self.template_hash = hasher.hexdigest()
+        return self
+
+    def inputs_hash(self, current_id: str) -> Optional[str]:
+        """
+        The hash of the template and the files of the id, None if the files of the id are not known
+        """
+        index = get_md_index(self.template_type)
+        paths = index.paths.get(current_id)
+        if paths is None and not index.complete:
+            return None
+        hasher = hashlib.sha256(self.template_hash.encode("utf-8"))
+        for path in sorted(paths or []):
+            hash_file(hasher, path)
+        hash_file(hasher, os.path.join(self.ruc_folder, f"{current_id}.json"))
+        return hasher.hexdigest()
+
+    def dependency_hash(self, kind: str, name: str) -> str:
+        if (kind, name) not in self.dependency_hashes:
+            if kind == "query":
+                value = hashlib.sha256(query_registry.get(name).encode("utf-8")).hexdigest()
+            elif kind == "vocab":
+                hasher = hashlib.sha256()
+                hash_file(hasher, os.path.join(vocabs.PROPERTIES_FOLDER, f"{name}.json"))
+                value = hasher.hexdigest()
+            else:
+                raise ValueError(f"Invalid dependency kind {kind}; Valid kinds are 'query' and 'vocab'")
+            self.dependency_hashes[(kind, name)] = value
+        return self.dependency_hashes[(kind, name)]
+
+    def key(self, inputs_hash: str, dependencies: list) -> str:
+        hasher = hashlib.sha256(inputs_hash.encode("utf-8"))
+        for kind, name in dependencies:
+            hasher.update(f"{kind}:{name}:{self.dependency_hash(kind, name)}".encode("utf-8"))
+        return hasher.hexdigest()
+
+    def restore(self, current_id: str) -> Optional[tuple[str, list]]:
+        """
+        Get the templated package of the id from the cache, if none of its inputs changed
+
+        return (tuple): the processed folder and the package on a hit, None otherwise
+        """
+        entry = self.manifest.get(current_id)
+        if entry is None:
+            return None
+        inputs_hash = self.inputs_hash(current_id)
+        if inputs_hash is None or inputs_hash != entry["inputs"]:
+            return None
+        key = self.key(inputs_hash, entry["dependencies"])
+        object_path = os.path.join(self.objects_folder, f"{key}.json")
+        if key != entry["key"] or not os.path.exists(object_path):
+            return None
+
+        with open(object_path, "r") as object_file:
+            package = json.load(object_file)
+        logger.debug(f"Restored {current_id} from the template cache")
+        return entry["folder"], package
+
+    def store(self, current_id: str, folder: str, package: list, dependencies: set) -> Optional[dict]:
+        """
+        Store the templated package of the id
+
+        return (dict): the manifest entry of the id, to be added with update
+        """
+        inputs_hash = self.inputs_hash(current_id)
+        if inputs_hash is None:
+            return None
+        dependencies = sorted(dependencies)
+        key = self.key(inputs_hash, dependencies)
+        object_path = os.path.join(self.objects_folder, f"{key}.json")
+        if not os.path.exists(object_path):
+            os.makedirs(self.objects_folder, exist_ok=True)
+            # written under a temporary name first, other workers may store the same object
+            temp_path = f"{object_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "w") as object_file:
+                json.dump(package, object_file)
+            os.replace(temp_path, object_path)
+        return {"inputs": inputs_hash, "dependencies": dependencies, "key": key, "folder": folder}
+
+    def update(self, entries: dict) -> None:
+        self.manifest.update({current_id: entry for current_id, entry in entries.items() if entry is not None})
+
+    def save(self) -> None:
+        """
+        Save the manifest and remove the objects no id refers to anymore
+        """
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        temp_path = f"{self.manifest_path}.tmp"
+        with open(temp_path, "w") as manifest_file:
+            json.dump(self.manifest, manifest_file)
+        os.replace(temp_path, self.manifest_path)
+
+        # the objects of all template types share the folder
+        keys = set()
+        for file_name in os.listdir(os.path.dirname(self.manifest_path)):
+            if file_name.endswith("_manifest.json"):
+                with open(os.path.join(os.path.dirname(self.manifest_path), file_name), "r") as manifest_file:
+                    keys.update(entry["key"] for entry in json.load(manifest_file).values())
+        if os.path.isdir(self.objects_folder):
+            for file_name in os.listdir(self.objects_folder):
+                if file_name.endswith(".json") and file_name[:-len(".json")] not in keys:
+                    os.remove(os.path.join(self.objects_folder, file_name))
+
+
+# the caches of this process, see get_template_cache
+template_caches = {}
+
+
+def get_template_cache(template_path: str, template_type: str, ruc_folder: str) -> TemplateCache:
+    """
+    Get the cache of the template, its manifest is loaded on first use.
+    """
+    if template_path not in template_caches:
+        template_caches[template_path] = TemplateCache(template_path, template_type, ruc_folder).load()
+    return template_caches[template_path]
@@ -0,0 +1,285 @@
+import json
+import logging
+import re
+from dataclasses import dataclass
+from typing import Optional, Tuple, Union
+
+from utils import get_logger
+from query_registry import query_registry
+from vocabs import get_vocabulary
+
+logger = get_logger("template.log", __name__, level=logging.WARNING)
+
+"""
+This module compiles the template DSL (template_tools.json / template_datasets.json) into an immutable execution plan.
+
+A template value such as "<md:@queries/status.xq:status,null" is parsed once into a chain of typed directive nodes,
+so the templating of thousands of ids does not need to split directive strings for every record.
+The queries themselves are kept in the query registry (query_registry.py), the plan refers to them by key.
+The plan is executed by template.traverse_data and template.retrieve_info.
+"""
+
+# the BaseX databases with the metadata per template type, see get_dbname
+DBNAMES = {"tools": "tools", "datasets": "datasets"}
+
+
+@dataclass(frozen=True)
+class RucDirective:
+    """
+    ruc:<key>[:<regex>[:<text>]], e.g. "ruc:overview:^(.*)### Data.*:### Overview\n $1"
+
+    key (str): the lowercased key (or path) in the RUC, without the "[]" suffix
+    carousel (bool): True if the key ends with "[]", the text is then applied on every item of the list
+    regex (re.Pattern): optional regular expression, group 1 is used as value
+    text (str): optional text in which "$1" is replaced by the value
+    """
+    key: Optional[str]
+    carousel: bool = False
+    regex: Optional[re.Pattern] = None
+    text: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class MdDirective:
+    """
+    md:<field or @query file>[:<vocab>], e.g. "md:@queries/status.xq:status" or "md:description"
+
+    path (str): the field in the metadata or the query file prefixed with "@", without the "[]" suffix
+    query_file (str): the query file, None for a plain field lookup
+    query_key (str): the key of the query in the query registry, the query file or the key of the generated
+                     fallback query. The query binds $DB and $ID as external variables.
+    vocab (str): optional name of the INEO property the results are mapped against
+    """
+    path: Optional[str]
+    query_file: Optional[str] = None
+    query_key: Optional[str] = None
+    vocab: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class ApiDirective:
+    """api: the INEO operation, always "create"; further processed in ineo_sync.py"""
+
+
+@dataclass(frozen=True)
+class DefaultDirective:
+    """default:<value>, e.g. "default:Tools" """
+    value: str
+
+
+@dataclass(frozen=True)
+class ErrDirective:
+    """err:<message>, e.g. "err:there is no learn!" """
+    message: str
+
+
+@dataclass(frozen=True)
+class NullDirective:
+    """null: the result is None"""
+
+
+Directive = Union[RucDirective, MdDirective, ApiDirective, DefaultDirective, ErrDirective, NullDirective]
+
+
+@dataclass(frozen=True)
+class DirectiveChain:
+    """
+    The compiled form of a template value starting with "<". The directives are evaluated in order.
+
+    source (str): the original instruction, kept for logging
+    """
+    directives: Tuple[Directive, ...]
+    source: str
+
+
+@dataclass(frozen=True)
+class DictNode:
+    items: Tuple[Tuple[str, "Node"], ...]
+
+
+@dataclass(frozen=True)
+class ListNode:
+    items: Tuple["Node", ...]
+
+
+@dataclass(frozen=True)
+class DropNode:
+    """A template value that is not a directive nor a container (e.g. "markdown"), it never ends up in the result"""
+
+
+Node = Union[DictNode, ListNode, DirectiveChain, DropNode]
+
+
+@dataclass(frozen=True)
+class TemplatePlan:
+    root: Node
+    template_path: str
+    template_type: str
+    query_files: Tuple[str, ...]
+    md_queries: Tuple[str, ...]  # the keys of the queries in the query registry
+    fields: Tuple[str, ...]  # the plain field lookups, e.g. "description" for "md:description"
+
+
+def get_dbname(template_type: str) -> str:
+    """
+    The BaseX database with the metadata of the template type, see main.prepare_basex_tables
+    """
+    return DBNAMES["datasets"] if "datasets" == template_type else DBNAMES["tools"]
+
+
+def get_id_key(template_type: str) -> str:
+    """
+    The key of the id in the metadata of the template type
+    """
+    if "datasets" == template_type:
+        return "id"
+    elif "tools" == template_type:
+        return "identifier"
+    raise TypeError(f"Invalid template type {template_type}; Valid types are 'datasets' and 'tools'")
+
+
+def fallback_query_key(path: str, template_type: str) -> str:
+    """
+    The key of the fallback query of the path in the query registry
+    """
+    return f"fallback:{template_type}:{path}"
+
+
+def fallback_query(path: str, template_type: str) -> str:
+    """
+    Generates the query used when there is no external query file, e.g. for "md:description".
+    Just like the query files, the query binds the database and the id as the external variables $DB and $ID.
+    The record is looked up with the text index of the database (db:text) instead of scanning all records.
+    """
+    id_key = get_id_key(template_type)
+    return f"""
+                        declare namespace js="http://www.w3.org/2005/xpath-functions";
+
+                        declare variable $DB external;
+                        declare variable $ID external;
+
+                        for $i in db:text($DB, $ID)/parent::js:string[@key='{id_key}']/parent::js:map[parent::document-node()]
+                         return xml-to-json($i/js:*[@key='{path}'][1])
+                        """
+
+
+def compile_ruc(info_parts: list) -> RucDirective:
+    if len(info_parts) < 2:
+        return RucDirective(key=None)
+
+    template_key = info_parts[1].strip().lower()
+    carousel = template_key.endswith("[]")
+    if carousel:
+        template_key = template_key[:-2]
+
+    regex = None
+    if len(info_parts) > 2:
+        regex = re.compile(info_parts[2].strip(), flags=re.DOTALL)
+
+    text = None
+    if len(info_parts) > 3:
+        if carousel:
+            # in case of carousel the text can contain colons, e.g. an url
+            text = ":".join(info_parts[3:])
+        else:
+            text = info_parts[3].strip()
+
+    return RucDirective(key=template_key, carousel=carousel, regex=regex, text=text)
+
+
+def compile_md(info_parts: list, template_type: str) -> MdDirective:
+    if len(info_parts) < 2:
+        return MdDirective(path=None)
+
+    path = info_parts[1]
+    if path.endswith("[]"):
+        path = path[:-2]  # Remove the '[]' suffix
+
+    vocab = None
+    if len(info_parts) > 2:
+        vocab = info_parts[2].strip()
+        # preload the vocabulary, a missing file only fails when the vocabulary is actually needed
+        get_vocabulary(vocab)
+
+    # If the path starts with "@", it refers to a file containing a query, e.g. "@queries/activities.xq"
+    if path.startswith("@"):
+        query_file = path[1:]
+        # load the query now, a missing query file fails the compilation
+        query_key = query_file
+        query_registry.get(query_key)
+    else:
+        query_file = None
+        query_key = query_registry.register(fallback_query_key(path, template_type), fallback_query(path, template_type))
+
+    return MdDirective(path=path, query_file=query_file, query_key=query_key, vocab=vocab)
+
+
+def compile_directives(info: str, template_type: str) -> DirectiveChain:
+    """
+    Compile a single instruction (the information after "<", e.g. "md:@queries/domains.xq:researchDomains,null")
+    into a chain of directives. Unknown directives are ignored, as they do not change the result.
+    """
+    directives = []
+    for info_value in info.split(","):
+        info_parts = info_value.split(":")
+        if info_value.startswith("ruc"):
+            directives.append(compile_ruc(info_parts))
+        elif info_value.startswith("api"):
+            directives.append(ApiDirective())
+        elif info_value.startswith("default"):
+            directives.append(DefaultDirective(value=info_parts[1]))
+        elif info_value.startswith("md"):
+            directives.append(compile_md(info_parts, template_type))
+        elif info_value.startswith("err"):
+            directives.append(ErrDirective(message=info_parts[1].strip()))
+        elif info_value.startswith("null"):
+            directives.append(NullDirective())
+        else:
+            logger.debug(f"Ignoring unknown directive [{info_value}] in [{info}]")
+    return DirectiveChain(directives=tuple(directives), source=info)
+
+
+def compile_node(template, template_type: str) -> Node:
+    """
+    Compile (a part of) the loaded template into plan nodes.
+    """
+    if isinstance(template, dict):
+        return DictNode(items=tuple((key, compile_node(value, template_type)) for key, value in template.items()))
+    if isinstance(template, list):
+        return ListNode(items=tuple(compile_node(item, template_type) for item in template))
+    if isinstance(template, str) and template.startswith("<"):
+        # Extract the information after the '<'
+        return compile_directives(template.split("<")[1], template_type)
+    return DropNode()
+
+
+def collect_md_directives(node: Node) -> list[MdDirective]:
+    if isinstance(node, DictNode):
+        return [d for _, item in node.items for d in collect_md_directives(item)]
+    if isinstance(node, ListNode):
+        return [d for item in node.items for d in collect_md_directives(item)]
+    if isinstance(node, DirectiveChain):
+        return [d for d in node.directives if isinstance(d, MdDirective) and d.path is not None]
+    return []
+
+
+def compile_template(template_path: str, template_type: str) -> TemplatePlan:
+    """
+    Compile a template file into an execution plan.
+
+    template_path (str): the path to the template, e.g. ./template_tools.json
+    template_type (str): 'tools' or 'datasets'
+
+    return (TemplatePlan): the plan to be executed by template.traverse_data for every id
+    """
+    logger.debug(f"Compiling template {template_path} of type {template_type}")
+    with open(template_path, "r") as file:
+        template = json.load(file)
+    root = compile_node(template, template_type)
+    md_directives = collect_md_directives(root)
+    query_files = tuple(dict.fromkeys(d.query_file for d in md_directives if d.query_file is not None))
+    # unique queries of the template, e.g. to be evaluated in batch for a block of ids
+    md_queries = tuple(dict.fromkeys(d.query_key for d in md_directives))
+    fields = tuple(dict.fromkeys(d.path for d in md_directives if d.query_file is None))
+    return TemplatePlan(root=root, template_path=template_path, template_type=template_type, query_files=query_files,
+                        md_queries=md_queries, fields=fields)
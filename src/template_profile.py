@@ -0,0 +1,97 @@
+import json
+import logging
+import os
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from utils import get_logger
+
+logger = get_logger("template.log", __name__, level=logging.WARNING)
+
+"""
+Wall time and call counts of the templating, to be left on in production (see main.PROFILE_TEMPLATING).
+
+The times are recorded per:
+- directive: the kind of the directive in the template (ruc, md, api, default, err, null) and the parts of a
+  directive, regex (of a ruc directive) and vocab (of a md directive); the time of a directive includes its parts
+- query: the query (key) of a md directive, the time to get the response of a single id
+- batch: the query (key) evaluated for a block of ids, see template.prefetch_md_results
+- record: the id, the time to template it
+
+Every block of ids is profiled on its own (see profile_var), the profiles of the blocks are merged by the process
+calling main.call_template, also when the blocks are templated by a pool of workers. Recording a time costs two
+calls of time.perf_counter and a dictionary update.
+"""
+
+# the profile of the block being templated, None if the templating is not profiled
+profile_var: ContextVar[Optional["TemplateProfile"]] = ContextVar("template_profile", default=None)
+
+# the folder of the reports, see TemplateProfile.save
+PROFILE_FOLDER = "./logs"
+
+
+def record_time(category: str, name: str, start: float) -> None:
+    """
+    Record the time since start (time.perf_counter) in the profile of the block, if it is profiled
+    """
+    profile = profile_var.get()
+    if profile is not None:
+        profile.add(category, name, time.perf_counter() - start)
+
+
+class TemplateProfile:
+    """
+    stats (dict): category -> name -> [calls, seconds]
+    """
+
+    def __init__(self):
+        self.stats = {}
+
+    def add(self, category: str, name: str, seconds: float) -> None:
+        entry = self.stats.setdefault(category, {}).setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+    def merge(self, stats: Optional[dict]) -> None:
+        """
+        Add the stats of another profile, e.g. of a block templated by a worker
+        """
+        for category, names in (stats or {}).items():
+            for name, (calls, seconds) in names.items():
+                entry = self.stats.setdefault(category, {}).setdefault(name, [0, 0.0])
+                entry[0] += calls
+                entry[1] += seconds
+
+    def slowest(self, category: str, top: int) -> list[dict]:
+        names = self.stats.get(category, {})
+        ranked = sorted(names.items(), key=lambda item: item[1][1], reverse=True)[:top]
+        return [{"name": name, "calls": calls, "seconds": round(seconds, 6),
+                 "mean_ms": round(seconds / calls * 1000, 3) if calls else 0.0}
+                for name, (calls, seconds) in ranked]
+
+    def report(self, top: int = 25) -> dict:
+        """
+        The totals per directive kind, and the slowest queries, batches and records
+        """
+        records = self.stats.get("record", {})
+        return {
+            "records": len(records),
+            "seconds": round(sum(seconds for _, seconds in records.values()), 6),
+            "directives": self.slowest("directive", len(self.stats.get("directive", {}))),
+            "queries": self.slowest("query", top),
+            "batches": self.slowest("batch", top),
+            "records_slowest": self.slowest("record", top),
+        }
+
+    def save(self, template_type: str, top: int = 25, folder: str = PROFILE_FOLDER) -> str:
+        """
+        Write the report to <folder>/template_profile_<template_type>.json
+
+        return (str): the path of the report
+        """
+        os.makedirs(folder, exist_ok=True)
+        report_path = os.path.join(folder, f"template_profile_{template_type}.json")
+        with open(report_path, "w") as report_file:
+            json.dump(self.report(top), report_file, indent=2)
+        return report_path
@@ -1,14 +1,24 @@
+import asyncio
+import json
 import logging
 import os
 import re
 import sys
+import threading
 import time
 from tqdm import tqdm
 
 import requests
-from typing import List, Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dataclasses import dataclass
+from typing import List, Optional, TYPE_CHECKING
+from xml.sax.saxutils import escape, quoteattr
 from markdown_plain_text.extention import convert_to_plain_text
 
+if TYPE_CHECKING:
+    import aiohttp
+
 utils_logger_level = logging.WARNING
 
 
@@ -60,126 +70,386 @@ def get_files(folder_name: str, file_postfix: str = "json") -> Optional[List[str
     return results
 
 
-def call_basex(query: str, host: str, port: int, user: str, password: str, action: str,
-               db: str = None, content_type: str = "application/json", http_caller=requests, cooldown: int = 300) -> requests.Response:
+def split_xquery_prolog(query: str) -> tuple[str, str]:
+    """
+    Split an XQuery into its prolog (the declarations, e.g. "declare namespace js=...;") and its body.
+    Comments and string literals are skipped, so a ";" inside them does not end a declaration.
+
+    query (str): The XQuery to be split
+
+    return (tuple[str, str]): The prolog and the body of the query
+    """
+    position = 0
+    length = len(query)
+    prolog_end = 0
+    while True:
+        # skip whitespace and (nested) comments
+        while position < length:
+            if query[position].isspace():
+                position += 1
+            elif query.startswith("(:", position):
+                depth = 0
+                while position < length:
+                    if query.startswith("(:", position):
+                        depth += 1
+                        position += 2
+                    elif query.startswith(":)", position):
+                        depth -= 1
+                        position += 2
+                        if depth == 0:
+                            break
+                    else:
+                        position += 1
+            else:
+                break
+
+        if not re.match(r"(declare|import|xquery\s+version)\b", query[position:position + 20]):
+            break
+
+        # scan to the ";" which ends the declaration
+        depth = 0
+        while position < length:
+            char = query[position]
+            if char in "\"'":
+                end = query.find(char, position + 1)
+                position = length if end < 0 else end + 1
+                continue
+            if query.startswith("(:", position):
+                end = query.find(":)", position + 2)
+                position = length if end < 0 else end + 2
+                continue
+            if char in "({[":
+                depth += 1
+            elif char in ")}]":
+                depth -= 1
+            elif char == ";" and depth == 0:
+                position += 1
+                break
+            position += 1
+        prolog_end = position
+
+    return query[:prolog_end], query[prolog_end:]
+
+
+def build_batch_query(query: str) -> str:
+    """
+    Rewrite a single-id query (with the external variable $ID) into a query for a block of ids.
+    The ids are bound to the external variable $IDS as a JSON array. The body of the query is evaluated for every id
+    and the result is a JSON object: id -> the JSON result of the original query for that id (an empty string if the
+    query had no result). The batch query does not depend on the ids, so BaseX can reuse it for every block.
+
+    query (str): The query with the external variable $ID, e.g. the contents of queries/author.xq
+
+    return (str): The batch query
     """
-    This function calls the basex query
+    prolog, body = split_xquery_prolog(query)
+    prolog = re.sub(r"declare\s+variable\s+\$ID\s+external\s*;", "", prolog)
+    return f"""{prolog}
+declare variable $IDS external;
+
+serialize(
+  map:merge(
+    for $ID in parse-json($IDS)?*
+    return map:entry($ID, string-join((
+{body}
+    ), ''))
+  ),
+  map {{ 'method': 'json' }}
+)
+"""
+
+
+# BaseX server as defined in docker-compose.yaml
+BASEX_HOST = "basex"
+BASEX_PORT = 8080
+BASEX_USER = "admin"
+BASEX_PASSWORD = "pass"
+# default number of pooled connections, the same as the default number of templating workers
+BASEX_POOL_SIZE = 12
+# (connect, read) timeout in seconds of a single basex request
+BASEX_TIMEOUT = (10, 300)
+# transient errors of basex (or a proxy in front of it) which are retried
+BASEX_RETRY_STATUS = (502, 503, 504)
+
+
+class BaseXClient:
+    """
+    Client for the BaseX REST API.
+
+    All requests share a session with a pool of keep-alive connections, so the small XQuery calls of the templating do
+    not pay the connection setup. The credentials are sent with basic authentication instead of in the url.
+    Requests have a timeout and are retried with a backoff on transient 5xx errors.
 
-    query (str): The query to be executed
     host (str): The host of the basex server
     port (int): The port of the basex server
     user (str): The user of the basex server
     password (str): The password of the basex server
-
-    return (str): The response of the basex query
+    pool_size (int): The number of pooled connections, should be the number of workers using this client
+    timeout (tuple): The (connect, read) timeout in seconds
+    retries (int): The number of retries on connection errors and transient 5xx errors
+    max_in_flight (int): The maximum number of requests running at the same time, by default pool_size
     """
-    if db:
-        url: str = f"http://{user}:{password}@{host}:{port}/rest/{db}"
-    else:
-        url: str = f"http://{user}:{password}@{host}:{port}/rest"
-
-    # print(f"Executing the basex query: {query} on {url=} with {action=} ...")
-    # logger.info(f"Executing the basex query: {query} on {url=} with {action=} ...")
-    if action == "get":
-        response = http_caller.get(url, data=query, headers={"Content-Type": content_type})
-    elif action == "post":
-        response = http_caller.post(url, data=query, headers={"Content-Type": content_type})
-    else:
+
+    def __init__(self, host: str = None, port: int = None, user: str = BASEX_USER,
+                 password: str = BASEX_PASSWORD, pool_size: int = BASEX_POOL_SIZE, timeout: tuple = BASEX_TIMEOUT,
+                 retries: int = 3, max_in_flight: int = None):
+        # BASEX_HOST and BASEX_PORT by default, looked up here so they can be changed, e.g. by benchmark.py
+        self.url = f"http://{host or BASEX_HOST}:{port or BASEX_PORT}/rest"
+        self.timeout = timeout
+        # bounds the requests of all threads using this client, so BaseX is not flooded
+        self.in_flight = threading.BoundedSemaphore(max_in_flight or pool_size)
+        self.session = make_http_session(pool_size, retries, BASEX_RETRY_STATUS)
+        self.session.auth = (user, password)
+
+    def call(self, body: str, db: str = None, action: str = "post", content_type: str = "application/xml",
+             timeout: tuple = None) -> requests.Response:
+        """
+        Send a request to the REST API
+
+        body (str): The body of the request, e.g. a <query> element
+        db (str): The database the query runs on, or None for the server
+        action (str): 'get' or 'post'
+        """
+        url = f"{self.url}/{db}" if db else self.url
+        timeout = timeout or self.timeout
+        with self.in_flight:
+            if action == "get":
+                return self.session.get(url, data=body, headers={"Content-Type": content_type}, timeout=timeout)
+            elif action == "post":
+                return self.session.post(url, data=body.encode("utf-8"), headers={"Content-Type": content_type},
+                                         timeout=timeout)
         raise Exception(f"Invalid action {action}; Valid actions are 'get' and 'post'")
 
-    return response
+    def query(self, query: str, db: str, variables: dict = None, timeout: tuple = None) -> requests.Response:
+        """
+        Run an XQuery on the database
+
+        query (str): The query to be executed
+        db (str): The database to be queried
+        variables (dict): The values of the external variables of the query, e.g. {"ID": "frog"}. Binding the values
+            instead of substituting them keeps the query text the same for every call, so BaseX can cache it,
+            and values containing quotes cannot break (or inject into) the query.
+
+        return (requests.Response): The response of the basex query
+        """
+        return self.call(basex_query_body(query, variables), db, timeout=timeout)
 
+    def query_file(self, file_path: str, db: str) -> requests.Response:
+        """
+        Run the XQuery in the file on the database
+        """
+        with open(file_path, "r") as file:
+            return self.query(file.read(), db)
 
-def call_basex_with_file(file_path: str,
-                         host: str,
-                         port: int,
-                         user: str,
-                         password: str,
-                         action: str,
-                         db: str) -> requests.Response:
+    def query_batch(self, batch_query: str, ids: list[str], db: str, variables: dict = None) -> dict[str, str]:
+        """
+        Run a single-id query for a block of ids in one call
+
+        batch_query (str): The query rewritten by build_batch_query
+        ids (list[str]): The ids to evaluate the query for
+        db (str): The database to be queried
+        variables (dict): The values of the other external variables of the query
+
+        return (dict[str, str]): The response text of the query for every id
+        """
+        response = self.query(batch_query, db, {**(variables or {}), "IDS": json.dumps(ids)})
+        if response.status_code != 200:
+            raise Exception(f"HttpError {response.status_code} Error running batch query on basex: {response.text}")
+        return json.loads(response.text)
+
+    def close(self) -> None:
+        self.session.close()
+
+
+def basex_query_body(query: str, variables: dict = None) -> str:
+    """
+    The body of a REST request running the query, with the values of its external variables
     """
-    This function calls the basex query
+    bindings = "".join(f"<variable name={quoteattr(name)} value={quoteattr(value)}/>"
+                       for name, value in (variables or {}).items())
+    return f"<query><text>{escape(query)}</text>{bindings}</query>"
+
+
+def make_http_session(pool_size: int, retries: int, retry_status: tuple) -> requests.Session:
+    """
+    Create a session with a pool of keep-alive connections which retries on connection errors and the given statuses.
+
+    pool_size (int): The maximum number of connections kept per host
+    retries (int): The number of retries, with an exponential backoff
+    retry_status (tuple): The HTTP statuses to be retried
+    """
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=retry_status,
+                  allowed_methods=frozenset({"GET", "POST"}), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry, pool_block=True)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-    file_path (str): The file path to the query to be executed
-    host (str): The host of the basex server
-    port (int): The port of the basex server
-    user (str): The user of the basex server
-    password (str): The password of the basex server
 
-    return (str): The response of the basex query
-    """
-    with open(file_path, "r") as file:
-        content = file.read()
-        content = content.replace("<js:", "&lt;js:")
-        content = content.replace("</js:", "&lt;/js:")
-        query = """
-        <query>
-            <text>
-                {query}
-            </text>
-        </query>
-        """.format(query=content)
-        response = call_basex(query, host, port, user, password, action, db)
-    return response
-
-
-def call_basex_with_query(query: str,
-                          host: str,
-                          port: int,
-                          user: str,
-                          password: str,
-                          action: str,
-                          db: str,
-                          content_type: str = "application/json",
-                          http_caller=requests
-                          ) -> requests.Response:
-    """
-    This function calls the basex query
-
-    file_path (str): The file path to the query to be executed
+# the client of this process, see get_basex_client
+basex_client: Optional[BaseXClient] = None
+
+
+def get_basex_client(pool_size: int = BASEX_POOL_SIZE) -> BaseXClient:
+    """
+    Get the BaseX client of this process, it is created on first use.
+    """
+    global basex_client
+    if basex_client is None:
+        basex_client = BaseXClient(pool_size=pool_size)
+    return basex_client
+
+
+def init_basex_client(pool_size: int = BASEX_POOL_SIZE, **kwargs) -> BaseXClient:
+    """
+    (Re)create the BaseX client of this process, e.g. with a pool sized to the number of workers.
+    """
+    global basex_client
+    if basex_client is not None:
+        basex_client.close()
+    basex_client = BaseXClient(pool_size=pool_size, **kwargs)
+    return basex_client
+
+
+# default number of requests in flight of the asyncio clients, over all tasks of the event loop
+ASYNC_CONCURRENCY = 200
+
+
+@dataclass
+class HttpResponse:
+    """
+    The status and the body of a response of the asyncio clients, read before the connection is released.
+    """
+    status_code: int
+    text: str
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncHttpClient:
+    """
+    asyncio client for the I/O-bound stages, one process keeps many requests in flight without a pool of threads
+    or processes. Use it as an async context manager, the session is bound to the running event loop.
+    aiohttp is only imported when a client is entered, so the synchronous paths do not depend on it.
+
+    Just like make_http_session, the connections are kept alive and the requests are retried with an exponential
+    backoff on connection errors and the given statuses.
+
+    concurrency (int): The maximum number of requests in flight
+    timeout (tuple): The (connect, read) timeout in seconds
+    retries (int): The number of retries
+    retry_status (tuple): The HTTP statuses to be retried
+    headers (dict): The headers sent with every request, e.g. the Authorization header
+    auth (tuple): The (user, password) of basic authentication
+    """
+
+    def __init__(self, concurrency: int = ASYNC_CONCURRENCY, timeout: tuple = BASEX_TIMEOUT, retries: int = 3,
+                 retry_status: tuple = BASEX_RETRY_STATUS, headers: dict = None, auth: tuple = None):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_status = retry_status
+        self.headers = headers
+        self.auth = auth
+        self.session: Optional["aiohttp.ClientSession"] = None
+        self.semaphore: Optional[asyncio.Semaphore] = None
+
+    async def __aenter__(self):
+        import aiohttp
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]),
+            headers=self.headers,
+            auth=aiohttp.BasicAuth(*self.auth) if self.auth else None)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+        self.session = None
+
+    async def request(self, method: str, url: str, **kwargs) -> HttpResponse:
+        """
+        Send a request, e.g. request("POST", url, json=package), kwargs are passed on to aiohttp.
+
+        return (HttpResponse): The response, after the retries
+        """
+        import aiohttp
+        attempt = 0
+        while True:
+            try:
+                async with self.semaphore:
+                    async with self.session.request(method, url, **kwargs) as response:
+                        result = HttpResponse(response.status, await response.text())
+                if result.status_code not in self.retry_status or attempt >= self.retries:
+                    return result
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= self.retries:
+                    raise
+            await asyncio.sleep(0.5 * 2 ** attempt)
+            attempt += 1
+
+    async def get(self, url: str, **kwargs) -> HttpResponse:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> HttpResponse:
+        return await self.request("POST", url, **kwargs)
+
+
+class AsyncBaseXClient(AsyncHttpClient):
+    """
+    asyncio client for the BaseX REST API, the counterpart of BaseXClient.
+
     host (str): The host of the basex server
     port (int): The port of the basex server
     user (str): The user of the basex server
     password (str): The password of the basex server
-
-    return (str): The response of the basex query
+    concurrency (int): The maximum number of requests in flight, BaseX queues the requests above its own limit
     """
-    query = query.replace("<js:", "&lt;js:")
-    query = query.replace("</js:", "&lt;/js:")
-    query = """
-    <query>
-        <text>
-            {query}
-        </text>
-    </query>
-    """.format(query=query)
-    response = call_basex(query, host, port, user, password, action, db, content_type, http_caller)
-    return response
+
+    def __init__(self, host: str = None, port: int = None, user: str = BASEX_USER,
+                 password: str = BASEX_PASSWORD, concurrency: int = ASYNC_CONCURRENCY, **kwargs):
+        super().__init__(concurrency=concurrency, auth=(user, password), **kwargs)
+        self.url = f"http://{host or BASEX_HOST}:{port or BASEX_PORT}/rest"
+
+    async def call(self, body: str, db: str = None, content_type: str = "application/xml") -> HttpResponse:
+        url = f"{self.url}/{db}" if db else self.url
+        return await self.post(url, data=body.encode("utf-8"), headers={"Content-Type": content_type})
+
+    async def query(self, query: str, db: str, variables: dict = None) -> HttpResponse:
+        """
+        Run an XQuery on the database, see BaseXClient.query
+        """
+        return await self.call(basex_query_body(query, variables), db)
+
+    async def query_batch(self, batch_query: str, ids: list[str], db: str, variables: dict = None) -> dict[str, str]:
+        """
+        Run a single-id query for a block of ids in one call, see BaseXClient.query_batch
+        """
+        response = await self.query(batch_query, db, {**(variables or {}), "IDS": json.dumps(ids)})
+        if response.status_code != 200:
+            raise Exception(f"HttpError {response.status_code} Error running batch query on basex: {response.text}")
+        return json.loads(response.text)
 
 
 def get_ids_from_basex_by_query(query_file: str,
-                                host: str = "basex",
-                                port: int = 8080,
-                                user: str = "admin",
-                                password: str = "pass",
-                                db: str = "tools") -> list[str]:
+                                db: str = "tools",
+                                client: BaseXClient = None) -> list[str]:
     """
     This function gets the IDs from the basex table by executing a query
 
     query_file (str): The file path to the query to be executed
-    table_name (str): The name of the table to be queried
+    db (str): The name of the table to be queried
+    client (BaseXClient): The client to be used, by default the client of this process
 
     return (list[str]): The list of IDs from the basex table
     """
     logger = get_logger("basex.log", "basex")
     logger.info(f"Getting IDs from basex table {db} by executing the query {query_file} ...")
-    response = call_basex_with_file(file_path=query_file,
-                                    host=host,
-                                    port=port,
-                                    user=user,
-                                    password=password,
-                                    action="post",
-                                    db=db)
+    client = client or get_basex_client()
+    response = client.query_file(query_file, db)
     if 199 < response.status_code < 300:
         logger.info(
             f"Status: {response.status_code} Got IDs from basex table {db} by executing the query {query_file} ...")
@@ -218,6 +488,20 @@ def shorten_list_or_string(long_text: str | list, limit: int, more_characters: s
     return shortened
 
 
+def normalize_ruc(ruc: dict) -> dict:
+    """
+    The RUC (Rich User Contents) with its keys lowercased, also of the nested dictionaries, so the keys can be
+    looked up case-insensitively with a dictionary lookup (see template.resolve_path).
+    The first key wins when keys only differ in case, e.g. "Overview" and "overview".
+    """
+    normalized = {}
+    for key, value in ruc.items():
+        if isinstance(value, dict):
+            value = normalize_ruc(value)
+        normalized.setdefault(key.lower() if isinstance(key, str) else key, value)
+    return normalized
+
+
 def get_id_from_file_name(file_name: str) -> str:
     parts = file_name.split(".")[0:-1]
     parts = ".".join(parts)
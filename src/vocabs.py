@@ -0,0 +1,162 @@
+import bisect
+import json
+import logging
+import os
+from typing import Optional
+
+from utils import get_logger
+
+logger = get_logger("template.log", __name__, level=logging.WARNING)
+
+"""
+The vocabularies (INEO properties, e.g. researchDomains.json or mediaTypes.json) used to map the metadata to INEO,
+shared by template.py and ineo_sync.py.
+
+Every property file is loaded once and indexed, so mapping a value does not scan the vocabulary:
+- the case-insensitive match on the title (template.process_vocabs) and on the link (normalize_properties) are
+  dictionary lookups
+- the case-insensitive match of a value within a title (normalize_properties) is a single search in the
+  concatenated titles, the result is memoized per value
+The first entry of the property file wins when more than one entry matches, as with the scans these replace.
+"""
+
+# folder with the INEO properties, downloaded by ineo_get_properties.py
+PROPERTIES_FOLDER = "./properties"
+
+# the properties of the INEO packages mapped to the links of INEO per record type, see normalize_properties
+NORMALIZED_PROPERTIES = {
+    "tools": ("researchDomains", "researchActivities"),
+    "datasets": ("researchDomains",),
+}
+
+# separates the titles in the concatenated titles, it does not occur in a title
+TITLE_SEPARATOR = "\x00"
+
+
+class Vocabulary:
+    """
+    name (str): the name of the property, e.g. "researchDomains"
+    entries (list): the entries of the property file, dictionaries with (amongst others) "index", "title" and "link"
+    """
+
+    def __init__(self, name: str, entries: list):
+        self.name = name
+        self.entries = entries
+
+        # stripped and lowercased title -> "{index} {title}", or the title if there is no index
+        self.titles = {}
+        # lowercased link -> link
+        self.links = {}
+        for entry in entries:
+            title = (entry.get("title") or "").strip()
+            self.titles.setdefault(title.lower(), f"{entry['index']} {title}" if entry.get("index") is not None
+                                   else title)
+            if entry.get("link") is not None:
+                self.links.setdefault(entry["link"].lower(), entry["link"])
+
+        # the lowercased titles joined, with the start of every title in it
+        lowered_titles = [(entry.get("title") or "").lower() for entry in entries]
+        self.corpus = TITLE_SEPARATOR.join(lowered_titles)
+        self.offsets = []
+        offset = 0
+        for title in lowered_titles:
+            self.offsets.append(offset)
+            offset += len(title) + len(TITLE_SEPARATOR)
+        self.in_titles = {}
+
+    def match_title(self, value: str) -> Optional[str]:
+        """
+        The "{index} {title}" of the entry whose title equals the value (case-insensitive), e.g. "7.23 plain"
+        """
+        return self.titles.get(value.lower())
+
+    def match_link(self, value: str) -> Optional[str]:
+        """
+        The link of the entry whose link equals the value (case-insensitive), with the spelling of INEO
+        """
+        return self.links.get(value.lower())
+
+    def find_in_titles(self, value: str) -> Optional[dict]:
+        """
+        The first entry whose title contains the value (case-insensitive)
+        """
+        needle = value.lower()
+        if needle not in self.in_titles:
+            entry = None
+            if TITLE_SEPARATOR not in needle:
+                position = self.corpus.find(needle)
+                if position >= 0 and self.entries:
+                    entry = self.entries[bisect.bisect_right(self.offsets, position) - 1]
+            self.in_titles[needle] = entry
+        return self.in_titles[needle]
+
+    def map_to_ineo(self, values: list) -> tuple[list, list]:
+        """
+        Map the values (e.g. research domains) to the links of INEO: on the link first, then on the titles.
+
+        return (tuple): the links of the matched values, and the values without a match
+        """
+        links = []
+        non_matches = []
+        for value in values:
+            link = self.match_link(value)
+            if link is not None:
+                logger.info(f"Match found: {value}")
+                links.append(link)
+                continue
+            entry = self.find_in_titles(value)
+            if entry is not None:
+                logger.info(f"Match found in title: {value}")
+                links.append(entry["link"])
+            else:
+                logger.info(f"No match found for: {value}")
+                non_matches.append(value)
+        return links, non_matches
+
+
+# the loaded vocabularies of this process, see get_vocabulary
+vocabularies = {}
+
+
+def get_vocabulary(name: str) -> Optional[Vocabulary]:
+    """
+    Load the vocabulary once and keep it.
+    Returns None if the properties have not been downloaded (yet).
+    """
+    if name not in vocabularies:
+        vocab_path = os.path.join(PROPERTIES_FOLDER, f"{name}.json")
+        if not os.path.exists(vocab_path):
+            return None
+        with open(vocab_path, "r") as vocab_file:
+            vocabularies[name] = Vocabulary(name, json.load(vocab_file))
+    return vocabularies[name]
+
+
+def normalize_properties(ineo_package: list, record_type: str) -> list:
+    """
+    Replace the researchDomains and researchActivities of the INEO package (in place) by the links of INEO.
+    There are some discrepancies, e.g. https://w3id.org/nwo-research-fields#TextualAndContentAnalysis (INEO)
+    and https://w3id.org/nwo-research-fields#TextualandContentAnalysis (processed Json file of Alud).
+    Mapping the links of INEO again gives the same links, so an already normalized package does not change.
+
+    ineo_package (list): the documents of the package, as templated by template.template_package
+    record_type (str): 'tools' or 'datasets', other record types are not normalized
+
+    return (list): the names of the properties (vocabularies) the result depends on, also when not downloaded (yet)
+    """
+    names = list(NORMALIZED_PROPERTIES.get(record_type, ()))
+    for name in names:
+        vocabulary = get_vocabulary(name)
+        if vocabulary is None:
+            continue
+        for document in ineo_package:
+            properties = document.get("document", {}).get("properties", {})
+            values = properties.get(name)
+            if values is None:
+                continue
+            # Filter out None values
+            links, non_matches = vocabulary.map_to_ineo([value for value in values if value])
+            if non_matches:
+                logger.info(f"no matches for: {non_matches}")
+            properties[name] = links
+    return names